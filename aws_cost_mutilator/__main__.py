@@ -2,6 +2,7 @@ from boto3 import Session
 from click import group, option, pass_context
 
 import json
+from dataclasses import asdict
 from .ec2 import (
     scan_for_lbs_no_targets,
     delete_lbs,
@@ -11,18 +12,130 @@ from .ec2 import (
     delete_ebs_volumes,
     get_old_snapshots,
     estimate_snapshots_cost,
+    get_orphaned_snapshots,
+    delete_ebs_snapshots,
+    resolve_in_flight_deletions,
+    SNAPSHOT_PRICE_PER_GB_MONTH,
+)
+from .s3 import (
+    get_buckets,
+    get_bucket_stats_cost,
+    delete_buckets,
+    get_bucket_fingerprints,
 )
-from .s3 import get_buckets, get_bucket_cost
 from .iam import get_unused_iam_roles
+from .inventory import get_inventory_stats, DEFAULT_CSV_SCHEMA
+from .journal import Journal, get_journal_path
+from .server import ScanServer, DEFAULT_TTLS
+from .tags import build_tag_filter
+from .cur import (
+    get_monthly_cur_costs,
+    apply_cur_costs_to_volumes,
+    apply_cur_costs_to_lbs,
+)
+from .metrics import (
+    Registry,
+    set_registry,
+    instrument_session,
+    record_findings,
+    record_savings,
+)
+from .trace import Tracer, set_tracer, trace_session
+from .cassette import Recorder, Player
+from .memo import ResponseMemo
+from .graph import build_resource_graph
+from .elb import scan_for_clbs_no_instances, delete_clbs
+from .cloudtrail import get_principals_last_used, CLOUDTRAIL_STATE_PATH
+from .ebs import estimate_snapshots_unique_cost
+from .api import Scanner, Cleaner
+from .marks import (
+    get_due_findings,
+    get_marked_resources,
+    get_bucket_regions,
+    get_finding_regions,
+    mark_findings,
+    MARK_TAG_KEY,
+)
+from .delta import (
+    get_index_path,
+    load_index,
+    save_index,
+    diff_findings,
+    get_unchanged_results,
+    record_inspections,
+)
 
 
 @group()
 @option("--profile", "-p", required=False, help="AWS profile")
 @option("--region", "-r", required=False, help="AWS region")
+@option(
+    "--include-tag",
+    multiple=True,
+    help="Only report resources with this tag, as KEY=VALUE or KEY for any value (repeatable)",
+)
+@option(
+    "--exclude-tag",
+    multiple=True,
+    help="Never report resources with this tag, as KEY=VALUE or KEY for any value (repeatable)",
+)
+@option(
+    "--metrics-file",
+    help="Write OpenMetrics telemetry of the run to this file, e.g. in node-exporter's textfile directory",
+)
+@option(
+    "--metrics-push",
+    help="Push telemetry of the run to this Pushgateway URL, e.g. http://localhost:9091/metrics/job/acm",
+)
+@option(
+    "--trace",
+    help="Write a Chrome trace-event JSON timeline of the run's scanners, deleters and AWS calls to this file, viewable in ui.perfetto.dev",
+)
+@option(
+    "--record",
+    help="Record the sanitized responses of every AWS call of the run to this gzipped cassette file",
+)
+@option(
+    "--replay",
+    help="Serve AWS calls from a cassette file recorded with --record instead of calling AWS",
+)
+@option(
+    "--replay-latency",
+    type=float,
+    default=0,
+    show_default=True,
+    help="Factor of the recorded call durations to wait before serving a replayed response",
+)
+@option(
+    "--replay-throttle-rate",
+    type=float,
+    default=0,
+    show_default=True,
+    help="Chance of a replayed call attempt being throttled and backed off from",
+)
+@option(
+    "--no-cache",
+    is_flag=True,
+    help="Call AWS for every read instead of serving repeated describe, list and get calls of the run from memory",
+)
 @pass_context
-def cli(ctx, profile, region):
+def cli(
+    ctx,
+    profile,
+    region,
+    include_tag,
+    exclude_tag,
+    metrics_file,
+    metrics_push,
+    trace,
+    record,
+    replay,
+    replay_latency,
+    replay_throttle_rate,
+    no_cache,
+):
     print("Welcome to the AWS Cost Mutilator!")
-    ctx.obj = {}
+    ctx.obj = {"include_tags": include_tag, "exclude_tags": exclude_tag}
 
     if profile and region:
         ctx.obj["session"] = Session(region_name=region, profile_name=profile)
@@ -41,21 +154,355 @@ def cli(ctx, profile, region):
         ctx.obj["profile"] = ctx.obj["session"].profile_name
         ctx.obj["region"] = ctx.obj["session"].region_name
 
+    if record and replay:
+        print("--record and --replay cannot be used together")
+        exit(1)
+    if record:
+        recorder = Recorder(record)
+        recorder.attach(ctx.obj["session"])
+        ctx.call_on_close(recorder.write)
+    if replay:
+        Player(replay, replay_latency, replay_throttle_rate).attach(ctx.obj["session"])
+
+    if metrics_file or metrics_push:
+        enable_metrics(ctx, metrics_file, metrics_push)
+    if trace:
+        enable_tracing(ctx, trace)
+    # the server keeps scan results for their TTL itself, a memo of the whole process
+    # would serve its reads long after that
+    if not no_cache and ctx.invoked_subcommand != "serve":
+        ResponseMemo().attach(ctx.obj["session"])
+
+
+def enable_metrics(ctx, metrics_file, metrics_push):
+    # The API hooks must be registered before the first client is created, clients
+    # copy the session's event handlers. Metrics are written when the command exits,
+    # commands end with exit() so this runs on the context's close.
+    registry = Registry(
+        {
+            "profile": ctx.obj["profile"] or "default",
+            "region": ctx.obj["region"] or "",
+        }
+    )
+    set_registry(registry)
+    instrument_session(ctx.obj["session"], registry)
+
+    def write_metrics():
+        set_registry(None)
+        if metrics_file:
+            registry.write_textfile(metrics_file)
+        if metrics_push:
+            try:
+                registry.push(metrics_push)
+            except OSError as e:
+                print(f"Failed to push metrics to {metrics_push}: {e}")
+
+    ctx.call_on_close(write_metrics)
+
+
+def enable_tracing(ctx, path):
+    session = ctx.obj["session"]
+    try:
+        account = session.client("sts").get_caller_identity()["Account"]
+    except Exception:
+        account = None
+
+    tracer = Tracer({"account": account, "region": ctx.obj["region"]})
+    set_tracer(tracer)
+    trace_session(session, tracer)
+
+    def write_trace():
+        set_tracer(None)
+        tracer.write(path)
+        print(f"Wrote trace of the run to {path}")
+
+    ctx.call_on_close(write_trace)
+
+
+def get_tag_filter(ctx):
+    # the tag index is only crawled once per run, and only if tags were given
+    if "tag_filter" not in ctx.obj:
+        ctx.obj["tag_filter"] = build_tag_filter(
+            ctx.obj["session"], ctx.obj["include_tags"], ctx.obj["exclude_tags"]
+        )
+
+    return ctx.obj["tag_filter"]
+
 
 @cli.group()
+@option(
+    "--cur",
+    multiple=True,
+    help="Cost and Usage Report Parquet or CSV file, or a directory of them, to take actual resource costs from (repeatable)",
+)
+@option(
+    "--cur-days",
+    type=int,
+    default=30,
+    show_default=True,
+    help="Number of most recent days of the Cost and Usage Report to sum costs over",
+)
+@option(
+    "--since-last",
+    is_flag=True,
+    help="Only report findings that are new, changed or resolved since the last --since-last run of the check",
+)
 @pass_context
-def check(ctx):
+def check(ctx, cur, cur_days, since_last):
+    ctx.obj["cur"] = cur
+    ctx.obj["cur_days"] = cur_days
+    ctx.obj["since_last"] = since_last
     pass
 
 
+def get_regions(ctx, regions, all_regions):
+    # regions enabled for the account, or the given ones, or the session's region
+    if all_regions:
+        ec2 = ctx.obj["session"].client("ec2")
+        return [region["RegionName"] for region in ec2.describe_regions()["Regions"]]
+
+    return list(regions) or [ctx.obj["region"]]
+
+
+def get_actual_costs(ctx, resource_ids):
+    # monthly cost per resource from the Cost and Usage Report, if one was given
+    if not ctx.obj["cur"] or not resource_ids:
+        return {}
+
+    print("reading cost and usage report...")
+    return get_monthly_cur_costs(ctx.obj["cur"], resource_ids, ctx.obj["cur_days"])
+
+
+def print_lbs(load_balancers, idle_days, action):
+    # Idle load balancers are deleted with their populated target groups, so they are
+    # listed apart from the ones with empty target groups
+    empty = {
+        arn: lb for arn, lb in load_balancers.items() if "idle_target_groups" not in lb
+    }
+    idle = {arn: lb for arn, lb in load_balancers.items() if "idle_target_groups" in lb}
+    if empty:
+        print(f"There are {len(empty)} load balancers with empty target groups:")
+        print(json.dumps(empty, indent=4))
+    if idle:
+        print(
+            f"There are {len(idle)} load balancers without traffic for {idle_days} days, all their target groups {action} deleted with them, including populated ones:"
+        )
+        print(json.dumps(idle, indent=4))
+
+    return idle
+
+
+def print_progress(event):
+    if event.message:
+        print(event.message)
+
+
+def report_since_last(ctx, check, **options):
+    # Compares the findings of the check with the index its last --since-last run
+    # stored, prints what is new, changed or resolved and stores the findings for
+    # the next run. Costs are the estimates of the check, --cur is not applied.
+    session = ctx.obj["session"]
+    path = get_index_path(check, ctx.obj["profile"], ctx.obj["region"])
+    index = load_index(path)
+    scanner = Scanner(
+        session, tag_filter=get_tag_filter(ctx), on_progress=print_progress
+    )
+
+    # buckets whose storage metrics have not changed are not listed again
+    if check == "s3":
+        print("getting bucket storage metrics...")
+        fingerprints = get_bucket_fingerprints(session)
+        unchanged = get_unchanged_results(index, fingerprints)
+        print(f"reusing the stats of {len(unchanged)} buckets that have not changed")
+        options["stats"] = {**unchanged, **options.get("stats", {})}
+
+    findings = list(scanner.scan(check, **options))
+    delta, index["findings"] = diff_findings(index["findings"], findings)
+    if check == "s3":
+        record_inspections(index, fingerprints, options["stats"])
+    save_index(path, index)
+
+    record_findings(
+        check, len(findings), sum([finding.monthly_cost for finding in findings])
+    )
+
+    print(
+        f"Since the last scan there are {len(delta['new'])} new, {len(delta['changed'])} changed and {len(delta['resolved'])} resolved {check} findings:"
+    )
+    print(json.dumps(delta, indent=4, default=str))
+    exit(0)
+
+
 @cli.group()
 @option("--dry-run", "-d", is_flag=True, help="Perform a dry run")
+@option(
+    "--resume",
+    is_flag=True,
+    help="Resume an interrupted cleanup from its journal instead of scanning again",
+)
+@option(
+    "--journal",
+    help="Path of the cleanup journal, defaults to ~/.acm/journals/<command>-<profile>-<region>.jsonl",
+)
+@option(
+    "--mark",
+    is_flag=True,
+    help=f"Tag the resources found with {MARK_TAG_KEY} instead of deleting them",
+)
+@option(
+    "--sweep",
+    is_flag=True,
+    help="Delete the resources found that were marked at least --older-than days ago",
+)
+@option(
+    "--older-than",
+    type=int,
+    help="Grace period in days between marking a resource and sweeping it",
+)
 @pass_context
-def clean(ctx, dry_run):
+def clean(ctx, dry_run, resume, journal, mark, sweep, older_than):
+    if mark and sweep:
+        print("--mark and --sweep cannot be used together.")
+        exit(1)
+    if sweep and older_than is None:
+        print("--sweep requires --older-than.")
+        exit(1)
+
     ctx.obj["dry_run"] = dry_run
+    ctx.obj["resume"] = resume
+    ctx.obj["journal"] = journal
+    ctx.obj["mark"] = mark
+    ctx.obj["sweep"] = sweep
+    ctx.obj["older_than"] = older_than
     pass
 
 
+def open_journal(ctx, command):
+    # dry runs delete nothing, so there is nothing to journal
+    if ctx.obj["dry_run"]:
+        return None
+
+    path = ctx.obj["journal"] or get_journal_path(
+        command, ctx.obj["profile"], ctx.obj["region"]
+    )
+    journal = Journal(path, resume=ctx.obj["resume"])
+    ctx.call_on_close(journal.close)
+    return journal
+
+
+def record_realized_savings(ctx, check, monthly_cost):
+    # dry runs delete nothing, so they save nothing
+    if not ctx.obj["dry_run"]:
+        record_savings(check, monthly_cost)
+
+
+def resume_cleanup(ctx, command, kind, delete):
+    # Continues the cleanup recorded in the journal of the command without scanning
+    # or asking for confirmation again, delete is called with the journaled plan
+    session = ctx.obj["session"]
+    journal = open_journal(ctx, command)
+
+    if journal is None:
+        print("Cannot resume a cleanup in dry run mode.")
+        exit(1)
+
+    resources = journal.plan(kind)
+    if len(resources) == 0:
+        print(f"No interrupted cleanup found in {journal.path}")
+        exit(1)
+
+    resolved = resolve_in_flight_deletions(session, journal)
+    print(
+        f"Resuming cleanup of {len(resources)} resources from {journal.path}, {resolved} in-flight deletions already completed:"
+    )
+    print(json.dumps(journal.summary(), indent=4))
+
+    delete(resources, journal)
+
+    print("Cleanup finished:")
+    print(json.dumps(journal.summary(), indent=4))
+    exit(0)
+
+
+def mark_or_sweep(ctx, check, clean_options=None, **options):
+    # --mark tags what the check finds with the time it was marked, --sweep deletes
+    # what the check still finds once its mark is older than the grace period.
+    # Marked resources the check no longer finds are in use again and left alone.
+    session = ctx.obj["session"]
+    dry_run = ctx.obj["dry_run"]
+    scanner = Scanner(
+        session, tag_filter=get_tag_filter(ctx), on_progress=print_progress
+    )
+    findings = list(scanner.scan(check, **options))
+    bucket_regions = get_bucket_regions(session, findings)
+    regions = get_finding_regions(findings, ctx.obj["region"], bucket_regions)
+
+    print("getting marked resources...")
+    marked = get_marked_resources(session, regions or [ctx.obj["region"]])
+
+    if ctx.obj["mark"]:
+        if dry_run:
+            print("Dry run mode enabled, no resources will be tagged.")
+
+        result = mark_findings(
+            session, findings, marked, dry_run, bucket_regions=bucket_regions
+        )
+        print(
+            f"Marked {len(result['tagged'])} resources of {len(findings)} {check} findings for deletion, resources already marked keep their mark."
+        )
+        if result["failed"]:
+            print(f"Failed to mark {len(result['failed'])} resources:")
+            print(json.dumps(result["failed"], indent=4))
+        exit(0)
+
+    older_than = ctx.obj["older_than"]
+    account_id = session.client("sts").get_caller_identity()["Account"]
+    due = get_due_findings(findings, marked, older_than, account_id)
+
+    if len(due) == 0:
+        print(
+            f"No {check} findings marked for deletion more than {older_than} {'day' if older_than == 1 else 'days'} ago!"
+        )
+        exit(0)
+
+    print(
+        f"There are {len(due)} {check} findings marked for deletion more than {older_than} {'day' if older_than == 1 else 'days'} ago:"
+    )
+    print(
+        json.dumps(
+            {finding.resource_id: finding.details for finding in due},
+            indent=4,
+            default=str,
+        )
+    )
+
+    # Ask the user for confirmation
+    response = input(
+        f"Are you sure you want to continue? This will delete the resources of {len(due)} {check} findings. (yes/no): "
+    )
+    if response != "yes":
+        print("Aborted")
+        exit(0)
+
+    if dry_run:
+        print("Dry run mode enabled, no resources will be deleted.")
+
+    journal = open_journal(ctx, check)
+    results = Cleaner(
+        session, dry_run=dry_run, journal=journal, on_progress=print_progress
+    ).clean(due, **(clean_options or {}))
+
+    deleted = {resource_id for result in results for resource_id in result.deleted}
+    saved_monthly_cost = sum(
+        [finding.monthly_cost for finding in due if finding.resource_id in deleted]
+    )
+    record_realized_savings(ctx, check, saved_monthly_cost)
+
+    print(f"Swept {len(deleted)} resources saving ${saved_monthly_cost:.2f} per month:")
+    print(json.dumps([asdict(result) for result in results], indent=4))
+    exit(0)
+
+
 @check.command("s3")
 @option(
     "--days",
@@ -63,14 +510,36 @@ def clean(ctx, dry_run):
     default=365,
     help="Find empty buckets and buckets with no objects newer than this number of days",
 )
+@option(
+    "--inventory",
+    multiple=True,
+    help="S3 Inventory manifest, inventory file or directory to read bucket contents from instead of listing them, local or s3:// (repeatable)",
+)
+@option(
+    "--inventory-schema",
+    default=DEFAULT_CSV_SCHEMA,
+    show_default=True,
+    help="Field names of CSV inventory files read without a manifest",
+)
 @pass_context
-def s3_(ctx, days):
+def s3_(ctx, days, inventory, inventory_schema):
     session = ctx.obj["session"]
     profile = ctx.obj["profile"]
-    buckets = get_buckets(session, days)
+    stats = {}
+    if inventory:
+        print("reading s3 inventory files...")
+        stats = get_inventory_stats(session, inventory, inventory_schema)
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "s3", days=days, stats=stats)
+    buckets = get_buckets(session, days, stats, get_tag_filter(ctx))
+    actual_costs = get_actual_costs(ctx, buckets["old"])
     cost = 0
     for bucket_name in buckets["old"]:
-        cost += get_bucket_cost(session, bucket_name)
+        if bucket_name in actual_costs:
+            cost += actual_costs[bucket_name]
+        else:
+            cost += get_bucket_stats_cost(stats[bucket_name])
+    record_findings("s3", len(buckets["old"]) + len(buckets["empty"]), cost)
     print(json.dumps(buckets, indent=4))
     print(
         f"Run:\n\nacm --profile {profile} clean s3 --days {days}\n\nto delete these resources and save ${cost:.2f} per month"
@@ -79,10 +548,33 @@ def s3_(ctx, days):
 
 @check.command("roles")
 @option("--days", type=int, help="Find roles unused for this many days")
+@option(
+    "--cloudtrail",
+    multiple=True,
+    help="CloudTrail log files, a local sync of the trail bucket or an s3:// trail prefix to read role usage from instead of the 90 day event history (repeatable)",
+)
+@option(
+    "--cloudtrail-state",
+    default=CLOUDTRAIL_STATE_PATH,
+    show_default=True,
+    help="File keeping the role usage read so far and which log files were read, so later runs only read new files",
+)
 @pass_context
-def roles_(ctx, days):
+def roles_(ctx, days, cloudtrail, cloudtrail_state):
+    if ctx.obj["since_last"]:
+        report_since_last(
+            ctx,
+            "roles",
+            days=days,
+            cloudtrail=cloudtrail,
+            cloudtrail_state=cloudtrail_state,
+        )
     session = ctx.obj["session"]
-    unused_roles = get_unused_iam_roles(session, days)
+    last_used = None
+    if cloudtrail:
+        last_used = get_principals_last_used(session, cloudtrail, cloudtrail_state)
+    unused_roles = get_unused_iam_roles(session, days, last_used)
+    record_findings("roles", len(unused_roles), 0)
 
     if len(unused_roles) == 0:
         print("No unused IAM roles found!")
@@ -95,16 +587,38 @@ def roles_(ctx, days):
 
 
 @check.command("ebs")
+@option(
+    "--idle-days",
+    type=int,
+    help="Also find attached volumes with no read or write operations for this many days",
+)
 @pass_context
-def ebs_(ctx):
+def ebs_(ctx, idle_days):
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "ebs", idle_days=idle_days)
     session = ctx.obj["session"]
     region = ctx.obj["region"]
     profile = ctx.obj["profile"]
-    unused_ebs_volumes = scan_for_unused_ebs_volumes(session)
+    unused_ebs_volumes = scan_for_unused_ebs_volumes(
+        session, idle_days, get_tag_filter(ctx)
+    )
+    apply_cur_costs_to_volumes(
+        unused_ebs_volumes,
+        get_actual_costs(
+            ctx, [volume["VolumeId"] for volume in unused_ebs_volumes["volumes"]]
+        ),
+    )
     total_monthly_cost = unused_ebs_volumes["total_monthly_cost"]
-    del unused_ebs_volumes["total_monthly_cost"]
+    record_findings("ebs", len(unused_ebs_volumes["volumes"]), total_monthly_cost)
+
+    idle_volumes = unused_ebs_volumes["idle_volumes"]
+    if idle_volumes:
+        print(
+            f"There are {len(idle_volumes)} attached EBS volumes without i/o for {idle_days} {'day' if idle_days == 1 else 'days'}, costing ${unused_ebs_volumes['idle_monthly_cost']:.2f} per month. Detach them before they can be deleted:"
+        )
+        print(json.dumps(idle_volumes, indent=4))
 
-    if len(unused_ebs_volumes) == 0:
+    if len(unused_ebs_volumes["volumes"]) == 0:
         print("No unused EBS volumes found!")
         return
 
@@ -118,35 +632,88 @@ def ebs_(ctx):
 
 @check.command("ebssnap")
 @option("--older-than", type=int, help="Find snapshots older than this many days")
+@option(
+    "--accurate",
+    is_flag=True,
+    help="Price the blocks only each snapshot stores, from the EBS direct APIs",
+)
 @pass_context
-def ebs_snapshots_(ctx, older_than):
+def ebs_snapshots_(ctx, older_than, accurate):
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "ebssnap", older_than=older_than, accurate=accurate)
     session = ctx.obj["session"]
     region = ctx.obj["region"]
     profile = ctx.obj["profile"]
-    old_snapshots = get_old_snapshots(session, older_than)
+    graph = build_resource_graph(session, ["snapshots"])
+    old_snapshots = get_old_snapshots(session, older_than, get_tag_filter(ctx), graph)
 
     if len(old_snapshots) == 0:
         print("No old EBS snapshots found!")
+        record_findings("ebssnap", 0, 0)
         exit(0)
 
+    elif accurate:
+        snapshot_costs = estimate_snapshots_unique_cost(session, old_snapshots, graph)
+        total_monthly_cost = sum(
+            [
+                snapshot_costs[snapshot_id]["monthly_cost"]
+                for snapshot_id in snapshot_costs
+            ]
+        )
+        record_findings("ebssnap", len(old_snapshots), total_monthly_cost)
+
     else:
-        total_monthly_cost = estimate_snapshots_cost(session, old_snapshots)
+        total_monthly_cost = estimate_snapshots_cost(session, old_snapshots, graph)
+        record_findings("ebssnap", len(old_snapshots), total_monthly_cost)
 
     print(
         f"There are {len(old_snapshots)} EBS snapshots older than {older_than} {'day' if older_than == 1 else 'days'}:"
     )
-    print(json.dumps(old_snapshots, indent=4))
+    print(json.dumps(snapshot_costs if accurate else old_snapshots, indent=4))
     print(
-        f"Run:\n\nacm clean ebsnap --region {region} --profile {profile} --older-than {older_than}\n\nto delete these resources and save ${total_monthly_cost:.2f} per month"
+        f"Run:\n\nacm clean ebssnap --region {region} --profile {profile} --older-than {older_than}\n\nto delete these resources and save ${total_monthly_cost:.2f} per month"
     )
     exit(0)
 
 
+@check.command("orphansnap")
+@pass_context
+def orphaned_snapshots_(ctx):
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "orphansnap")
+    session = ctx.obj["session"]
+    orphaned_snapshots = get_orphaned_snapshots(session, get_tag_filter(ctx))
+    total_monthly_cost = orphaned_snapshots["total_monthly_cost"]
+    del orphaned_snapshots["total_monthly_cost"]
+    record_findings(
+        "orphansnap",
+        sum([len(group["snapshots"]) for group in orphaned_snapshots.values()]),
+        total_monthly_cost,
+    )
+
+    if len(orphaned_snapshots) == 0:
+        print("No EBS snapshots of deleted volumes found!")
+        exit(0)
+
+    num_snapshots = sum(
+        [len(group["snapshots"]) for group in orphaned_snapshots.values()]
+    )
+    print(
+        f"There are {num_snapshots} EBS snapshots of {len(orphaned_snapshots)} deleted volumes:"
+    )
+    print(json.dumps(orphaned_snapshots, indent=4))
+    print(f"Deleting these snapshots would save ${total_monthly_cost:.2f} per month")
+    exit(0)
+
+
 @check.command("tgs")
 @pass_context
 def tgs_(ctx):
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "tgs")
     session = ctx.obj["session"]
-    target_groups = scan_for_tgs_no_targets_or_lb(session)
+    target_groups = scan_for_tgs_no_targets_or_lb(session, get_tag_filter(ctx))
+    record_findings("tgs", len(target_groups), 0)
 
     if len(target_groups) == 0:
         print("No target groups without targets or load balancers found!")
@@ -159,24 +726,39 @@ def tgs_(ctx):
 
 
 @check.command("lbs")
+@option(
+    "--idle-days",
+    type=int,
+    help="Also find load balancers with no traffic for this many days",
+)
 @pass_context
-def lbs_(ctx):
+def lbs_(ctx, idle_days):
     # Perform analysis of ELBv2 resources in the specified region and profile
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "lbs", idle_days=idle_days)
     session = ctx.obj["session"]
     region = ctx.obj["region"]
     profile = ctx.obj["profile"]
-    load_balancers = scan_for_lbs_no_targets(session, region, region)
+    load_balancers = scan_for_lbs_no_targets(
+        session, region, idle_days=idle_days, tag_filter=get_tag_filter(ctx)
+    )
+    apply_cur_costs_to_lbs(
+        load_balancers,
+        get_actual_costs(
+            ctx, [lb_arn for lb_arn in load_balancers if lb_arn != "total_monthly_cost"]
+        ),
+    )
 
     total_monthly_cost = load_balancers["total_monthly_cost"]
     del load_balancers["total_monthly_cost"]
     num_lbs_no_targets = len(load_balancers)
+    record_findings("lbs", num_lbs_no_targets, total_monthly_cost)
 
     if num_lbs_no_targets == 0:
         print("No load balancers without targets found!")
         return
 
-    print(f"There are {len(load_balancers)} load balancers with empty target groups:")
-    print(json.dumps(load_balancers, indent=4))
+    print_lbs(load_balancers, idle_days, "would be")
     print(
         f"Run:\n\nacm clean elbv2 --region {region} --profile {profile}\n\nto delete these resources and save ${total_monthly_cost:.2f} per month"
     )
@@ -184,6 +766,72 @@ def lbs_(ctx):
     exit(0)
 
 
+@check.command("clb")
+@option(
+    "--regions",
+    multiple=True,
+    help="Region to scan, defaults to the session's region (repeatable)",
+)
+@option("--all-regions", is_flag=True, help="Scan every region enabled for the account")
+@pass_context
+def clbs_(ctx, regions, all_regions):
+    session = ctx.obj["session"]
+    profile = ctx.obj["profile"]
+    regions = get_regions(ctx, regions, all_regions)
+    if ctx.obj["since_last"]:
+        report_since_last(ctx, "clb", regions=regions)
+    load_balancers = scan_for_clbs_no_instances(
+        session, regions, tag_filter=get_tag_filter(ctx)
+    )
+    apply_cur_costs_to_lbs(
+        load_balancers,
+        get_actual_costs(
+            ctx, [lb_arn for lb_arn in load_balancers if lb_arn != "total_monthly_cost"]
+        ),
+    )
+
+    total_monthly_cost = load_balancers["total_monthly_cost"]
+    del load_balancers["total_monthly_cost"]
+    record_findings("clb", len(load_balancers), total_monthly_cost)
+
+    if len(load_balancers) == 0:
+        print("No classic load balancers without healthy instances found!")
+        return
+
+    print(
+        f"There are {len(load_balancers)} classic load balancers without healthy instances:"
+    )
+    print(json.dumps(load_balancers, indent=4))
+    print(
+        f"Run:\n\nacm --profile {profile} clean clb {' '.join(f'--regions {region}' for region in regions)}\n\nto delete these resources and save ${total_monthly_cost:.2f} per month"
+    )
+
+    exit(0)
+
+
+@cli.command("serve")
+@option("--host", default="127.0.0.1", show_default=True, help="Address to listen on")
+@option("--port", type=int, default=8080, show_default=True, help="Port to listen on")
+@option(
+    "--ttl",
+    multiple=True,
+    help=f"Seconds to serve a check's results from memory as CHECK=SECONDS (repeatable), defaults: {', '.join(f'{check}={ttl}' for check, ttl in DEFAULT_TTLS.items())}",
+)
+@pass_context
+def serve(ctx, host, port, ttl):
+    ttls = {}
+    for value in ttl:
+        check_name, _, seconds = value.partition("=")
+        if check_name not in DEFAULT_TTLS or not seconds.isdigit():
+            print(f"Invalid --ttl {value}, expected CHECK=SECONDS")
+            exit(1)
+        ttls[check_name] = int(seconds)
+
+    ScanServer(
+        ctx.obj["session"], ttls, ctx.obj["include_tags"], ctx.obj["exclude_tags"]
+    ).serve(host, port)
+
+
 # CLEAN COMMANDS
 
 
@@ -194,9 +842,80 @@ def lbs_(ctx):
     default=365,
     help="Delete empty buckets and buckets with no objects newer than this number of days",
 )
+@option(
+    "--lifecycle-threshold",
+    type=int,
+    help="Expire buckets with more than this many objects with a lifecycle rule instead of deleting their objects",
+)
+@option(
+    "--workers",
+    type=int,
+    default=16,
+    help="Number of concurrent listing and deletion workers per bucket",
+)
 @pass_context
-def s3(ctx, days):
-    raise NotImplementedError("This feature is not yet implemented")
+def s3(ctx, days, lifecycle_threshold, workers):
+    session = ctx.obj["session"]
+    dry_run = ctx.obj["dry_run"]
+
+    if ctx.obj["mark"] or ctx.obj["sweep"]:
+        mark_or_sweep(
+            ctx, "s3", {"lifecycle_threshold": lifecycle_threshold}, days=days
+        )
+    stats = {}
+    buckets = get_buckets(session, days, stats, get_tag_filter(ctx))
+    bucket_names = buckets["old"] + buckets["empty"]
+    num_buckets = len(bucket_names)
+
+    if num_buckets == 0:
+        print("No empty or old buckets found!")
+        return
+
+    print(
+        f"There are {len(buckets['empty'])} empty buckets and {len(buckets['old'])} buckets with no objects newer than {days} {'day' if days == 1 else 'days'}:"
+    )
+    print(json.dumps(buckets, indent=4))
+
+    # Ask the user for confirmation
+    response = input(
+        f"Are you sure you want to continue? This will delete {num_buckets} buckets and all of their objects and object versions. (yes/no): "
+    )
+
+    # Check the user's response
+    if response == "yes":
+        # Execute the code if the response was "yes"
+        if dry_run:
+            print("Dry run mode enabled, no resources will be deleted.")
+
+        summary = delete_buckets(
+            session, bucket_names, dry_run, lifecycle_threshold, workers
+        )
+        saved_monthly_cost = sum(
+            [
+                get_bucket_stats_cost(stats[bucket_name])
+                for bucket_name in summary["deleted_buckets"]
+            ]
+        )
+        record_realized_savings(ctx, "s3", saved_monthly_cost)
+
+        print(
+            f"Deleted {len(summary['deleted_buckets'])} buckets saving ${saved_monthly_cost:.2f} per month."
+        )
+        if summary["failed_buckets"]:
+            print(f"Failed to delete {len(summary['failed_buckets'])} buckets:")
+            print(json.dumps(summary["errors"], indent=4))
+        expiring_buckets = summary["expiring_buckets"]
+        if expiring_buckets:
+            print(
+                f"Set an expiring lifecycle rule on {len(expiring_buckets)} buckets, run this command again once they are empty to delete them:"
+            )
+            print(json.dumps(expiring_buckets, indent=4))
+
+    else:
+        # Exit the program if the response was "no" or anything else
+        print("Aborted")
+
+    exit(0)
 
 
 @clean.command("tgs")
@@ -204,7 +923,21 @@ def s3(ctx, days):
 def tgs(ctx):
     session = ctx.obj["session"]
     dry_run = ctx.obj["dry_run"]
-    target_groups = scan_for_tgs_no_targets_or_lb(session)
+
+    if ctx.obj["mark"] or ctx.obj["sweep"]:
+        mark_or_sweep(ctx, "tgs")
+
+    if ctx.obj["resume"]:
+        resume_cleanup(
+            ctx,
+            "tgs",
+            "tg",
+            lambda tgs, journal: delete_tgs(session, list(tgs), dry_run, journal),
+        )
+
+    # the graph also tells which target groups are still in use when deleting
+    graph = build_resource_graph(session, ["load_balancers", "target_groups"])
+    target_groups = scan_for_tgs_no_targets_or_lb(session, get_tag_filter(ctx), graph)
 
     num_tgs = len(target_groups)
 
@@ -228,12 +961,18 @@ def tgs(ctx):
         if dry_run:
             print("Dry run mode enabled, no resources will be deleted.")
 
-        delete_tgs(session, target_groups, dry_run)
+        summary = delete_tgs(
+            session, target_groups, dry_run, open_journal(ctx, "tgs"), graph
+        )
+        # target groups cost nothing by themselves
+        record_realized_savings(ctx, "tgs", 0)
 
-        print(f"Deleted {num_tgs} target groups.")
-        # print(
-        #     f"Deleted {num_tgs} load balancers and their associated target groups saving ${total_monthly_cost:.2f} per month."
-        # )
+        print(f"Deleted {len(summary['deleted_target_groups'])} target groups.")
+        if summary["failed_target_groups"]:
+            print(
+                f"Failed to delete {len(summary['failed_target_groups'])} target groups:"
+            )
+            print(json.dumps(summary["errors"], indent=4))
 
     else:
         # Exit the program if the response was "no" or anything else
@@ -243,14 +982,32 @@ def tgs(ctx):
 
 
 @clean.command("lbs")
+@option(
+    "--idle-days",
+    type=int,
+    help="Also find load balancers with no traffic for this many days",
+)
 @pass_context
-def lbs(ctx):
+def lbs(ctx, idle_days):
     # Perform analysis of ELBv2 resources in the specified region and profile
     session = ctx.obj["session"]
     region = ctx.obj["region"]
     dry_run = ctx.obj["dry_run"]
-    load_balancers = scan_for_lbs_no_targets(session, region)
-    total_monthly_cost = load_balancers["total_monthly_cost"]
+
+    if ctx.obj["mark"] or ctx.obj["sweep"]:
+        mark_or_sweep(ctx, "lbs", idle_days=idle_days)
+
+    if ctx.obj["resume"]:
+        resume_cleanup(
+            ctx,
+            "lbs",
+            "lb",
+            lambda lbs, journal: delete_lbs(session, lbs, dry_run, journal),
+        )
+
+    load_balancers = scan_for_lbs_no_targets(
+        session, region, idle_days=idle_days, tag_filter=get_tag_filter(ctx)
+    )
     del load_balancers["total_monthly_cost"]
     num_lbs = len(load_balancers)
 
@@ -258,12 +1015,16 @@ def lbs(ctx):
         print("No load balancers without targets found!")
         return
 
-    print(f"There are {num_lbs} load balancers with empty target groups:")
-    print(json.dumps(load_balancers, indent=4))
+    idle = print_lbs(load_balancers, idle_days, "will be")
+    idle_warning = (
+        f" The {len(idle)} load balancers without traffic are deleted with all their target groups, including populated ones."
+        if idle
+        else ""
+    )
 
     # Ask the user for confirmation
     response = input(
-        f"Are you sure you want to continue? This will delete {num_lbs} load balancers and their associated target groups. If there are both populated and empty target groups associated with a load balancer, it will detach and delete only the empty target groups, leaving the load balancer and populated target groups in place. (yes/no): "
+        f"Are you sure you want to continue? This will delete {num_lbs} load balancers and their associated target groups. If there are both populated and empty target groups associated with a load balancer that has traffic, it will detach and delete only the empty target groups, leaving the load balancer and populated target groups in place.{idle_warning} (yes/no): "
     )
 
     # Check the user's response
@@ -272,10 +1033,18 @@ def lbs(ctx):
         if dry_run:
             print("Dry run mode enabled, no resources will be deleted.")
 
-        delete_lbs(session, load_balancers, dry_run)
+        summary = delete_lbs(session, load_balancers, dry_run, open_journal(ctx, "lbs"))
+        saved_monthly_cost = sum(
+            [
+                load_balancers[lb_arn]["monthly_cost"]
+                for lb_arn in summary["deleted_load_balancers"]
+            ]
+        )
+
+        record_realized_savings(ctx, "lbs", saved_monthly_cost)
 
         print(
-            f"Deleted {num_lbs} load balancers and their associated target groups saving ${total_monthly_cost:.2f} per month."
+            f"Deleted {len(summary['deleted_load_balancers'])} load balancers and {len(summary['deleted_target_groups'])} target groups saving ${saved_monthly_cost:.2f} per month."
         )
 
     else:
@@ -290,11 +1059,25 @@ def lbs(ctx):
 def ebs(ctx):
     session = ctx.obj["session"]
     dry_run = ctx.obj["dry_run"]
-    unused_ebs_volumes = scan_for_unused_ebs_volumes(session)
-    total_monthly_cost = unused_ebs_volumes["total_monthly_cost"]
-    del unused_ebs_volumes["total_monthly_cost"]
 
-    if len(unused_ebs_volumes) == 0:
+    if ctx.obj["mark"] or ctx.obj["sweep"]:
+        mark_or_sweep(ctx, "ebs")
+
+    if ctx.obj["resume"]:
+        resume_cleanup(
+            ctx,
+            "ebs",
+            "volume",
+            lambda volume_ids, journal: delete_ebs_volumes(
+                list(volume_ids), session, dry_run, journal
+            ),
+        )
+
+    unused_ebs_volumes = scan_for_unused_ebs_volumes(
+        session, tag_filter=get_tag_filter(ctx)
+    )
+
+    if len(unused_ebs_volumes["volumes"]) == 0:
         print("No unused EBS volumes found!")
         return
 
@@ -310,12 +1093,162 @@ def ebs(ctx):
         if dry_run:
             print("Dry run mode enabled, no resources will be deleted.")
 
-        delete_ebs_volumes(
-            [vol["VolumeId"] for vol in unused_ebs_volumes["volumes"]], session, dry_run
+        summary = delete_ebs_volumes(
+            [vol["VolumeId"] for vol in unused_ebs_volumes["volumes"]],
+            session,
+            dry_run,
+            open_journal(ctx, "ebs"),
         )
+        saved_monthly_cost = sum(
+            [
+                volume["MonthlyCost"]
+                for volume in unused_ebs_volumes["volumes"]
+                if volume["VolumeId"] in summary["deleted_volumes"]
+            ]
+        )
+        record_realized_savings(ctx, "ebs", saved_monthly_cost)
         print(
-            f"Deleted {len(unused_ebs_volumes['volumes'])} EBS volumes saving ${total_monthly_cost:.2f} per month."
+            f"Deleted {len(summary['deleted_volumes'])} EBS volumes saving ${saved_monthly_cost:.2f} per month."
+        )
+        if summary["failed_volumes"]:
+            print(f"Failed to delete {len(summary['failed_volumes'])} EBS volumes:")
+            print(json.dumps(summary["errors"], indent=4))
+    else:
+        # Exit the program if the response was "no" or anything else
+        print("Aborted")
+
+    exit(0)
+
+
+@clean.command("ebssnap")
+@option("--older-than", type=int, help="Delete snapshots older than this many days")
+@pass_context
+def ebs_snapshots(ctx, older_than):
+    session = ctx.obj["session"]
+    dry_run = ctx.obj["dry_run"]
+
+    if ctx.obj["mark"] or ctx.obj["sweep"]:
+        mark_or_sweep(ctx, "ebssnap", older_than=older_than)
+
+    if ctx.obj["resume"]:
+        resume_cleanup(
+            ctx,
+            "ebssnap",
+            "snapshot",
+            lambda snapshot_ids, journal: delete_ebs_snapshots(
+                list(snapshot_ids), session, dry_run, journal
+            ),
         )
+
+    # the graph also tells which snapshots still back an image when deleting
+    graph = build_resource_graph(session, ["snapshots", "images"])
+    old_snapshots = get_old_snapshots(session, older_than, get_tag_filter(ctx), graph)
+
+    if len(old_snapshots) == 0:
+        print("No old EBS snapshots found!")
+        exit(0)
+
+    print(
+        f"There are {len(old_snapshots)} EBS snapshots older than {older_than} {'day' if older_than == 1 else 'days'}:"
+    )
+    print(json.dumps(old_snapshots, indent=4))
+
+    # Ask the user for confirmation
+    response = input(
+        f"Are you sure you want to continue? This will delete {len(old_snapshots)} EBS snapshots. (yes/no): "
+    )
+    if response == "yes":
+        # Execute the code if the response was "yes"
+        if dry_run:
+            print("Dry run mode enabled, no resources will be deleted.")
+
+        summary = delete_ebs_snapshots(
+            old_snapshots, session, dry_run, open_journal(ctx, "ebssnap"), graph
+        )
+        saved_monthly_cost = sum(
+            [
+                graph.data(snapshot_id)["VolumeSize"] * SNAPSHOT_PRICE_PER_GB_MONTH
+                for snapshot_id in summary["deleted_snapshots"]
+            ]
+        )
+        record_realized_savings(ctx, "ebssnap", saved_monthly_cost)
+        print(
+            f"Deleted {len(summary['deleted_snapshots'])} EBS snapshots saving ${saved_monthly_cost:.2f} per month."
+        )
+        if summary["failed_snapshots"]:
+            print(f"Failed to delete {len(summary['failed_snapshots'])} EBS snapshots:")
+            print(json.dumps(summary["errors"], indent=4))
+    else:
+        # Exit the program if the response was "no" or anything else
+        print("Aborted")
+
+    exit(0)
+
+
+@clean.command("clb")
+@option(
+    "--regions",
+    multiple=True,
+    help="Region to clean, defaults to the session's region (repeatable)",
+)
+@option(
+    "--all-regions", is_flag=True, help="Clean every region enabled for the account"
+)
+@pass_context
+def clbs(ctx, regions, all_regions):
+    session = ctx.obj["session"]
+    dry_run = ctx.obj["dry_run"]
+
+    if ctx.obj["mark"] or ctx.obj["sweep"]:
+        mark_or_sweep(ctx, "clb", regions=get_regions(ctx, regions, all_regions))
+
+    if ctx.obj["resume"]:
+        resume_cleanup(
+            ctx,
+            "clb",
+            "clb",
+            lambda lbs, journal: delete_clbs(session, lbs, dry_run, journal),
+        )
+
+    load_balancers = scan_for_clbs_no_instances(
+        session, get_regions(ctx, regions, all_regions), tag_filter=get_tag_filter(ctx)
+    )
+    del load_balancers["total_monthly_cost"]
+    num_lbs = len(load_balancers)
+
+    if num_lbs == 0:
+        print("No classic load balancers without healthy instances found!")
+        return
+
+    print(f"There are {num_lbs} classic load balancers without healthy instances:")
+    print(json.dumps(load_balancers, indent=4))
+
+    # Ask the user for confirmation
+    response = input(
+        f"Are you sure you want to continue? This will delete {num_lbs} classic load balancers. (yes/no): "
+    )
+
+    # Check the user's response
+    if response == "yes":
+        # Execute the code if the response was "yes"
+        if dry_run:
+            print("Dry run mode enabled, no resources will be deleted.")
+
+        summary = delete_clbs(
+            session, load_balancers, dry_run, open_journal(ctx, "clb")
+        )
+        saved_monthly_cost = sum(
+            [
+                load_balancers[lb_arn]["monthly_cost"]
+                for lb_arn in summary["deleted_load_balancers"]
+            ]
+        )
+        record_realized_savings(ctx, "clb", saved_monthly_cost)
+
+        print(
+            f"Deleted {len(summary['deleted_load_balancers'])} classic load balancers saving ${saved_monthly_cost:.2f} per month."
+        )
+
     else:
         # Exit the program if the response was "no" or anything else
         print("Aborted")
@@ -0,0 +1,415 @@
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, Optional
+from .cloudtrail import get_principals_last_used, CLOUDTRAIL_STATE_PATH
+from .ebs import estimate_snapshots_unique_cost
+from .ec2 import (
+    get_lb_hourly_costs,
+    scan_for_lbs_no_targets,
+    scan_for_tgs_no_targets_or_lb,
+    scan_for_unused_ebs_volumes,
+    get_old_snapshots,
+    get_orphaned_snapshots,
+    delete_lbs,
+    delete_tgs,
+    delete_ebs_volumes,
+    delete_ebs_snapshots,
+    SNAPSHOT_PRICE_PER_GB_MONTH,
+)
+from .elb import scan_for_clbs_no_instances, delete_clbs
+from .graph import build_resource_graph
+from .iam import get_unused_iam_roles
+from .journal import Journal
+from .progress import ProgressEvent, reporting
+from .s3 import get_buckets, get_bucket_stats_cost, delete_buckets
+from .session import WarmSession
+
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+@dataclass(frozen=True)
+class ConcurrencyConfig:
+    # Worker threads of every concurrent step, and connections of the clients they
+    # share
+    max_workers: int = 8
+
+
+@dataclass(frozen=True)
+class Finding:
+    # One resource a check flagged, details holds what the check found out about it
+    # and what its cleanup needs
+    check: str
+    resource_id: str
+    region: Optional[str] = None
+    monthly_cost: float = 0
+    details: dict = field(default_factory=dict, compare=False, hash=False)
+
+
+@dataclass
+class CleanupResult:
+    # Resources are deleted unless they failed or were skipped, e.g. because they
+    # are still in use or were left to a lifecycle rule. deleted holds what would
+    # have been deleted in a dry run.
+    check: str
+    deleted: list = field(default_factory=list)
+    failed: list = field(default_factory=list)
+    skipped: list = field(default_factory=list)
+
+
+def get_session(session):
+    # clients are created once and shared by every check and cleanup of the session
+    if isinstance(session, WarmSession):
+        return session
+    return WarmSession(session)
+
+
+class Scanner:
+    # The checks of the CLI as an API: findings are returned instead of printed and
+    # progress goes to on_progress, or nowhere without it. Every check method
+    # returns an iterator of Findings, scan runs a check by its CLI name.
+
+    def __init__(
+        self,
+        session,
+        concurrency: Optional[ConcurrencyConfig] = None,
+        tag_filter: Optional[Callable[[str], bool]] = None,
+        on_progress: Optional[ProgressCallback] = None,
+    ):
+        self.concurrency = concurrency or ConcurrencyConfig()
+        self.session = get_session(session)
+        self.tag_filter = tag_filter
+        self.on_progress = on_progress
+        self.hourly_costs = None
+
+    @property
+    def region(self):
+        return self.session.region_name
+
+    def scan(self, check: str, **options) -> Iterator[Finding]:
+        if check not in CHECKS:
+            raise ValueError(f"Unknown check {check}")
+        return getattr(self, check)(**options)
+
+    def run(self, scan):
+        # the scan runs on the first next(), progress is reported as it runs
+        with reporting(self.on_progress):
+            findings = list(scan())
+        yield from findings
+
+    def get_hourly_costs(self):
+        # pricing is fetched once per scanner
+        if self.hourly_costs is None:
+            self.hourly_costs = get_lb_hourly_costs(self.session)
+        return self.hourly_costs
+
+    def get_graph(self, crawls):
+        return build_resource_graph(
+            self.session, crawls, max_workers=self.concurrency.max_workers
+        )
+
+    def lbs(self, idle_days=None, omit_pricing=False) -> Iterator[Finding]:
+        def scan():
+            lbs = scan_for_lbs_no_targets(
+                self.session,
+                self.region,
+                omit_pricing,
+                idle_days,
+                None if omit_pricing else self.get_hourly_costs(),
+                self.tag_filter,
+                self.get_graph(["load_balancers", "target_groups"]),
+            )
+            for lb_arn, lb in lbs.items():
+                if lb_arn != "total_monthly_cost":
+                    yield Finding("lbs", lb_arn, self.region, lb["monthly_cost"], lb)
+
+        return self.run(scan)
+
+    def tgs(self) -> Iterator[Finding]:
+        def scan():
+            tgs = scan_for_tgs_no_targets_or_lb(
+                self.session, self.tag_filter, self.get_graph(["target_groups"])
+            )
+            for tg_arn in dict.fromkeys(tgs):
+                yield Finding("tgs", tg_arn, self.region)
+
+        return self.run(scan)
+
+    def ebs(self, idle_days=None) -> Iterator[Finding]:
+        # attached idle volumes cannot be deleted, so they are not findings
+        def scan():
+            volumes = scan_for_unused_ebs_volumes(
+                self.session, idle_days, self.tag_filter, self.get_graph(["volumes"])
+            )
+            for volume in volumes["volumes"]:
+                yield Finding(
+                    "ebs",
+                    volume["VolumeId"],
+                    self.region,
+                    volume["MonthlyCost"],
+                    volume,
+                )
+
+        return self.run(scan)
+
+    def ebssnap(self, older_than, accurate=False) -> Iterator[Finding]:
+        # accurate prices the blocks only each snapshot stores, see the ebs module
+        def scan():
+            graph = self.get_graph(["snapshots"])
+            snapshot_ids = get_old_snapshots(
+                self.session, older_than, self.tag_filter, graph
+            )
+            if accurate and snapshot_ids:
+                costs = estimate_snapshots_unique_cost(
+                    self.session, snapshot_ids, graph
+                )
+            else:
+                costs = {
+                    snapshot_id: {
+                        "monthly_cost": graph.data(snapshot_id)["VolumeSize"]
+                        * SNAPSHOT_PRICE_PER_GB_MONTH
+                    }
+                    for snapshot_id in snapshot_ids
+                }
+
+            for snapshot_id in snapshot_ids:
+                yield Finding(
+                    "ebssnap",
+                    snapshot_id,
+                    self.region,
+                    costs[snapshot_id]["monthly_cost"],
+                    {**graph.data(snapshot_id), **costs[snapshot_id]},
+                )
+
+        return self.run(scan)
+
+    def orphansnap(self) -> Iterator[Finding]:
+        # one finding per deleted volume with all of its snapshots, or per copied
+        # snapshot
+        def scan():
+            orphaned_snapshots = get_orphaned_snapshots(
+                self.session,
+                self.tag_filter,
+                self.get_graph(["volumes", "snapshots"]),
+            )
+            for volume_id, group in orphaned_snapshots.items():
+                if volume_id != "total_monthly_cost":
+                    yield Finding(
+                        "orphansnap",
+                        volume_id,
+                        self.region,
+                        group["monthly_cost"],
+                        group,
+                    )
+
+        return self.run(scan)
+
+    def s3(self, days, stats=None) -> Iterator[Finding]:
+        # stats may hold bucket stats read from an inventory, see get_buckets
+        def scan():
+            bucket_stats = {} if stats is None else stats
+            buckets = get_buckets(self.session, days, bucket_stats, self.tag_filter)
+            for reason in ["old", "empty"]:
+                for bucket_name in buckets[reason]:
+                    yield Finding(
+                        "s3",
+                        bucket_name,
+                        monthly_cost=get_bucket_stats_cost(bucket_stats[bucket_name]),
+                        details={"reason": reason, **bucket_stats[bucket_name]},
+                    )
+
+        return self.run(scan)
+
+    def roles(
+        self, days, cloudtrail=(), cloudtrail_state=CLOUDTRAIL_STATE_PATH
+    ) -> Iterator[Finding]:
+        def scan():
+            last_used = None
+            if cloudtrail:
+                last_used = get_principals_last_used(
+                    self.session, cloudtrail, cloudtrail_state
+                )
+            for role_name in get_unused_iam_roles(self.session, days, last_used):
+                yield Finding("roles", role_name)
+
+        return self.run(scan)
+
+    def clb(self, regions=None) -> Iterator[Finding]:
+        def scan():
+            lbs = scan_for_clbs_no_instances(
+                self.session,
+                regions,
+                hourly_costs=self.get_hourly_costs(),
+                tag_filter=self.tag_filter,
+                max_workers=self.concurrency.max_workers,
+            )
+            for lb_arn, lb in lbs.items():
+                if lb_arn != "total_monthly_cost":
+                    yield Finding("clb", lb_arn, lb["region"], lb["monthly_cost"], lb)
+
+        return self.run(scan)
+
+
+CHECKS = ("lbs", "tgs", "ebs", "ebssnap", "orphansnap", "s3", "roles", "clb")
+
+
+class Cleaner:
+    # Deletes the resources of Scanner findings with the deleters of the CLI, without
+    # asking for confirmation. The journal, when given, is opened by the caller.
+
+    def __init__(
+        self,
+        session,
+        concurrency: Optional[ConcurrencyConfig] = None,
+        dry_run=False,
+        journal: Optional[Journal] = None,
+        on_progress: Optional[ProgressCallback] = None,
+    ):
+        self.concurrency = concurrency or ConcurrencyConfig()
+        self.session = get_session(session)
+        self.dry_run = dry_run
+        self.journal = journal
+        self.on_progress = on_progress
+
+    def clean(self, findings: Iterable[Finding], **options) -> list:
+        # one CleanupResult per check of the findings, in the order they came in
+        checks = {}
+        for finding in findings:
+            checks.setdefault(finding.check, []).append(finding)
+
+        cleaners = {
+            "lbs": self.clean_lbs,
+            "tgs": self.clean_tgs,
+            "ebs": self.clean_ebs,
+            "ebssnap": self.clean_snapshots,
+            "orphansnap": self.clean_snapshots,
+            "s3": self.clean_s3,
+            "clb": self.clean_clbs,
+        }
+        for check in checks:
+            if check not in cleaners:
+                raise ValueError(f"{check} findings cannot be cleaned up")
+
+        results = []
+        with reporting(self.on_progress):
+            for check, check_findings in checks.items():
+                results.append(cleaners[check](check_findings, **options))
+
+        return results
+
+    def clean_lbs(self, findings, **options):
+        summary = delete_lbs(
+            self.session,
+            {finding.resource_id: finding.details for finding in findings},
+            self.dry_run,
+            self.journal,
+            self.concurrency.max_workers,
+        )
+        return CleanupResult(
+            "lbs",
+            summary["deleted_load_balancers"] + summary["deleted_target_groups"],
+            summary["failed_load_balancers"] + summary["failed_target_groups"],
+            summary["kept_load_balancers"] + summary["skipped_target_groups"],
+        )
+
+    def clean_tgs(self, findings, **options):
+        # target groups still in use are skipped by delete_tgs
+        graph = build_resource_graph(
+            self.session,
+            ["load_balancers", "target_groups"],
+            max_workers=self.concurrency.max_workers,
+        )
+        summary = delete_tgs(
+            self.session,
+            [finding.resource_id for finding in findings],
+            self.dry_run,
+            self.journal,
+            graph,
+        )
+        return CleanupResult(
+            "tgs",
+            summary["deleted_target_groups"],
+            summary["failed_target_groups"],
+            summary["skipped_target_groups"],
+        )
+
+    def clean_ebs(self, findings, **options):
+        summary = delete_ebs_volumes(
+            [finding.resource_id for finding in findings],
+            self.session,
+            self.dry_run,
+            self.journal,
+        )
+        return CleanupResult(
+            "ebs", summary["deleted_volumes"], summary["failed_volumes"]
+        )
+
+    def clean_snapshots(self, findings, **options):
+        # orphansnap findings are deleted volumes, with their snapshots in details
+        check = findings[0].check
+        snapshot_ids = [
+            snapshot_id
+            for finding in findings
+            for snapshot_id in (
+                finding.details["snapshots"]
+                if finding.check == "orphansnap"
+                else [finding.resource_id]
+            )
+        ]
+        graph = build_resource_graph(
+            self.session,
+            ["snapshots", "images"],
+            max_workers=self.concurrency.max_workers,
+        )
+        summary = delete_ebs_snapshots(
+            snapshot_ids, self.session, self.dry_run, self.journal, graph
+        )
+        if check != "orphansnap":
+            return CleanupResult(
+                check,
+                summary["deleted_snapshots"],
+                summary["failed_snapshots"],
+                summary["skipped_snapshots"],
+            )
+
+        # results are by volume like the findings, a volume is deleted once all of
+        # its snapshots are and failed if any of them failed
+        result = CleanupResult(check)
+        for finding in findings:
+            snapshots = set(finding.details["snapshots"])
+            if snapshots <= set(summary["deleted_snapshots"]):
+                result.deleted.append(finding.resource_id)
+            elif snapshots & set(summary["failed_snapshots"]):
+                result.failed.append(finding.resource_id)
+            else:
+                result.skipped.append(finding.resource_id)
+
+        return result
+
+    def clean_s3(self, findings, lifecycle_threshold=None, **options):
+        # buckets left to an expiring lifecycle rule are skipped
+        summary = delete_buckets(
+            self.session,
+            [finding.resource_id for finding in findings],
+            self.dry_run,
+            lifecycle_threshold,
+            self.concurrency.max_workers,
+        )
+        return CleanupResult(
+            "s3",
+            summary["deleted_buckets"],
+            summary["failed_buckets"],
+            summary["expiring_buckets"],
+        )
+
+    def clean_clbs(self, findings, **options):
+        summary = delete_clbs(
+            self.session,
+            {finding.resource_id: finding.details for finding in findings},
+            self.dry_run,
+            self.journal,
+            self.concurrency.max_workers,
+        )
+        return CleanupResult(
+            "clb",
+            summary["deleted_load_balancers"],
+            summary["failed_load_balancers"],
+        )
@@ -0,0 +1,201 @@
+import base64
+import copy
+import gzip
+import json
+import random
+import re
+from datetime import datetime
+from threading import Lock
+from time import perf_counter, sleep
+from botocore.awsrequest import AWSResponse
+
+CASSETTE_VERSION = 1
+
+ACCOUNT_ID = re.compile(r"(?<!\d)\d{12}(?!\d)")
+SANITIZED_ACCOUNT_ID = "000000000000"
+
+# Standard retry mode backs off up to 2^attempt * 1s between 3 attempts
+THROTTLE_MAX_ATTEMPTS = 3
+THROTTLE_BASE_DELAY = 1
+
+
+def sanitize(value):
+    # Account ids are replaced in keys and values alike, so ARNs taken from one
+    # recorded response still match the recorded calls made with them
+    if isinstance(value, str):
+        return ACCOUNT_ID.sub(SANITIZED_ACCOUNT_ID, value)
+    if isinstance(value, dict):
+        return {sanitize(key): sanitize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [sanitize(item) for item in value]
+    return value
+
+
+def sanitize_response(parsed):
+    parsed = sanitize(parsed)
+    if "ResponseMetadata" in parsed:
+        parsed["ResponseMetadata"] = {
+            "HTTPStatusCode": parsed["ResponseMetadata"].get("HTTPStatusCode")
+        }
+    return parsed
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode()}
+    raise TypeError(f"Cannot record {type(value).__name__} values")
+
+
+def decode(value):
+    if "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    if "$bytes" in value:
+        return base64.b64decode(value["$bytes"])
+    return value
+
+
+def get_call_key(model, params):
+    # Datetimes in requests are relative to when the run started, e.g. CloudWatch
+    # query windows, so they are left out of the key
+    def normalize(value):
+        if isinstance(value, datetime):
+            return "$datetime"
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(item) for item in value]
+        return value
+
+    return json.dumps(
+        [
+            model.service_model.service_name,
+            model.name,
+            sanitize(normalize(params)),
+        ],
+        sort_keys=True,
+        default=str,
+    )
+
+
+class Recorder:
+    # Records the sanitized parsed response of every AWS call, written to a gzipped
+    # JSON lines cassette when the run ends
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = []
+        self.lock = Lock()
+
+    def attach(self, session):
+        session.events.register("provide-client-params", self.provide_params)
+        session.events.register("before-call", self.before_call)
+        session.events.register("after-call", self.after_call)
+
+    def provide_params(self, params, context, **kwargs):
+        context["acm_cassette_params"] = params
+
+    def before_call(self, context, **kwargs):
+        context["acm_cassette_start"] = perf_counter()
+
+    def after_call(self, model, context, http_response, parsed, **kwargs):
+        # streamed bodies are read by the caller after the call returns. Calls
+        # served from memory are not recorded, a replay without the memo serves
+        # repeats the last recorded response with the duration AWS took for it.
+        if model.has_streaming_output or context.get("acm_memo_hit"):
+            return
+
+        call = {
+            "key": get_call_key(model, context.get("acm_cassette_params", {})),
+            "status": http_response.status_code,
+            "parsed": sanitize_response(parsed),
+            "duration": perf_counter() - context.get("acm_cassette_start", 0),
+        }
+        with self.lock:
+            self.calls.append(call)
+
+    def write(self):
+        with self.lock:
+            calls = list(self.calls)
+
+        with gzip.open(self.path, "wt") as f:
+            f.write(json.dumps({"version": CASSETTE_VERSION}) + "\n")
+            for call in calls:
+                f.write(json.dumps(call, default=encode) + "\n")
+
+
+class Player:
+    # Serves the responses of a cassette instead of calling AWS. Calls made more
+    # than once, like waiter polls, get the recorded responses in order and then the
+    # last one again. latency scales the recorded call durations, throttle_rate is
+    # the chance of an attempt being throttled and backed off from.
+
+    def __init__(self, path, latency=0, throttle_rate=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = {}
+        self.served = {}
+        self.lock = Lock()
+
+        with gzip.open(path, "rt") as f:
+            header = json.loads(next(f))
+            if header.get("version") != CASSETTE_VERSION:
+                raise ValueError(
+                    f"Unsupported cassette version {header.get('version')} in {path}"
+                )
+            for line in f:
+                call = json.loads(line, object_hook=decode)
+                self.calls.setdefault(call["key"], []).append(call)
+
+    def attach(self, session):
+        # registered last, so the metrics and trace hooks still see replayed calls
+        session.events.register("provide-client-params", self.provide_params)
+        session.events.register_last("before-call", self.before_call)
+
+    def provide_params(self, params, context, **kwargs):
+        context["acm_cassette_params"] = params
+
+    def next_call(self, key):
+        with self.lock:
+            calls = self.calls.get(key)
+            if not calls:
+                return None
+            index = self.served.get(key, 0)
+            self.served[key] = index + 1
+            return calls[min(index, len(calls) - 1)]
+
+    def throttle(self):
+        for attempt in range(THROTTLE_MAX_ATTEMPTS):
+            if random.random() >= self.throttle_rate:
+                return None
+            sleep(random.uniform(0, THROTTLE_BASE_DELAY * 2**attempt))
+
+        return (
+            AWSResponse(None, 400, {}, None),
+            {
+                "Error": {"Code": "Throttling", "Message": "Rate exceeded"},
+                "ResponseMetadata": {"HTTPStatusCode": 400},
+            },
+        )
+
+    def before_call(self, model, context, **kwargs):
+        key = get_call_key(model, context.get("acm_cassette_params", {}))
+        call = self.next_call(key)
+        if call is None:
+            raise RuntimeError(
+                f"No recorded response for {model.service_model.service_name}.{model.name} with these parameters: {key}"
+            )
+
+        if self.throttle_rate:
+            throttled = self.throttle()
+            if throttled:
+                return throttled
+
+        if self.latency:
+            sleep(call["duration"] * self.latency)
+
+        # callers may modify responses, e.g. the load balancer scan does
+        return AWSResponse(None, call["status"], {}, None), copy.deepcopy(
+            call["parsed"]
+        )
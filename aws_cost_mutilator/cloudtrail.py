@@ -0,0 +1,223 @@
+import gzip
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from .progress import progress_bar, report
+from .inventory import parse_s3_uri, init_worker, get_worker_s3
+from .metrics import timed
+
+CLOUDTRAIL_STATE_PATH = os.path.join(
+    os.path.expanduser("~"), ".acm", "cloudtrail-state.json"
+)
+
+# Sibling folders of CloudTrail/ in a trail bucket that hold no events
+SKIPPED_FOLDERS = {"CloudTrail-Digest", "CloudTrail-Insight"}
+
+# CloudTrail delivers files late and out of order, the files of this window before
+# the cursor of a folder are listed again on every run and skipped if already read
+DELIVERY_LAG = timedelta(hours=1)
+
+# YYYY/MM/DD/<account>_CloudTrail_<region>_<time>_... path of a file in its folder
+LOG_PATH = re.compile(r"^\d{4}/\d{2}/\d{2}/(.+_)(\d{8}T\d{4}Z)_")
+
+
+def split_log_path(path):
+    # Splits a log file path at its AWSLogs/.../CloudTrail/<region>/ folder. Within a
+    # region, paths after it (YYYY/MM/DD/<account>_CloudTrail_<region>_<time>_...)
+    # sort in delivery order, which is what the cursor of the folder relies on.
+    parts = path.replace(os.sep, "/").split("/")
+    if "CloudTrail" in parts:
+        index = len(parts) - 1 - parts[::-1].index("CloudTrail")
+        return "/".join(parts[: index + 2]), "/".join(parts[index + 2 :])
+
+    return "/".join(parts[:-1]), parts[-1]
+
+
+def get_lag_start(cursor, lag=DELIVERY_LAG):
+    # The path files delivered within the lag before the cursor sort after, or the
+    # cursor itself when its path does not tell the delivery time
+    match = LOG_PATH.match(cursor)
+    if match is None:
+        return cursor
+
+    start = datetime.strptime(match[2], "%Y%m%dT%H%MZ") - lag
+    return f"{start:%Y/%m/%d}/{match[1]}{start:%Y%m%dT%H%MZ}"
+
+
+def is_new_file(path, state):
+    folder, rest = split_log_path(path)
+    if folder not in state["cursors"]:
+        return True
+
+    read = state["read"].get(folder, ())
+    return rest > get_lag_start(state["cursors"][folder]) and rest not in read
+
+
+def get_region_prefixes(s3, bucket, prefix):
+    # Walks the folders of the bucket down to the CloudTrail/<region>/ level, so new
+    # files of every region can be listed from its cursor on
+    paginator = s3.get_paginator("list_objects_v2")
+    prefixes, region_prefixes = [prefix], []
+    while prefixes:
+        current = prefixes.pop()
+        parts = current.rstrip("/").split("/")
+        if "CloudTrail" in parts[:-1]:
+            region_prefixes.append(current)
+            continue
+
+        for page in paginator.paginate(Bucket=bucket, Prefix=current, Delimiter="/"):
+            for common_prefix in page.get("CommonPrefixes", []):
+                name = common_prefix["Prefix"].rstrip("/").split("/")[-1]
+                if name not in SKIPPED_FOLDERS:
+                    prefixes.append(common_prefix["Prefix"])
+
+    return region_prefixes
+
+
+def get_new_s3_log_files(s3, uri, state):
+    bucket, prefix = parse_s3_uri(uri)
+    paginator = s3.get_paginator("list_objects_v2")
+
+    log_files = []
+    for region_prefix in get_region_prefixes(s3, bucket, prefix):
+        folder, _ = split_log_path(f"s3://{bucket}/{region_prefix}")
+        kwargs = {}
+        if folder in state["cursors"]:
+            folder_key = folder.removeprefix(f"s3://{bucket}/")
+            lag_start = get_lag_start(state["cursors"][folder])
+            kwargs["StartAfter"] = f"{folder_key}/{lag_start}"
+
+        for page in paginator.paginate(Bucket=bucket, Prefix=region_prefix, **kwargs):
+            log_files.extend(
+                f"s3://{bucket}/{item['Key']}"
+                for item in page.get("Contents", [])
+                if item["Key"].endswith(".json.gz")
+            )
+
+    return [path for path in log_files if is_new_file(path, state)]
+
+
+def get_new_log_files(session, sources, state):
+    log_files = []
+    for source in sources:
+        if source.startswith("s3://"):
+            log_files.extend(get_new_s3_log_files(session.client("s3"), source, state))
+        elif os.path.isdir(source):
+            # cursors are kept by absolute path, the same sync may be given either way
+            for root, _, names in os.walk(os.path.abspath(source)):
+                log_files.extend(
+                    os.path.join(root, name)
+                    for name in sorted(names)
+                    if name.endswith(".json.gz")
+                    and is_new_file(os.path.join(root, name), state)
+                )
+        else:
+            log_files.append(os.path.abspath(source))
+
+    return log_files
+
+
+def open_log_file(path):
+    if path.startswith("s3://"):
+        bucket, key = parse_s3_uri(path)
+        return get_worker_s3().get_object(Bucket=bucket, Key=key)["Body"]
+
+    return open(path, "rb")
+
+
+def get_principals(record):
+    # The role or user that made the call, and the role it assumed if it did
+    identity = record.get("userIdentity", {})
+    principals = []
+    if identity.get("type") == "AssumedRole":
+        issuer = identity.get("sessionContext", {}).get("sessionIssuer", {})
+        if issuer.get("arn"):
+            principals.append(issuer["arn"])
+    elif identity.get("type") == "IAMUser" and identity.get("arn"):
+        principals.append(identity["arn"])
+
+    if record.get("eventName", "").startswith("AssumeRole"):
+        role_arn = (record.get("requestParameters") or {}).get("roleArn")
+        if role_arn:
+            principals.append(role_arn)
+
+    return principals
+
+
+def read_log_file(path):
+    # Last event time of every principal in one log file, the file is decompressed
+    # as it is read. Event times are ISO 8601 in UTC so they compare as strings.
+    last_used = {}
+    with open_log_file(path) as f:
+        records = json.load(gzip.GzipFile(fileobj=f)).get("Records", [])
+
+    for record in records:
+        event_time = record.get("eventTime", "")
+        for principal in get_principals(record):
+            if event_time > last_used.get(principal, ""):
+                last_used[principal] = event_time
+
+    return last_used
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {"cursors": {}, "read": {}, "last_used": {}}
+
+    with open(path) as f:
+        state = json.load(f)
+
+    # state files written before the lag window have no read files
+    state.setdefault("read", {})
+    return state
+
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+@timed
+def get_principals_last_used(
+    session, sources, state_path=CLOUDTRAIL_STATE_PATH, max_workers=None
+):
+    # Reads the CloudTrail log files of the sources that are newer than the cursors
+    # of the state file on a process pool and returns the last time every role and
+    # user of every account in them was used, merged with the earlier runs'. The
+    # files read within the lag window of each cursor are kept in the state file.
+    state = load_state(state_path)
+    log_files = get_new_log_files(session, sources, state)
+
+    report(f"reading {len(log_files)} new cloudtrail log files...")
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_worker,
+        initargs=(session.profile_name,),
+    ) as executor:
+        futures = {executor.submit(read_log_file, path): path for path in log_files}
+        for future in progress_bar(
+            as_completed(futures), total=len(futures), unit="file"
+        ):
+            for principal, event_time in future.result().items():
+                if event_time > state["last_used"].get(principal, ""):
+                    state["last_used"][principal] = event_time
+
+            folder, rest = split_log_path(futures[future])
+            state["read"].setdefault(folder, []).append(rest)
+            if rest > state["cursors"].get(folder, ""):
+                state["cursors"][folder] = rest
+
+    for folder, cursor in state["cursors"].items():
+        lag_start = get_lag_start(cursor)
+        state["read"][folder] = sorted(
+            rest for rest in state["read"].get(folder, []) if rest > lag_start
+        )
+
+    save_state(state_path, state)
+
+    return state["last_used"]
@@ -0,0 +1,184 @@
+from collections import Counter
+from datetime import datetime, timedelta, UTC
+from .progress import progress_bar
+
+# GetMetricData accepts at most 500 queries per request
+MAX_METRIC_DATA_QUERIES = 500
+
+LB_IDLE_METRICS = {
+    "application": ("AWS/ApplicationELB", ["RequestCount"]),
+    "network": ("AWS/NetworkELB", ["ActiveFlowCount"]),
+}
+
+EBS_IDLE_METRICS = ("AWS/EBS", ["VolumeReadOps", "VolumeWriteOps"])
+
+# Daily S3 storage metrics that fingerprint the contents of a bucket
+BUCKET_FINGERPRINT_METRICS = [
+    ("NumberOfObjects", "AllStorageTypes"),
+    ("BucketSizeBytes", "StandardStorage"),
+]
+
+
+def get_metric_values(
+    session, metrics, days, period=86400, stat="Sum", region_name=None
+):
+    # metrics is a list of (key, namespace, metric_name, dimensions) tuples, the
+    # datapoints of all metrics sharing a key are collected together
+    client = session.client("cloudwatch", region_name=region_name)
+    paginator = client.get_paginator("get_metric_data")
+
+    end_time = datetime.now(UTC)
+    start_time = end_time - timedelta(days=days)
+
+    values = {metric[0]: [] for metric in metrics}
+
+    batches = range(0, len(metrics), MAX_METRIC_DATA_QUERIES)
+    for offset in progress_bar(batches, unit="batch", disable=len(batches) < 2):
+        batch = metrics[offset : offset + MAX_METRIC_DATA_QUERIES]
+        queries = [
+            {
+                "Id": f"m{index}",
+                "MetricStat": {
+                    "Metric": {
+                        "Namespace": namespace,
+                        "MetricName": metric_name,
+                        "Dimensions": [
+                            {"Name": name, "Value": value}
+                            for name, value in dimensions.items()
+                        ],
+                    },
+                    "Period": period,
+                    "Stat": stat,
+                },
+                "ReturnData": True,
+            }
+            for index, (_, namespace, metric_name, dimensions) in enumerate(batch)
+        ]
+
+        for page in paginator.paginate(
+            MetricDataQueries=queries, StartTime=start_time, EndTime=end_time
+        ):
+            for result in page["MetricDataResults"]:
+                key = batch[int(result["Id"][1:])][0]
+                values[key].extend(result["Values"])
+
+    return values
+
+
+def get_metric_sums(
+    session, metrics, days, period=86400, region_name=None, full_window=False
+):
+    # With full_window, keys without a datapoint for every period of every one of
+    # their metrics sum to None, missing data is not the same as no activity
+    values = get_metric_values(
+        session, metrics, days, period=period, region_name=region_name
+    )
+    if not full_window:
+        return {key: sum(values[key]) for key in values}
+
+    num_metrics = Counter(metric[0] for metric in metrics)
+    num_periods = days * 86400 // period
+    return {
+        key: (
+            sum(values[key])
+            if len(values[key]) >= num_periods * num_metrics[key]
+            else None
+        )
+        for key in values
+    }
+
+
+def get_idle_lbs(session, lbs, days):
+    # lbs are LoadBalancers entries as returned by elbv2 describe_load_balancers.
+    # Their traffic metrics are only published while there is traffic, so load
+    # balancers younger than the window are never idle rather than requiring a
+    # datapoint for every day.
+    created_before = datetime.now(UTC) - timedelta(days=days)
+    metrics = []
+    for lb in lbs:
+        if lb["Type"] not in LB_IDLE_METRICS or lb["CreatedTime"] > created_before:
+            continue
+
+        namespace, metric_names = LB_IDLE_METRICS[lb["Type"]]
+        dimensions = {"LoadBalancer": lb["LoadBalancerArn"].split(":loadbalancer/")[1]}
+        for metric_name in metric_names:
+            metrics.append((lb["LoadBalancerArn"], namespace, metric_name, dimensions))
+
+    sums = get_metric_sums(session, metrics, days)
+
+    return [lb_arn for lb_arn in sums if sums[lb_arn] == 0]
+
+
+def get_idle_ebs_volumes(session, volume_ids, days):
+    namespace, metric_names = EBS_IDLE_METRICS
+    metrics = [
+        (volume_id, namespace, metric_name, {"VolumeId": volume_id})
+        for volume_id in volume_ids
+        for metric_name in metric_names
+    ]
+
+    # attached volumes publish their i/o every day, even when there is none
+    sums = get_metric_sums(session, metrics, days, full_window=True)
+
+    return [volume_id for volume_id in sums if sums[volume_id] == 0]
+
+
+def get_bucket_object_counts(session, bucket_regions):
+    # S3 storage metrics are published once a day in the bucket's own region
+    regions = {}
+    for bucket_name, region in bucket_regions.items():
+        regions.setdefault(region, []).append(bucket_name)
+
+    counts = {}
+    for region, bucket_names in regions.items():
+        metrics = [
+            (
+                bucket_name,
+                "AWS/S3",
+                "NumberOfObjects",
+                {"BucketName": bucket_name, "StorageType": "AllStorageTypes"},
+            )
+            for bucket_name in bucket_names
+        ]
+        values = get_metric_values(
+            session, metrics, 3, stat="Average", region_name=region
+        )
+        for bucket_name in bucket_names:
+            counts[bucket_name] = int(max(values[bucket_name], default=0))
+
+    return counts
+
+
+def get_bucket_storage_metrics(session, bucket_regions):
+    # The latest daily object count and standard storage size of every bucket, or
+    # None for buckets without metrics yet
+    regions = {}
+    for bucket_name, region in bucket_regions.items():
+        regions.setdefault(region, []).append(bucket_name)
+
+    storage_metrics = {}
+    for region, bucket_names in regions.items():
+        metrics = [
+            (
+                (bucket_name, metric_name),
+                "AWS/S3",
+                metric_name,
+                {"BucketName": bucket_name, "StorageType": storage_type},
+            )
+            for bucket_name in bucket_names
+            for metric_name, storage_type in BUCKET_FINGERPRINT_METRICS
+        ]
+        values = get_metric_values(
+            session, metrics, 3, stat="Average", region_name=region
+        )
+        # datapoints come newest first
+        for bucket_name in bucket_names:
+            latest = [
+                values[(bucket_name, metric_name)][:1]
+                for metric_name, _ in BUCKET_FINGERPRINT_METRICS
+            ]
+            storage_metrics[bucket_name] = (
+                [int(value[0]) for value in latest] if all(latest) else None
+            )
+
+    return storage_metrics
@@ -0,0 +1,208 @@
+import csv
+import gzip
+import os
+import re
+from datetime import timedelta, UTC
+from .progress import progress_bar
+
+RESOURCE_ID = "line_item_resource_id"
+USAGE_START_DATE = "line_item_usage_start_date"
+UNBLENDED_COST = "line_item_unblended_cost"
+
+
+def import_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise RuntimeError(
+            "Reading Cost and Usage Reports requires pyarrow, install it with: pip install pyarrow"
+        )
+
+
+def normalize_column(name):
+    # CSV reports name columns like lineItem/ResourceId, Parquet reports like
+    # line_item_resource_id
+    name = name.replace("/", "_").replace(":", "_")
+    return re.sub(r"(?<=[a-z0-9])(?=[A-Z])", "_", name).lower()
+
+
+def get_report_files(sources):
+    report_files = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, _, names in os.walk(source):
+                report_files.extend(
+                    os.path.join(root, name)
+                    for name in sorted(names)
+                    if name.endswith((".parquet", ".csv", ".csv.gz"))
+                )
+        else:
+            report_files.append(source)
+
+    return report_files
+
+
+def get_csv_datasets(paths):
+    # CSV reports only share a header within a month, so files are grouped by it
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.dataset
+
+    headers = {}
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", newline="") as f:
+            header = next(csv.reader(f), [])
+        headers.setdefault(tuple(header), []).append(path)
+
+    datasets = []
+    for header, header_paths in headers.items():
+        column_names = [normalize_column(column) for column in header]
+        if not {RESOURCE_ID, USAGE_START_DATE, UNBLENDED_COST} <= set(column_names):
+            continue
+
+        datasets.append(
+            pyarrow.dataset.dataset(
+                header_paths,
+                format=pyarrow.dataset.CsvFileFormat(
+                    read_options=pyarrow.csv.ReadOptions(
+                        column_names=column_names, skip_rows=1
+                    ),
+                    convert_options=pyarrow.csv.ConvertOptions(
+                        column_types={
+                            USAGE_START_DATE: pa.timestamp("s", tz="UTC"),
+                            UNBLENDED_COST: pa.float64(),
+                            RESOURCE_ID: pa.string(),
+                        },
+                    ),
+                ),
+            )
+        )
+
+    return datasets
+
+
+def get_parquet_datasets(paths):
+    import pyarrow.dataset
+
+    return [pyarrow.dataset.dataset(paths, format="parquet")] if paths else []
+
+
+def get_cur_datasets(sources):
+    report_files = get_report_files(sources)
+    return get_parquet_datasets(
+        [path for path in report_files if path.endswith(".parquet")]
+    ) + get_csv_datasets([path for path in report_files if ".csv" in path])
+
+
+def get_newest_usage_time(sources):
+    # Start of the newest line item of the reports, only its column is read
+    import_pyarrow()
+    import pyarrow.compute
+
+    newest = None
+    for dataset in get_cur_datasets(sources):
+        for batch in dataset.to_batches(columns=[USAGE_START_DATE]):
+            usage_time = pyarrow.compute.max(batch.column(0)).as_py()
+            if usage_time is None:
+                continue
+            if usage_time.tzinfo is None:
+                usage_time = usage_time.replace(tzinfo=UTC)
+            if newest is None or usage_time > newest:
+                newest = usage_time
+
+    return newest
+
+
+def get_cur_costs(sources, resource_ids, start_time, end_time):
+    # Sums the unblended cost of the given resources over [start_time, end_time) from
+    # local CUR files. The resource and time filters are pushed down into the scan and
+    # the matching rows are aggregated batch by batch on pyarrow's thread pool, so
+    # memory is bounded by the number of resources rather than the report size.
+    import_pyarrow()
+    import pyarrow as pa
+    import pyarrow.dataset
+
+    datasets = get_cur_datasets(sources)
+    value_set = pa.array(sorted(set(resource_ids)), type=pa.string())
+    costs = {}
+
+    for dataset in datasets:
+        usage_start_type = dataset.schema.field(USAGE_START_DATE).type
+        start, end = start_time, end_time
+        if usage_start_type.tz is None:
+            start = start.astimezone(UTC).replace(tzinfo=None)
+            end = end.astimezone(UTC).replace(tzinfo=None)
+
+        usage_start_date = pyarrow.dataset.field(USAGE_START_DATE)
+        scanner = dataset.scanner(
+            columns=[RESOURCE_ID, UNBLENDED_COST],
+            filter=(
+                pyarrow.dataset.field(RESOURCE_ID).isin(value_set)
+                & (usage_start_date >= pa.scalar(start, type=usage_start_type))
+                & (usage_start_date < pa.scalar(end, type=usage_start_type))
+            ),
+            use_threads=True,
+        )
+
+        for batch in progress_bar(scanner.to_batches(), unit="batch"):
+            if batch.num_rows == 0:
+                continue
+
+            sums = (
+                pa.Table.from_batches([batch])
+                .group_by(RESOURCE_ID)
+                .aggregate([(UNBLENDED_COST, "sum")])
+            )
+            for resource_id, cost in zip(
+                sums[RESOURCE_ID].to_pylist(),
+                sums[f"{UNBLENDED_COST}_sum"].to_pylist(),
+            ):
+                costs[resource_id] = costs.get(resource_id, 0) + (cost or 0)
+
+    return costs
+
+
+def get_monthly_cur_costs(sources, resource_ids, days=30):
+    # Actual spend of the resources over the last days the reports cover, scaled to
+    # 30 days. Reports lag behind, so the window ends with the day of their newest
+    # line item rather than today.
+    newest = get_newest_usage_time(sources)
+    if newest is None:
+        return {}
+
+    end_time = newest.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(
+        days=1
+    )
+    start_time = end_time - timedelta(days=days)
+    costs = get_cur_costs(sources, resource_ids, start_time, end_time)
+
+    return {resource_id: cost * 30 / days for resource_id, cost in costs.items()}
+
+
+def apply_cur_costs_to_volumes(unused_volumes, costs):
+    for volume in unused_volumes["volumes"]:
+        if volume["VolumeId"] in costs:
+            volume["MonthlyCost"] = costs[volume["VolumeId"]]
+
+    unused_volumes["total_monthly_cost"] = sum(
+        [volume["MonthlyCost"] for volume in unused_volumes["volumes"]]
+    )
+
+    return unused_volumes
+
+
+def apply_cur_costs_to_lbs(lbs, costs):
+    for lb_arn in lbs:
+        if lb_arn != "total_monthly_cost" and lb_arn in costs:
+            lbs[lb_arn]["monthly_cost"] = costs[lb_arn]
+
+    lbs["total_monthly_cost"] = sum(
+        [
+            lbs[lb_arn]["monthly_cost"]
+            for lb_arn in lbs
+            if lb_arn != "total_monthly_cost"
+        ]
+    )
+
+    return lbs
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+from .cassette import encode, decode
+
+SCAN_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".acm", "scans")
+
+INDEX_VERSION = 1
+
+
+def get_index_path(check, profile, region):
+    return os.path.join(SCAN_INDEX_DIR, f"{check}-{profile}-{region}.json")
+
+
+def get_content_hash(value):
+    # datetimes are encoded the way the index stores them, so a finding hashes the
+    # same before and after a round trip through the index
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=encode).encode()
+    ).hexdigest()
+
+
+def load_index(path):
+    # findings maps resource ids to the content hash and contents of their last
+    # finding, inspections to the cheap fingerprint and result of their last
+    # inspection
+    if not os.path.exists(path):
+        return {"version": INDEX_VERSION, "findings": {}, "inspections": {}}
+
+    with open(path) as f:
+        index = json.load(f, object_hook=decode)
+
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"Unsupported scan index version {index.get('version')}")
+
+    return index
+
+
+def save_index(path, index):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, default=encode)
+    os.replace(tmp_path, path)
+
+
+def get_changes(previous, current):
+    # the cost and detail fields, e.g. size or attachments, that differ
+    changes = {}
+    if previous["monthly_cost"] != current["monthly_cost"]:
+        changes["monthly_cost"] = [previous["monthly_cost"], current["monthly_cost"]]
+
+    for key in {**previous["details"], **current["details"]}:
+        if previous["details"].get(key) != current["details"].get(key):
+            changes[key] = [
+                previous["details"].get(key),
+                current["details"].get(key),
+            ]
+
+    return changes
+
+
+def diff_findings(previous, findings):
+    # One pass over the findings with lookups in the previous index, then one over
+    # the index for what was resolved. Returns the delta and the index entries of
+    # the findings for the next run.
+    current = {}
+    delta = {"new": [], "changed": [], "resolved": []}
+
+    for finding in findings:
+        entry = {
+            "region": finding.region,
+            "monthly_cost": finding.monthly_cost,
+            "details": finding.details,
+        }
+        content_hash = get_content_hash(entry)
+        current[finding.resource_id] = {"hash": content_hash, "finding": entry}
+
+        if finding.resource_id not in previous:
+            delta["new"].append({"resource_id": finding.resource_id, **entry})
+        elif previous[finding.resource_id]["hash"] != content_hash:
+            delta["changed"].append(
+                {
+                    "resource_id": finding.resource_id,
+                    "changes": get_changes(
+                        previous[finding.resource_id]["finding"], entry
+                    ),
+                }
+            )
+
+    for resource_id, entry in previous.items():
+        if resource_id not in current:
+            delta["resolved"].append({"resource_id": resource_id, **entry["finding"]})
+
+    return delta, current
+
+
+def get_unchanged_results(index, fingerprints):
+    # Results of the last inspection of resources whose cheap fingerprint has not
+    # changed since, resources without a fingerprint are always inspected again
+    return {
+        resource_id: entry["result"]
+        for resource_id, entry in index["inspections"].items()
+        if fingerprints.get(resource_id) is not None
+        and fingerprints[resource_id] == entry["fingerprint"]
+    }
+
+
+def record_inspections(index, fingerprints, results):
+    index["inspections"] = {
+        resource_id: {"fingerprint": fingerprints[resource_id], "result": result}
+        for resource_id, result in results.items()
+        if fingerprints.get(resource_id) is not None
+    }
@@ -0,0 +1,213 @@
+import heapq
+import json
+import os
+from botocore.config import Config
+from itertools import groupby
+from operator import itemgetter
+from .progress import progress_bar, report, ContextThreadPoolExecutor
+from .ec2 import SNAPSHOT_PRICE_PER_GB_MONTH, COPIED_SNAPSHOT_VOLUME_ID
+from .graph import get_graph, SNAPSHOT
+from .trace import traced
+
+SNAPSHOT_BLOCKS_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".acm", "snapshot-blocks.json"
+)
+
+# The EBS direct APIs always list 512 KiB blocks
+BLOCK_SIZE = 524288
+
+# Largest page the block listing APIs return
+MAX_BLOCK_RESULTS = 10000
+
+
+def iter_block_indexes(ebs, operation, key, **kwargs):
+    # Block indexes in ascending order, fetched a page at a time
+    while True:
+        response = getattr(ebs, operation)(MaxResults=MAX_BLOCK_RESULTS, **kwargs)
+        for block in response[key]:
+            yield block["BlockIndex"]
+
+        if not response.get("NextToken"):
+            return
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def iter_written_blocks(ebs, chain, position):
+    # The blocks a snapshot stores itself: all of them for the first snapshot of a
+    # volume, the ones changed since the previous snapshot for the others
+    if position == 0:
+        return iter_block_indexes(
+            ebs, "list_snapshot_blocks", "Blocks", SnapshotId=chain[0]
+        )
+
+    return iter_block_indexes(
+        ebs,
+        "list_changed_blocks",
+        "ChangedBlocks",
+        FirstSnapshotId=chain[position - 1],
+        SecondSnapshotId=chain[position],
+    )
+
+
+def tag_blocks(blocks, position):
+    for index in blocks:
+        yield index, position
+
+
+def count_unique_blocks(written_blocks):
+    # written_blocks holds the ascending block indexes written by each snapshot of a
+    # chain. A block written by a snapshot is only freed by deleting it if the next
+    # snapshot wrote that block again, otherwise the next snapshot still uses it:
+    # unique(s) = changed(prev -> s) & changed(s -> next). The streams are merged by
+    # block index, so memory is bounded by one page per snapshot.
+    last = len(written_blocks) - 1
+    counts = [0] * len(written_blocks)
+    merged = heapq.merge(
+        *[
+            tag_blocks(blocks, position)
+            for position, blocks in enumerate(written_blocks)
+        ]
+    )
+    for _, group in groupby(merged, key=itemgetter(0)):
+        writers = {position for _, position in group}
+        for position in writers:
+            if position == last or position + 1 in writers:
+                counts[position] += 1
+
+    return counts
+
+
+def get_chain_keys(chain):
+    return [
+        "|".join(
+            [
+                chain[position - 1] if position > 0 else "",
+                chain[position],
+                chain[position + 1] if position < len(chain) - 1 else "",
+            ]
+        )
+        for position in range(len(chain))
+    ]
+
+
+def get_snapshot_chains(graph, snapshot_ids):
+    # The completed snapshots of every volume with one of the snapshots, oldest first.
+    # Copies share a placeholder volume id and are each a chain of their own.
+    volumes = {}
+    for snapshot_id in graph.of_type(SNAPSHOT):
+        snapshot = graph.data(snapshot_id)
+        if snapshot["State"] == "completed":
+            volume_id = snapshot["VolumeId"]
+            if volume_id == COPIED_SNAPSHOT_VOLUME_ID:
+                volume_id = snapshot_id
+            volumes.setdefault(volume_id, []).append(snapshot)
+
+    wanted = set(snapshot_ids)
+    chains = []
+    for snapshots in volumes.values():
+        chain = [
+            snapshot["SnapshotId"]
+            for snapshot in sorted(snapshots, key=itemgetter("StartTime"))
+        ]
+        if wanted.intersection(chain):
+            chains.append(chain)
+
+    return chains
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+@traced("pricing")
+def get_snapshots_unique_bytes(
+    session,
+    snapshot_ids,
+    graph=None,
+    cache_path=SNAPSHOT_BLOCKS_CACHE_PATH,
+    max_workers=8,
+):
+    # Bytes only each snapshot stores, i.e. what deleting it alone would free, from
+    # block walks of the snapshot chains of their volumes. Chains are walked
+    # concurrently. Snapshots never change, so the count of a snapshot between the
+    # same neighbors is cached on disk. Snapshots whose chain could not be walked
+    # are None.
+    graph = get_graph(session, graph, ["snapshots"])
+    ebs = session.client("ebs", config=Config(max_pool_connections=max_workers))
+    cache = load_cache(cache_path)
+
+    chains = get_snapshot_chains(graph, snapshot_ids)
+    uncached = [
+        chain
+        for chain in chains
+        if not all(key in cache for key in get_chain_keys(chain))
+    ]
+
+    report(f"walking the blocks of {len(uncached)} snapshot chains...")
+    pbar = progress_bar(total=len(uncached))
+
+    def walk_chain(chain):
+        try:
+            return count_unique_blocks(
+                [
+                    iter_written_blocks(ebs, chain, position)
+                    for position in range(len(chain))
+                ]
+            )
+        except Exception as e:
+            pbar.write(
+                f"Failed to walk the snapshot blocks of {chain[-1]}'s volume: {e}"
+            )
+            return None
+        finally:
+            pbar.update()
+
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chain, counts in zip(uncached, executor.map(walk_chain, uncached)):
+            if counts is not None:
+                cache.update(zip(get_chain_keys(chain), counts))
+
+    pbar.close()
+
+    save_cache(cache_path, cache)
+
+    unique_bytes = {snapshot_id: None for snapshot_id in snapshot_ids}
+    for chain in chains:
+        for snapshot_id, key in zip(chain, get_chain_keys(chain)):
+            if snapshot_id in unique_bytes and key in cache:
+                unique_bytes[snapshot_id] = cache[key] * BLOCK_SIZE
+
+    return unique_bytes
+
+
+def estimate_snapshots_unique_cost(session, snapshot_ids, graph=None):
+    # Monthly cost of the bytes only each snapshot stores, snapshots that could not
+    # be walked are priced by their full volume size like estimate_snapshots_cost
+    graph = get_graph(session, graph, ["snapshots"])
+    unique_bytes = get_snapshots_unique_bytes(session, snapshot_ids, graph)
+
+    snapshots = {}
+    for snapshot_id in snapshot_ids:
+        if unique_bytes[snapshot_id] is None:
+            size_gb = graph.data(snapshot_id)["VolumeSize"]
+        else:
+            size_gb = unique_bytes[snapshot_id] / 2**30
+
+        snapshots[snapshot_id] = {
+            "unique_bytes": unique_bytes[snapshot_id],
+            "monthly_cost": size_gb * SNAPSHOT_PRICE_PER_GB_MONTH,
+        }
+
+    return snapshots
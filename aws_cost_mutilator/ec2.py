@@ -1,9 +1,31 @@
 import json
-from tqdm import tqdm
+from botocore.config import Config
+from threading import Lock
 from time import sleep
 from datetime import datetime, timedelta
-
-
+from .cloudwatch import get_idle_lbs, get_idle_ebs_volumes
+from .metrics import timed
+from .trace import traced, span
+from .graph import (
+    get_graph,
+    LOAD_BALANCER,
+    TARGET_GROUP,
+    VOLUME,
+    SNAPSHOT,
+    BLOCK_DEVICE,
+)
+from .journal import journaled, IN_FLIGHT, DONE, FAILED
+from .progress import progress_bar, report, ContextThreadPoolExecutor
+
+# Pricing details (as of September 2021)
+# This value might change, so you should update it based on the current pricing details
+SNAPSHOT_PRICE_PER_GB_MONTH = 0.05
+
+# Volume id of snapshots copied from other snapshots, they share no volume
+COPIED_SNAPSHOT_VOLUME_ID = "vol-ffffffff"
+
+
+@traced("pricing")
 def get_lb_hourly_costs(session):
     client = session.client("pricing", region_name="us-east-1")
 
@@ -29,23 +51,27 @@ def get_lb_hourly_costs(session):
         ],
     }
 
-    # classic_params = {
-    #     "ServiceCode": "AmazonEC2",
-    #     "Filters": [{"Type": "TERM_MATCH", "Field": "productFamily", "Value": "Load Balancer"}],
-    # }
-
-    net_response = client.get_products(**net_params)
-    app_response = client.get_products(**app_params)
-    # classic_response = client.get_products(**classic_params)
+    classic_params = {
+        "ServiceCode": "AmazonEC2",
+        "Filters": [
+            {"Type": "TERM_MATCH", "Field": "productFamily", "Value": "Load Balancer"}
+        ],
+    }
 
-    hourly_costs = {"network": {}, "application": {}}  # , "classic": {}}
+    # every region has its own products, which take more than one page
+    paginator = client.get_paginator("get_products")
+    hourly_costs = {"network": {}, "application": {}, "classic": {}}
     responses = {
-        "network": net_response,
-        "application": app_response,
-    }  # , "classic": classic_response}
+        "network": paginator.paginate(**net_params),
+        "application": paginator.paginate(**app_params),
+        "classic": paginator.paginate(**classic_params),
+    }
 
     for response in responses:
-        for product in responses[response]["PriceList"]:
+        price_list = [
+            product for page in responses[response] for product in page["PriceList"]
+        ]
+        for product in price_list:
             data = json.loads(product)
 
             product_key = list(data["terms"]["OnDemand"].keys())[0]
@@ -72,19 +98,65 @@ def get_lb_hourly_costs(session):
     return hourly_costs
 
 
-def delete_tgs(session, tgs, dry_run=False):
+def get_lb_monthly_cost(hourly_costs, lb_type, region):
+    # load balancers run 730 hours a month
+    if hourly_costs is None or region not in hourly_costs[lb_type]:
+        return 0
+
+    return float(list(hourly_costs[lb_type][region].values())[0]) * 730
+
+
+@traced("delete", resource="tg_arn")
+def delete_tg(elb_client, tg_arn, dry_run=False, journal=None):
+    if journal and journal.is_done("tg", tg_arn):
+        return
+
+    if not dry_run:
+        with journaled(journal, "tg", tg_arn):
+            elb_client.delete_target_group(TargetGroupArn=tg_arn)
+
+
+@traced("delete")
+def delete_tgs(session, tgs, dry_run=False, journal=None, graph=None):
+    # target groups a listener or load balancer still uses are skipped, their
+    # deletion would fail
     elb_client = session.client("elbv2")
 
-    pbar = tqdm(tgs)
+    if journal:
+        journal.intend("tg", tgs)
+
+    summary = {
+        "deleted_target_groups": [],
+        "failed_target_groups": [],
+        "skipped_target_groups": [],
+        "errors": {},
+    }
+    pbar = progress_bar(tgs)
     for tg_arn in pbar:
-        if not dry_run:
-            try:
-                elb_client.delete_target_group(TargetGroupArn=tg_arn)
-            except Exception as e:
-                pbar.write(f"Failed to delete target group {tg_arn} with error {e}")
+        if journal and journal.is_done("tg", tg_arn):
+            pbar.write(f"target group {tg_arn} already deleted, skipping")
+            summary["deleted_target_groups"].append(tg_arn)
+            continue
+
+        if graph is not None and graph.is_referenced(tg_arn):
+            pbar.write(
+                f"target group {tg_arn} is still used by {', '.join(graph.get_referrers(tg_arn))}, skipping"
+            )
+            summary["skipped_target_groups"].append(tg_arn)
+            continue
+
+        try:
+            delete_tg(elb_client, tg_arn, dry_run, journal)
+        except Exception as e:
+            pbar.write(f"Failed to delete target group {tg_arn} with error {e}")
+            summary["failed_target_groups"].append(tg_arn)
+            summary["errors"][tg_arn] = str(e)
+            continue
+
         pbar.write(f"deleted target group {tg_arn} (dry run: {dry_run})")
+        summary["deleted_target_groups"].append(tg_arn)
 
-    return None
+    return summary
 
 
 def disable_lb_deletion_protection(client, lb_arn):
@@ -94,158 +166,419 @@ def disable_lb_deletion_protection(client, lb_arn):
     )
 
 
-def delete_lbs(session, lbs, dry_run=False):
-    elb_client = session.client("elbv2")
-    waiter = elb_client.get_waiter("load_balancers_deleted")
-
-    pbar = tqdm(lbs)
-    for lb_arn in pbar:
-        if not dry_run and "populated_target_groups" not in lbs[lb_arn]:
-            try:
-                lb_attributes = elb_client.describe_load_balancer_attributes(
-                    LoadBalancerArn=lb_arn
-                )["Attributes"]
-
-                if any(
-                    attr["Key"] == "deletion_protection.enabled"
-                    and attr["Value"] == "true"
-                    for attr in lb_attributes
-                ):
-                    pbar.write(
-                        f"Load balancer {lb_arn} has deletion protection enabled, disabling..."
-                    )
-                    disable_lb_deletion_protection(elb_client, lb_arn)
-
-                del_result = elb_client.delete_load_balancer(LoadBalancerArn=lb_arn)
+@traced("delete", resource="lb_arn")
+def delete_lb(elb_client, lb_arn, lb, dry_run=False, journal=None, write=report):
+    # Raises if the load balancer could not be deleted. Load balancers that still
+    # have populated target groups are left in place.
+    if journal and journal.is_done("lb", lb_arn):
+        write(f"load balancer {lb_arn} already deleted, skipping")
+        return
+
+    if dry_run or "populated_target_groups" in lb:
+        return
+
+    if journal:
+        journal.record("lb", lb_arn, IN_FLIGHT)
+    try:
+        lb_attributes = elb_client.describe_load_balancer_attributes(
+            LoadBalancerArn=lb_arn
+        )["Attributes"]
+
+        if any(
+            attr["Key"] == "deletion_protection.enabled" and attr["Value"] == "true"
+            for attr in lb_attributes
+        ):
+            write(
+                f"Load balancer {lb_arn} has deletion protection enabled, disabling..."
+            )
+            disable_lb_deletion_protection(elb_client, lb_arn)
+
+        del_result = elb_client.delete_load_balancer(LoadBalancerArn=lb_arn)
+
+        if del_result["ResponseMetadata"]["HTTPStatusCode"] != 200:
+            write(f"Failed to delete load balancer {lb_arn}: {del_result}")
+
+    except Exception:
+        if journal:
+            journal.record("lb", lb_arn, FAILED)
+        raise
+
+    write(f"waiting for load balancer {lb_arn} to be deleted...")
+    with span("load_balancers_deleted", "waiter", resource=lb_arn):
+        elb_client.get_waiter("load_balancers_deleted").wait(
+            LoadBalancerArns=[lb_arn],
+            WaiterConfig={"Delay": 15, "MaxAttempts": 100},
+        )
+    if journal:
+        journal.record("lb", lb_arn, DONE)
+    # target groups are only detached shortly after the load balancer is gone
+    with span("target_group_detach", "waiter", resource=lb_arn):
+        sleep(5)
+
+
+def get_lb_tgs_to_delete(lb):
+    return list(
+        dict.fromkeys(lb["empty_target_groups"] + lb.get("idle_target_groups", []))
+    )
 
-                if del_result["ResponseMetadata"]["HTTPStatusCode"] != 200:
-                    pbar.write(f"Failed to delete load balancer {lb_arn}: {del_result}")
 
-            except Exception as e:
-                pbar.write(f"Failed to delete load balancer {lb_arn} with error {e}")
+@traced("delete")
+def delete_lbs(session, lbs, dry_run=False, journal=None, max_workers=8):
+    # Load balancers are deleted concurrently. Their target groups form one
+    # de-duplicated queue and each is deleted as soon as no load balancer that is
+    # being deleted references it anymore.
+    elb_client = session.client(
+        "elbv2", config=Config(max_pool_connections=max_workers)
+    )
 
-            pbar.write(f"waiting for load balancer {lb_arn} to be deleted...")
-            waiter.wait(
-                LoadBalancerArns=[lb_arn],
-                WaiterConfig={"Delay": 15, "MaxAttempts": 100},
+    referencing_lbs = {}
+    for lb_arn in lbs:
+        for tg_arn in get_lb_tgs_to_delete(lbs[lb_arn]):
+            referencing_lbs.setdefault(tg_arn, set()).add(lb_arn)
+
+    if journal:
+        journal.intend("lb", lbs)
+        journal.intend("tg", list(referencing_lbs))
+
+    summary = {
+        "deleted_load_balancers": [],
+        "kept_load_balancers": [],
+        "failed_load_balancers": [],
+        "deleted_target_groups": [],
+        "failed_target_groups": [],
+        "skipped_target_groups": [],
+        "errors": {},
+    }
+    lock = Lock()
+    tg_futures = []
+    pbar = progress_bar(total=len(lbs) + len(referencing_lbs))
+
+    def delete_tg_task(tg_arn):
+        try:
+            delete_tg(elb_client, tg_arn, dry_run, journal)
+            result = "deleted_target_groups"
+            pbar.write(f"deleted target group {tg_arn} (dry run: {dry_run})")
+        except Exception as e:
+            result = "failed_target_groups"
+            pbar.write(f"Failed to delete target group {tg_arn} with error {e}")
+            with lock:
+                summary["errors"][tg_arn] = str(e)
+
+        with lock:
+            summary[result].append(tg_arn)
+        pbar.update()
+
+    def delete_lb_task(lb_arn):
+        error = None
+        try:
+            delete_lb(elb_client, lb_arn, lbs[lb_arn], dry_run, journal, pbar.write)
+        except Exception as e:
+            error = e
+            pbar.write(f"Failed to delete load balancer {lb_arn} with error {e}")
+
+        ready = []
+        with lock:
+            if error is None:
+                if "populated_target_groups" in lbs[lb_arn]:
+                    summary["kept_load_balancers"].append(lb_arn)
+                else:
+                    summary["deleted_load_balancers"].append(lb_arn)
+                for tg_arn in get_lb_tgs_to_delete(lbs[lb_arn]):
+                    referencing_lbs[tg_arn].discard(lb_arn)
+                    if not referencing_lbs[tg_arn]:
+                        ready.append(tg_arn)
+            else:
+                summary["failed_load_balancers"].append(lb_arn)
+                summary["errors"][lb_arn] = str(error)
+
+        if lb_arn in summary["deleted_load_balancers"]:
+            pbar.write(f"deleted load balancer {lb_arn} (dry run: {dry_run})")
+        pbar.update()
+
+        for tg_arn in ready:
+            tg_futures.append(executor.submit(delete_tg_task, tg_arn))
+
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        lb_futures = [executor.submit(delete_lb_task, lb_arn) for lb_arn in lbs]
+        for future in lb_futures:
+            future.result()
+
+        # every target group still referenced belongs to a load balancer that failed
+        for tg_arn, lb_arns in referencing_lbs.items():
+            if lb_arns:
+                summary["skipped_target_groups"].append(tg_arn)
+                pbar.update()
+
+        for future in tg_futures:
+            future.result()
+
+    pbar.close()
+
+    report(
+        f"Deleted {len(summary['deleted_load_balancers'])} load balancers and {len(summary['deleted_target_groups'])} target groups (dry run: {dry_run})"
+    )
+    for result in ["failed_load_balancers", "failed_target_groups"]:
+        if summary[result]:
+            report(
+                f"Failed to delete {len(summary[result])} {result[7:].replace('_', ' ')}"
             )
-            sleep(5)
-        pbar.write(f"deleted load balancer {lb_arn} (dry run: {dry_run})")
-
-        delete_tgs(session, lbs[lb_arn]["empty_target_groups"])
+    if summary["skipped_target_groups"]:
+        report(
+            f"Skipped {len(summary['skipped_target_groups'])} target groups of load balancers that could not be deleted"
+        )
 
-    return None
+    return summary
 
 
-def delete_ebs_volumes(volume_ids, session, dry_run=False):
+@traced("delete")
+def delete_ebs_volumes(volume_ids, session, dry_run=False, journal=None):
     ec2 = session.resource("ec2")
+
+    if journal:
+        journal.intend("volume", volume_ids)
+
+    summary = {"deleted_volumes": [], "failed_volumes": [], "errors": {}}
     for volume_id in volume_ids:
+        if journal and journal.is_done("volume", volume_id):
+            report("Volume {} already deleted, skipping".format(volume_id))
+            summary["deleted_volumes"].append(volume_id)
+            continue
+
         volume = ec2.Volume(volume_id)
-        print("Deleting volume {}".format(volume_id))
-        if not dry_run:
-            volume.delete()
+        report("Deleting volume {}".format(volume_id))
+        try:
+            if not dry_run:
+                with journaled(journal, "volume", volume_id):
+                    volume.delete()
+        except Exception as e:
+            report(f"Failed to delete volume {volume_id} with error {e}")
+            summary["failed_volumes"].append(volume_id)
+            summary["errors"][volume_id] = str(e)
+            continue
 
+        summary["deleted_volumes"].append(volume_id)
 
-def estimate_snapshots_cost(session, snapshot_ids):
-    ec2 = session.client("ec2")
+    return summary
 
-    # Pricing details (as of September 2021)
-    # This value might change, so you should update it based on the current pricing details
-    price_per_gb_month = 0.05
+
+@traced("pricing")
+def estimate_snapshots_cost(session, snapshot_ids, graph=None):
+    # snapshots are priced by the size of their volume, as the graph holds it
+    graph = get_graph(session, graph, ["snapshots"])
 
     total_size_gb = 0
     for snapshot_id in snapshot_ids:
-        snapshot = ec2.describe_snapshots(SnapshotIds=[snapshot_id])["Snapshots"][0]
-        total_size_gb += snapshot["VolumeSize"]
+        total_size_gb += graph.data(snapshot_id)["VolumeSize"]
 
-    cost = total_size_gb * price_per_gb_month
+    cost = total_size_gb * SNAPSHOT_PRICE_PER_GB_MONTH
 
     return cost
 
 
-def delete_ebs_snapshots(snapshot_ids, session, dry_run=False):
+@traced("delete")
+def delete_ebs_snapshots(
+    snapshot_ids, session, dry_run=False, journal=None, graph=None
+):
+    # snapshots backing an image are skipped, their deletion would fail
     ec2 = session.client("ec2")
+
+    if journal:
+        journal.intend("snapshot", snapshot_ids)
+
+    summary = {
+        "deleted_snapshots": [],
+        "failed_snapshots": [],
+        "skipped_snapshots": [],
+        "errors": {},
+    }
     for snapshot_id in snapshot_ids:
-        print("Deleting snapshot {}".format(snapshot_id))
-        if not dry_run:
-            ec2.delete_snapshot(SnapshotId=snapshot_id)
+        if journal and journal.is_done("snapshot", snapshot_id):
+            report("Snapshot {} already deleted, skipping".format(snapshot_id))
+            summary["deleted_snapshots"].append(snapshot_id)
+            continue
+
+        images = graph.get_referrers(snapshot_id, BLOCK_DEVICE) if graph else []
+        if images:
+            report(
+                "Snapshot {} is used by {}, skipping".format(
+                    snapshot_id, ", ".join(images)
+                )
+            )
+            summary["skipped_snapshots"].append(snapshot_id)
+            continue
+
+        report("Deleting snapshot {}".format(snapshot_id))
+        try:
+            if not dry_run:
+                with journaled(journal, "snapshot", snapshot_id):
+                    ec2.delete_snapshot(SnapshotId=snapshot_id)
+        except Exception as e:
+            report(f"Failed to delete snapshot {snapshot_id} with error {e}")
+            summary["failed_snapshots"].append(snapshot_id)
+            summary["errors"][snapshot_id] = str(e)
+            continue
 
+        summary["deleted_snapshots"].append(snapshot_id)
 
-def get_old_snapshots(session, days):
+    return summary
+
+
+def get_existing_resources(session, in_flight):
+    # Batched existence check of the resources a journal has in flight, keyed by kind
+    elb_client = session.client("elbv2")
     ec2 = session.client("ec2")
 
+    existing = {}
+    if "lb" in in_flight:
+        paginator = elb_client.get_paginator("describe_load_balancers")
+        existing["lb"] = {
+            lb["LoadBalancerArn"]
+            for page in paginator.paginate()
+            for lb in page["LoadBalancers"]
+        }
+
+    if "tg" in in_flight:
+        paginator = elb_client.get_paginator("describe_target_groups")
+        existing["tg"] = {
+            tg["TargetGroupArn"]
+            for page in paginator.paginate()
+            for tg in page["TargetGroups"]
+        }
+
+    # filter values are capped at 200 per request
+    if "volume" in in_flight:
+        existing["volume"] = set()
+        ids = in_flight["volume"]
+        for offset in range(0, len(ids), 200):
+            existing["volume"].update(
+                volume["VolumeId"]
+                for volume in get_ebs_volumes(
+                    ec2,
+                    Filters=[
+                        {"Name": "volume-id", "Values": ids[offset : offset + 200]}
+                    ],
+                )
+            )
+
+    # deleting a classic load balancer that is already gone succeeds, so in-flight
+    # ones are simply deleted again
+    if "clb" in in_flight:
+        existing["clb"] = set(in_flight["clb"])
+
+    if "snapshot" in in_flight:
+        existing["snapshot"] = set()
+        ids = in_flight["snapshot"]
+        paginator = ec2.get_paginator("describe_snapshots")
+        for offset in range(0, len(ids), 200):
+            for page in paginator.paginate(
+                OwnerIds=["self"],
+                Filters=[{"Name": "snapshot-id", "Values": ids[offset : offset + 200]}],
+            ):
+                existing["snapshot"].update(
+                    snapshot["SnapshotId"] for snapshot in page["Snapshots"]
+                )
+
+    return existing
+
+
+@traced("delete")
+def resolve_in_flight_deletions(session, journal):
+    # Resources that were in flight when a cleanup was interrupted and no longer
+    # exist were deleted, the rest are retried
+    in_flight = journal.in_flight()
+    existing = get_existing_resources(session, in_flight)
+
+    resolved = 0
+    for kind, resource_ids in in_flight.items():
+        for resource_id in resource_ids:
+            if resource_id not in existing[kind]:
+                journal.record(kind, resource_id, DONE)
+                resolved += 1
+
+    return resolved
+
+
+@traced("scan")
+@timed
+def get_old_snapshots(session, days, tag_filter=None, graph=None):
+    graph = get_graph(session, graph, ["snapshots"])
+
     now = datetime.now()
-    snapshots = ec2.describe_snapshots(OwnerIds=["self"])["Snapshots"]
     old_snapshots = [
-        snapshot["SnapshotId"]
-        for snapshot in snapshots
-        if (now - snapshot["StartTime"].replace(tzinfo=None)) > timedelta(days=days)
+        snapshot_id
+        for snapshot_id in graph.of_type(SNAPSHOT)
+        if (now - graph.data(snapshot_id)["StartTime"].replace(tzinfo=None))
+        > timedelta(days=days)
+        and (tag_filter is None or tag_filter(snapshot_id))
     ]
 
     return old_snapshots
 
 
-def scan_for_tgs_no_targets_or_lb(session):
-    elb_client = session.client("elbv2")
-
-    unused_target_groups = {
-        tg["TargetGroupArn"]: {
-            "TargetHealthDescriptions": elb_client.describe_target_health(
-                TargetGroupArn=tg["TargetGroupArn"]
-            )["TargetHealthDescriptions"],
-            "LoadBalancerArns": tg["LoadBalancerArns"],
-        }
-        for tg in elb_client.describe_target_groups()["TargetGroups"]
-    }
+@traced("scan")
+@timed
+def scan_for_tgs_no_targets_or_lb(session, tag_filter=None, graph=None):
+    graph = get_graph(session, graph, ["target_groups"])
 
     tgs = []
 
-    print("getting target groups with zero targets or no configured load balancer...")
-    for target_group_arn in tqdm(unused_target_groups):
-        sleep(0.05)
+    report("getting target groups with zero targets or no configured load balancer...")
+    for target_group_arn in graph.of_type(TARGET_GROUP):
+        if tag_filter is not None and not tag_filter(target_group_arn):
+            continue
+
+        target_group = graph.data(target_group_arn)
 
-        if len(unused_target_groups[target_group_arn]["TargetHealthDescriptions"]) == 0:
+        if len(target_group["TargetHealthDescriptions"]) == 0:
             tgs.append(target_group_arn)
 
-        if len(unused_target_groups[target_group_arn]["LoadBalancerArns"]) == 0:
+        if len(target_group["LoadBalancerArns"]) == 0:
             tgs.append(target_group_arn)
 
     return tgs
 
 
-def scan_for_lbs_no_targets(session, region, omit_pricing=False):
-    elb_client = session.client("elbv2")
-
-    print("getting hourly costs of load balancers...")
-
-    if not omit_pricing:
+@traced("scan")
+@timed
+def scan_for_lbs_no_targets(
+    session,
+    region,
+    omit_pricing=False,
+    idle_days=None,
+    hourly_costs=None,
+    tag_filter=None,
+    graph=None,
+):
+    if not omit_pricing and hourly_costs is None:
+        report("getting hourly costs of load balancers...")
         hourly_costs = get_lb_hourly_costs(session)
 
-    response = elb_client.describe_load_balancers()
+    graph = get_graph(session, graph, ["load_balancers", "target_groups"])
+    load_balancers = [
+        graph.data(lb_arn)
+        for lb_arn in graph.of_type(LOAD_BALANCER)
+        if tag_filter is None or tag_filter(lb_arn)
+    ]
 
-    if len(response["LoadBalancers"]) == 0:
-        print(f"No load balancers found in region {region}")
+    if len(load_balancers) == 0:
+        report(f"No load balancers found in region {region}")
         return {"total_monthly_cost": 0}
 
+    idle_lbs = set()
+    if idle_days:
+        report(f"getting load balancers without traffic for {idle_days} days...")
+        idle_lbs = set(get_idle_lbs(session, load_balancers, idle_days))
+
     lbs = {}
 
-    for lb in tqdm(response["LoadBalancers"]):
+    for lb in progress_bar(load_balancers):
         lb_arn = lb["LoadBalancerArn"]
 
-        if not omit_pricing:
-            lb_cost_value = (
-                float(list(hourly_costs[lb["Type"]][region].values())[0]) * 730
-            )
-        else:
-            lb_cost_value = 0
+        lb_cost_value = get_lb_monthly_cost(hourly_costs, lb["Type"], region)
 
         lb_target_groups = {
-            tg["TargetGroupArn"]: elb_client.describe_target_health(
-                TargetGroupArn=tg["TargetGroupArn"]
-            )
-            for tg in elb_client.describe_target_groups(LoadBalancerArn=lb_arn)[
-                "TargetGroups"
-            ]
+            tg_arn: graph.data(tg_arn)
+            for tg_arn in graph.neighbors(lb_arn, TARGET_GROUP)
         }
 
         for lb_target_group_arn in lb_target_groups:
@@ -261,6 +594,24 @@ def scan_for_lbs_no_targets(session, region, omit_pricing=False):
                 else:
                     lbs[lb_arn]["empty_target_groups"].append(lb_target_group_arn)
 
+        if lb_arn in idle_lbs:
+            # targets are registered but the load balancer has served no traffic,
+            # so its populated target groups are deleted along with it
+            if lb_arn not in lbs:
+                lbs[lb_arn] = {
+                    "monthly_cost": lb_cost_value,
+                    "empty_target_groups": [],
+                }
+            lbs[lb_arn]["idle_target_groups"] = [
+                lb_target_group_arn
+                for lb_target_group_arn in lb_target_groups
+                if len(
+                    lb_target_groups[lb_target_group_arn]["TargetHealthDescriptions"]
+                )
+                != 0
+            ]
+            continue
+
         if lb_arn in lbs:
             for lb_target_group_arn in lb_target_groups:
                 if (
@@ -283,8 +634,16 @@ def scan_for_lbs_no_targets(session, region, omit_pricing=False):
     return lbs
 
 
-def scan_for_unused_ebs_volumes(session):
-    client = session.client("ec2")
+def get_ebs_volumes(client, **kwargs):
+    paginator = client.get_paginator("describe_volumes")
+    for page in paginator.paginate(**kwargs):
+        yield from page["Volumes"]
+
+
+@traced("scan")
+@timed
+def scan_for_unused_ebs_volumes(session, idle_days=None, tag_filter=None, graph=None):
+    graph = get_graph(session, graph, ["volumes"])
 
     cost_per_gb_map = {
         "gp3": 0.08,
@@ -296,26 +655,98 @@ def scan_for_unused_ebs_volumes(session):
         "standard": 0.05,
     }
 
-    volumes = client.describe_volumes()["Volumes"]
+    volumes = [
+        graph.data(volume_id)
+        for volume_id in graph.of_type(VOLUME)
+        if tag_filter is None or tag_filter(volume_id)
+    ]
+
+    idle_volume_ids = set()
+    if idle_days:
+        report(f"getting attached ebs volumes without i/o for {idle_days} days...")
+        idle_volume_ids = set(
+            get_idle_ebs_volumes(
+                session,
+                [
+                    volume["VolumeId"]
+                    for volume in volumes
+                    if volume["State"] == "in-use"
+                ],
+                idle_days,
+            )
+        )
+
+    report("getting unused ebs volumes...")
+    # attached idle volumes cannot be deleted, so they are reported apart from the
+    # unattached ones and their cost is not part of the total
+    unused_volumes = {"volumes": [], "idle_volumes": []}
+    for volume in progress_bar(volumes):
+        if volume["State"] == "available":
+            group = unused_volumes["volumes"]
+        elif volume["VolumeId"] in idle_volume_ids:
+            group = unused_volumes["idle_volumes"]
+        else:
+            continue
 
-    print("getting unused ebs volumes...")
-    unused_volumes = {
-        "volumes": [
+        group.append(
             {
                 "VolumeId": volume["VolumeId"],
                 "Size": volume["Size"],
                 "CreateTime": str(volume["CreateTime"]),
                 "MultiAttachEnabled": volume["MultiAttachEnabled"],
-                "Attachments": volume["Attachments"],
+                "Attachments": [
+                    {**attachment, "AttachTime": str(attachment["AttachTime"])}
+                    for attachment in volume["Attachments"]
+                ],
                 "MonthlyCost": volume["Size"] * cost_per_gb_map[volume["VolumeType"]],
             }
-            for volume in tqdm(volumes)
-            if volume["State"] == "available"
-        ]
-    }
+        )
 
     unused_volumes["total_monthly_cost"] = sum(
         [volume["MonthlyCost"] for volume in unused_volumes["volumes"]]
     )
+    unused_volumes["idle_monthly_cost"] = sum(
+        [volume["MonthlyCost"] for volume in unused_volumes["idle_volumes"]]
+    )
 
     return unused_volumes
+
+
+@traced("scan")
+@timed
+def get_orphaned_snapshots(session, tag_filter=None, graph=None):
+    graph = get_graph(session, graph, ["volumes", "snapshots"])
+
+    report("getting snapshots of deleted volumes...")
+    orphaned_snapshots = {}
+    for snapshot_id in graph.of_type(SNAPSHOT):
+        snapshot = graph.data(snapshot_id)
+        volume_id = snapshot.get("VolumeId")
+        if volume_id in graph.nodes:
+            continue
+
+        if tag_filter is not None and not tag_filter(snapshot_id):
+            continue
+
+        # copies are grouped on their own rather than as one deleted volume
+        group_id = snapshot_id if volume_id == COPIED_SNAPSHOT_VOLUME_ID else volume_id
+        if group_id not in orphaned_snapshots:
+            orphaned_snapshots[group_id] = {
+                "snapshots": [],
+                "total_size": 0,
+                "monthly_cost": 0,
+            }
+
+        group = orphaned_snapshots[group_id]
+        group["snapshots"].append(snapshot_id)
+        group["total_size"] += snapshot["VolumeSize"]
+        group["monthly_cost"] += snapshot["VolumeSize"] * SNAPSHOT_PRICE_PER_GB_MONTH
+
+    orphaned_snapshots["total_monthly_cost"] = sum(
+        [
+            orphaned_snapshots[group_id]["monthly_cost"]
+            for group_id in orphaned_snapshots
+        ]
+    )
+
+    return orphaned_snapshots
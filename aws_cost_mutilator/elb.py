@@ -0,0 +1,179 @@
+from botocore.config import Config
+from threading import Lock
+from time import monotonic, sleep
+from .progress import progress_bar, report, ContextThreadPoolExecutor
+from .ec2 import get_lb_hourly_costs, get_lb_monthly_cost
+from .journal import journaled
+from .metrics import timed
+from .trace import traced
+
+# DescribeInstanceHealth calls per second per region, well under the ELB API limit
+INSTANCE_HEALTH_RATE = 10
+
+
+class RateLimiter:
+    # Spaces calls from any number of threads at least 1 / rate seconds apart
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_call = monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            sleep(delay)
+
+
+def get_clb_arn(region, account_id, name):
+    return f"arn:aws:elasticloadbalancing:{region}:{account_id}:loadbalancer/{name}"
+
+
+def get_regional_clients(session, regions, max_workers):
+    # boto3 sessions are not thread safe, clients are created before fanning out
+    config = Config(max_pool_connections=max_workers)
+    return {
+        region: session.client("elb", region_name=region, config=config)
+        for region in regions
+    }
+
+
+def get_clbs(elb_client):
+    paginator = elb_client.get_paginator("describe_load_balancers")
+    return [
+        lb
+        for page in paginator.paginate(PaginationConfig={"PageSize": 400})
+        for lb in page["LoadBalancerDescriptions"]
+    ]
+
+
+@traced("scan")
+@timed
+def scan_for_clbs_no_instances(
+    session,
+    regions=None,
+    omit_pricing=False,
+    hourly_costs=None,
+    tag_filter=None,
+    max_workers=8,
+    rate=INSTANCE_HEALTH_RATE,
+):
+    # Classic load balancers without any InService instance, in every region given.
+    # Regions are listed concurrently, then the instance health of every load
+    # balancer is looked up concurrently under a per region rate limit.
+    regions = regions or [session.region_name]
+    elb_clients = get_regional_clients(session, regions, max_workers)
+    account_id = session.client("sts").get_caller_identity()["Account"]
+
+    if not omit_pricing and hourly_costs is None:
+        report("getting hourly costs of load balancers...")
+        hourly_costs = get_lb_hourly_costs(session)
+
+    report(f"getting classic load balancers in {len(regions)} regions...")
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        regional_clbs = executor.map(
+            lambda region: get_clbs(elb_clients[region]), regions
+        )
+        clbs = [
+            (region, lb)
+            for region, lbs in zip(regions, regional_clbs)
+            for lb in lbs
+            if tag_filter is None
+            or tag_filter(
+                get_clb_arn(region, account_id, lb["LoadBalancerName"]), region
+            )
+        ]
+
+        limiters = {region: RateLimiter(rate) for region in regions}
+
+        def get_instance_health(region, lb):
+            limiters[region].wait()
+            return elb_clients[region].describe_instance_health(
+                LoadBalancerName=lb["LoadBalancerName"]
+            )["InstanceStates"]
+
+        report("getting instance health of classic load balancers...")
+        instance_states = list(
+            progress_bar(
+                executor.map(lambda clb: get_instance_health(*clb), clbs),
+                total=len(clbs),
+            )
+        )
+
+    lbs = {}
+    for (region, lb), states in zip(clbs, instance_states):
+        if any(state["State"] == "InService" for state in states):
+            continue
+
+        lbs[get_clb_arn(region, account_id, lb["LoadBalancerName"])] = {
+            "name": lb["LoadBalancerName"],
+            "region": region,
+            "monthly_cost": get_lb_monthly_cost(hourly_costs, "classic", region),
+            "instances": {state["InstanceId"]: state["State"] for state in states},
+        }
+
+    lbs["total_monthly_cost"] = sum([lbs[lb]["monthly_cost"] for lb in lbs])
+
+    return lbs
+
+
+@traced("delete", resource="lb_arn")
+def delete_clb(elb_client, lb_arn, lb, dry_run=False, journal=None):
+    if journal and journal.is_done("clb", lb_arn):
+        return
+
+    if not dry_run:
+        with journaled(journal, "clb", lb_arn):
+            elb_client.delete_load_balancer(LoadBalancerName=lb["name"])
+
+
+@traced("delete")
+def delete_clbs(session, lbs, dry_run=False, journal=None, max_workers=8):
+    # Classic load balancers are deleted concurrently across their regions, they
+    # have no target groups to clean up after them
+    elb_clients = get_regional_clients(
+        session, {lbs[lb_arn]["region"] for lb_arn in lbs}, max_workers
+    )
+
+    if journal:
+        journal.intend("clb", lbs)
+
+    summary = {"deleted_load_balancers": [], "failed_load_balancers": [], "errors": {}}
+    lock = Lock()
+    pbar = progress_bar(total=len(lbs))
+
+    def delete_clb_task(lb_arn):
+        lb = lbs[lb_arn]
+        try:
+            delete_clb(elb_clients[lb["region"]], lb_arn, lb, dry_run, journal)
+            result = "deleted_load_balancers"
+            pbar.write(f"deleted load balancer {lb_arn} (dry run: {dry_run})")
+        except Exception as e:
+            result = "failed_load_balancers"
+            pbar.write(f"Failed to delete load balancer {lb_arn} with error {e}")
+            with lock:
+                summary["errors"][lb_arn] = str(e)
+
+        with lock:
+            summary[result].append(lb_arn)
+        pbar.update()
+
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(delete_clb_task, lb_arn) for lb_arn in lbs]:
+            future.result()
+
+    pbar.close()
+
+    report(
+        f"Deleted {len(summary['deleted_load_balancers'])} classic load balancers (dry run: {dry_run})"
+    )
+    if summary["failed_load_balancers"]:
+        report(
+            f"Failed to delete {len(summary['failed_load_balancers'])} classic load balancers"
+        )
+
+    return summary
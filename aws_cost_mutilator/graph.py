@@ -0,0 +1,196 @@
+from botocore.config import Config
+from .progress import progress_bar, report, ContextThreadPoolExecutor
+from .trace import traced
+
+LOAD_BALANCER = "load_balancer"
+LISTENER = "listener"
+TARGET_GROUP = "target_group"
+TARGET = "target"
+INSTANCE = "instance"
+VOLUME = "volume"
+SNAPSHOT = "snapshot"
+IMAGE = "image"
+
+# Relation of an image to the snapshots of its block devices, which keeps them from
+# being deleted
+BLOCK_DEVICE = "block_device"
+
+# What each crawl describes, the scanners only crawl the kinds they query
+CRAWLS = (
+    "load_balancers",
+    "target_groups",
+    "volumes",
+    "snapshots",
+    "images",
+    "instances",
+)
+
+
+class ResourceGraph:
+    # Resources of a region keyed by id, with adjacency indexes in both directions
+    # so neighbors and referrers of a resource are found in O(degree)
+
+    def __init__(self, region=None, crawls=()):
+        self.region = region
+        # a kind missing from a graph is unknown, not absent
+        self.crawls = set(crawls)
+        self.nodes = {}
+        self.types = {}
+        self.edges = {}
+        self.referrers = {}
+
+    def add_node(self, node_type, node_id, data=None):
+        self.nodes[node_id] = {"type": node_type, "data": data or {}}
+        self.types.setdefault(node_type, {})[node_id] = None
+
+    def add_edge(self, source, relation, target):
+        self.edges.setdefault(source, {}).setdefault(relation, {})[target] = None
+        self.referrers.setdefault(target, {}).setdefault(relation, {})[source] = None
+
+    def of_type(self, node_type):
+        return list(self.types.get(node_type, {}))
+
+    def data(self, node_id):
+        return self.nodes[node_id]["data"]
+
+    def neighbors(self, node_id, relation):
+        return list(self.edges.get(node_id, {}).get(relation, {}))
+
+    def get_referrers(self, node_id, relation=None):
+        relations = self.referrers.get(node_id, {})
+        if relation is not None:
+            return list(relations.get(relation, {}))
+        return [source for sources in relations.values() for source in sources]
+
+    def is_referenced(self, node_id):
+        return any(self.referrers.get(node_id, {}).values())
+
+
+def paginate(client, operation, key, **kwargs):
+    items = []
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        items.extend(page[key])
+    return items
+
+
+def get_forwarded_target_groups(action):
+    if action.get("TargetGroupArn"):
+        return [action["TargetGroupArn"]]
+    return [
+        target_group["TargetGroupArn"]
+        for target_group in action.get("ForwardConfig", {}).get("TargetGroups", [])
+    ]
+
+
+@traced("scan")
+def build_resource_graph(session, crawls=CRAWLS, max_workers=16):
+    # One crawl of the region: the independent describe calls run concurrently, then
+    # the per load balancer listeners and per target group health lookups
+    config = Config(max_pool_connections=max_workers)
+    elb_client = session.client("elbv2", config=config)
+    ec2 = session.client("ec2", config=config)
+    graph = ResourceGraph(session.region_name, crawls)
+
+    describes = {
+        "load_balancers": lambda: paginate(
+            elb_client, "describe_load_balancers", "LoadBalancers"
+        ),
+        "target_groups": lambda: paginate(
+            elb_client, "describe_target_groups", "TargetGroups"
+        ),
+        "volumes": lambda: paginate(ec2, "describe_volumes", "Volumes"),
+        "snapshots": lambda: paginate(
+            ec2,
+            "describe_snapshots",
+            "Snapshots",
+            OwnerIds=["self"],
+            PaginationConfig={"PageSize": 1000},
+        ),
+        "images": lambda: paginate(ec2, "describe_images", "Images", Owners=["self"]),
+        "instances": lambda: [
+            instance
+            for reservation in paginate(ec2, "describe_instances", "Reservations")
+            for instance in reservation["Instances"]
+        ],
+    }
+
+    report("crawling resources...")
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {crawl: executor.submit(describes[crawl]) for crawl in crawls}
+        resources = {crawl: future.result() for crawl, future in futures.items()}
+
+        for instance in resources.get("instances", []):
+            graph.add_node(INSTANCE, instance["InstanceId"], instance)
+
+        for lb in resources.get("load_balancers", []):
+            graph.add_node(LOAD_BALANCER, lb["LoadBalancerArn"], lb)
+
+        for tg in resources.get("target_groups", []):
+            graph.add_node(TARGET_GROUP, tg["TargetGroupArn"], tg)
+            for lb_arn in tg["LoadBalancerArns"]:
+                graph.add_edge(lb_arn, TARGET_GROUP, tg["TargetGroupArn"])
+
+        listeners = executor.map(
+            lambda lb_arn: paginate(
+                elb_client, "describe_listeners", "Listeners", LoadBalancerArn=lb_arn
+            ),
+            graph.of_type(LOAD_BALANCER),
+        )
+        target_health = executor.map(
+            lambda tg_arn: elb_client.describe_target_health(TargetGroupArn=tg_arn)[
+                "TargetHealthDescriptions"
+            ],
+            graph.of_type(TARGET_GROUP),
+        )
+
+        for lb_listeners in listeners:
+            for listener in lb_listeners:
+                graph.add_node(LISTENER, listener["ListenerArn"], listener)
+                graph.add_edge(
+                    listener["LoadBalancerArn"], LISTENER, listener["ListenerArn"]
+                )
+                for action in listener["DefaultActions"]:
+                    for tg_arn in get_forwarded_target_groups(action):
+                        graph.add_edge(listener["ListenerArn"], TARGET_GROUP, tg_arn)
+
+        tg_arns = graph.of_type(TARGET_GROUP)
+        for tg_arn, descriptions in progress_bar(
+            zip(tg_arns, target_health), total=len(tg_arns)
+        ):
+            graph.data(tg_arn)["TargetHealthDescriptions"] = descriptions
+            for description in descriptions:
+                target_id = description["Target"]["Id"]
+                if target_id not in graph.nodes:
+                    graph.add_node(TARGET, target_id)
+                graph.add_edge(tg_arn, TARGET, target_id)
+
+    for volume in resources.get("volumes", []):
+        graph.add_node(VOLUME, volume["VolumeId"], volume)
+        for attachment in volume["Attachments"]:
+            graph.add_edge(attachment["InstanceId"], VOLUME, volume["VolumeId"])
+
+    for snapshot in resources.get("snapshots", []):
+        graph.add_node(SNAPSHOT, snapshot["SnapshotId"], snapshot)
+        if snapshot.get("VolumeId"):
+            graph.add_edge(snapshot["VolumeId"], SNAPSHOT, snapshot["SnapshotId"])
+
+    for image in resources.get("images", []):
+        graph.add_node(IMAGE, image["ImageId"], image)
+        for mapping in image.get("BlockDeviceMappings", []):
+            if mapping.get("Ebs", {}).get("SnapshotId"):
+                graph.add_edge(
+                    image["ImageId"], BLOCK_DEVICE, mapping["Ebs"]["SnapshotId"]
+                )
+
+    return graph
+
+
+def get_graph(session, graph, crawls):
+    # scanners use the graph they are given, or crawl just what they query
+    if graph is not None:
+        missing = set(crawls) - graph.crawls
+        if missing:
+            raise ValueError(f"The resource graph lacks the {sorted(missing)} crawls")
+        return graph
+
+    return build_resource_graph(session, crawls)
@@ -1,7 +1,14 @@
 from datetime import datetime, timedelta, timezone
+from .metrics import timed
+from .trace import traced
 
 
-def get_unused_iam_roles(session, days):
+@traced("scan")
+@timed
+def get_unused_iam_roles(session, days, last_used=None):
+    # last_used maps role ARNs to their last event time read from CloudTrail log
+    # files, without it the last event of every role is looked up in the 90 days
+    # of event history
     iam = session.client("iam")
     cloudtrail = session.client("cloudtrail")
     unused_roles = []
@@ -14,6 +21,13 @@ def get_unused_iam_roles(session, days):
             if role["Path"].startswith("/aws-service-role/"):
                 continue
 
+            if last_used is not None:
+                if role["Arn"] not in last_used or datetime.fromisoformat(
+                    last_used[role["Arn"]].replace("Z", "+00:00")
+                ) < datetime.now(timezone.utc) - timedelta(days=days):
+                    unused_roles.append(role["RoleName"])
+                continue
+
             events = cloudtrail.lookup_events(
                 LookupAttributes=[
                     {"AttributeKey": "ResourceName", "AttributeValue": role["RoleName"]}
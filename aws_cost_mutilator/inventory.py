@@ -0,0 +1,281 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from boto3 import Session
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, UTC
+from pathlib import Path
+from .progress import progress_bar
+from .s3 import merge_bucket_stats
+from .metrics import timed
+
+# Field names of the default CSV inventory schema, used for CSV files read without a
+# manifest
+DEFAULT_CSV_SCHEMA = "Bucket, Key, Size, LastModifiedDate, StorageClass"
+
+# ORC and Parquet inventory files use lower case column names
+COLUMNS = {
+    "Bucket": "bucket",
+    "Size": "size",
+    "LastModifiedDate": "last_modified_date",
+    "StorageClass": "storage_class",
+    "IsDeleteMarker": "is_delete_marker",
+}
+
+
+def import_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise RuntimeError(
+            "Reading ORC and Parquet inventory files requires pyarrow, install it with: pip install pyarrow"
+        )
+
+
+def get_file_format(path):
+    name = path.lower().removesuffix(".gz")
+    if name.endswith(".orc"):
+        return "ORC"
+    if name.endswith(".parquet"):
+        return "Parquet"
+    return "CSV"
+
+
+def parse_s3_uri(uri):
+    bucket, _, key = uri.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def load_manifest(session, manifest):
+    if manifest.startswith("s3://"):
+        bucket, key = parse_s3_uri(manifest)
+        body = session.client("s3").get_object(Bucket=bucket, Key=key)["Body"]
+        data = json.load(body)
+        destination = data["destinationBucket"].split(":::")[-1]
+        data["paths"] = [f"s3://{destination}/{file['key']}" for file in data["files"]]
+    else:
+        with open(manifest) as f:
+            data = json.load(f)
+        data["paths"] = [
+            resolve_local_file(manifest, file["key"]) for file in data["files"]
+        ]
+
+    return data
+
+
+def resolve_local_file(manifest, key):
+    # Inventory files are referenced by their key in the destination bucket, a local
+    # sync of that bucket has them below one of the manifest's parent directories
+    for parent in Path(manifest).resolve().parents:
+        path = parent / key
+        if path.exists():
+            return str(path)
+
+    return str(Path(manifest).parent / "data" / Path(key).name)
+
+
+def get_manifest_files(manifest):
+    return [
+        (path, manifest["fileFormat"], manifest["fileSchema"])
+        for path in manifest["paths"]
+    ]
+
+
+def get_inventory_files(session, sources, schema=DEFAULT_CSV_SCHEMA):
+    # Returns (path, file_format, schema) for every inventory file of the sources,
+    # which are manifests, inventory files or local directories holding either
+    inventory_files = []
+    for source in sources:
+        if source.endswith("manifest.json"):
+            inventory_files.extend(get_manifest_files(load_manifest(session, source)))
+        elif os.path.isdir(source):
+            manifests = {}
+            data_files = []
+            for root, _, names in os.walk(source):
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    if name.endswith("manifest.json"):
+                        manifest = load_manifest(session, path)
+                        # a synced destination bucket holds one manifest per day,
+                        # only the newest of each source bucket is read
+                        bucket = manifest["sourceBucket"]
+                        if bucket not in manifests or int(
+                            manifest["creationTimestamp"]
+                        ) > int(manifests[bucket]["creationTimestamp"]):
+                            manifests[bucket] = manifest
+                    elif get_file_format(name) != "CSV" or ".csv" in name:
+                        data_files.append((path, get_file_format(name), schema))
+
+            if manifests:
+                for manifest in manifests.values():
+                    inventory_files.extend(get_manifest_files(manifest))
+            else:
+                inventory_files.extend(data_files)
+        else:
+            inventory_files.append((source, get_file_format(source), schema))
+
+    return inventory_files
+
+
+# Profile and S3 client of a worker process, the client is created by the first
+# remote file the worker reads and shared by all the files after it
+worker = {"profile": None, "s3": None}
+
+
+def init_worker(profile=None):
+    worker["profile"] = profile
+    worker["s3"] = None
+
+
+def get_worker_s3():
+    if worker["s3"] is None:
+        worker["s3"] = Session(profile_name=worker["profile"]).client("s3")
+
+    return worker["s3"]
+
+
+def open_inventory_file(path):
+    if path.startswith("s3://"):
+        bucket, key = parse_s3_uri(path)
+        return get_worker_s3().get_object(Bucket=bucket, Key=key)["Body"]
+
+    return open(path, "rb")
+
+
+def add_row(stats, bucket, size, last_modified, storage_class, is_delete_marker):
+    if is_delete_marker or bucket is None:
+        return
+
+    if bucket not in stats:
+        stats[bucket] = {"size": {}, "count": 0, "last_modified": None}
+
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=UTC)
+
+    bucket_stats = stats[bucket]
+    storage_class = storage_class or "STANDARD"
+    bucket_stats["size"][storage_class] = bucket_stats["size"].get(
+        storage_class, 0
+    ) + int(size or 0)
+    bucket_stats["count"] += 1
+    if last_modified is not None and (
+        bucket_stats["last_modified"] is None
+        or last_modified > bucket_stats["last_modified"]
+    ):
+        bucket_stats["last_modified"] = last_modified
+
+
+def read_csv_inventory(f, schema, stats, compressed=True):
+    fields = [field.strip() for field in schema.split(",")]
+    index = {field: fields.index(field) for field in fields}
+
+    def column(row, field):
+        return row[index[field]] if field in index else None
+
+    if compressed:
+        f = gzip.GzipFile(fileobj=f)
+
+    text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+    for row in csv.reader(text):
+        last_modified = column(row, "LastModifiedDate")
+        add_row(
+            stats,
+            column(row, "Bucket"),
+            column(row, "Size"),
+            datetime.fromisoformat(last_modified) if last_modified else None,
+            column(row, "StorageClass"),
+            column(row, "IsDeleteMarker") == "true",
+        )
+
+
+def read_columnar_inventory(batches, stats):
+    for batch in batches:
+        columns = {
+            field: (
+                batch.column(column).to_pylist()
+                if column in batch.schema.names
+                else [None] * batch.num_rows
+            )
+            for field, column in COLUMNS.items()
+        }
+        for row in zip(
+            columns["Bucket"],
+            columns["Size"],
+            columns["LastModifiedDate"],
+            columns["StorageClass"],
+            columns["IsDeleteMarker"],
+        ):
+            add_row(stats, *row)
+
+
+def read_inventory_file(path, file_format, schema):
+    stats = {}
+
+    with open_inventory_file(path) as f:
+        if file_format == "CSV":
+            read_csv_inventory(f, schema, stats, path.endswith(".gz"))
+            return stats
+
+        import_pyarrow()
+
+        # ORC and Parquet need random access, so remote files are spooled to disk
+        with tempfile.TemporaryFile() as spool:
+            if path.startswith("s3://"):
+                for chunk in f.iter_chunks(1024**2):
+                    spool.write(chunk)
+                spool.seek(0)
+                f = spool
+
+            columns = list(COLUMNS.values())
+            if file_format == "Parquet":
+                import pyarrow.parquet
+
+                parquet_file = pyarrow.parquet.ParquetFile(f)
+                batches = parquet_file.iter_batches(
+                    columns=[
+                        column
+                        for column in columns
+                        if column in parquet_file.schema_arrow.names
+                    ]
+                )
+            else:
+                import pyarrow.orc
+
+                orc_file = pyarrow.orc.ORCFile(f)
+                batches = (
+                    orc_file.read_stripe(stripe) for stripe in range(orc_file.nstripes)
+                )
+
+            read_columnar_inventory(batches, stats)
+
+    return stats
+
+
+@timed
+def get_inventory_stats(session, sources, schema=DEFAULT_CSV_SCHEMA, max_workers=None):
+    # Reads the inventory files of the sources on a process pool and returns the
+    # get_bucket_stats result of every bucket they cover
+    inventory_files = get_inventory_files(session, sources, schema)
+
+    stats = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_worker,
+        initargs=(session.profile_name,),
+    ) as executor:
+        futures = [
+            executor.submit(read_inventory_file, path, file_format, file_schema)
+            for path, file_format, file_schema in inventory_files
+        ]
+        for future in progress_bar(
+            as_completed(futures), total=len(futures), unit="file"
+        ):
+            for bucket, bucket_stats in future.result().items():
+                if bucket not in stats:
+                    stats[bucket] = {"size": {}, "count": 0, "last_modified": None}
+                merge_bucket_stats(stats[bucket], bucket_stats)
+
+    return stats
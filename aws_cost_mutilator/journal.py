@@ -0,0 +1,136 @@
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from threading import Lock
+
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".acm", "journals")
+
+INTENDED = "intended"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+
+def get_journal_path(command, profile, region):
+    return os.path.join(JOURNAL_DIR, f"{command}-{profile}-{region}.jsonl")
+
+
+def make_entry(kind, resource_id, state, data=None):
+    entry = {
+        "time": datetime.now(UTC).isoformat(),
+        "kind": kind,
+        "id": resource_id,
+        "state": state,
+    }
+    if data is not None:
+        entry["data"] = data
+
+    return entry
+
+
+@contextmanager
+def journaled(journal, kind, resource_id):
+    # records a delete call as in flight, then as done or failed
+    if journal is None:
+        yield
+        return
+
+    journal.record(kind, resource_id, IN_FLIGHT)
+    try:
+        yield
+    except Exception:
+        journal.record(kind, resource_id, FAILED)
+        raise
+    journal.record(kind, resource_id, DONE)
+
+
+class Journal:
+    # Append-only record of a cleanup. Every resource is recorded as intended when
+    # the cleanup is confirmed, then in_flight before its delete call and done or
+    # failed after it, so an interrupted cleanup can be resumed from the file.
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.states = {}
+        self.data = {}
+        self.lock = Lock()
+
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except json.JSONDecodeError:
+                        # the last line is torn if the process died mid-write
+                        continue
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a" if resume else "w")
+
+    def apply(self, entry):
+        key = (entry["kind"], entry["id"])
+        self.states[key] = entry["state"]
+        if "data" in entry:
+            self.data[key] = entry["data"]
+
+    def write(self, entries):
+        # the entries are synced to disk together, before any of them is applied
+        with self.lock:
+            for entry in entries:
+                self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            for entry in entries:
+                self.apply(entry)
+
+    def record(self, kind, resource_id, state, data=None):
+        self.write([make_entry(kind, resource_id, state, data)])
+
+    def intend(self, kind, resources):
+        # resources is a list of ids or a dict of ids to the data needed to delete
+        # them, the whole plan is synced at once
+        entries = [
+            make_entry(
+                kind,
+                resource_id,
+                INTENDED,
+                resources[resource_id] if isinstance(resources, dict) else None,
+            )
+            for resource_id in resources
+            if (kind, resource_id) not in self.states
+        ]
+        if entries:
+            self.write(entries)
+
+    def state(self, kind, resource_id):
+        return self.states.get((kind, resource_id))
+
+    def is_done(self, kind, resource_id):
+        return self.state(kind, resource_id) == DONE
+
+    def plan(self, kind):
+        # every resource of this kind in the order it was intended, with its data
+        return {
+            resource_id: self.data.get((entry_kind, resource_id))
+            for entry_kind, resource_id in self.states
+            if entry_kind == kind
+        }
+
+    def in_flight(self):
+        in_flight = {}
+        for (kind, resource_id), state in self.states.items():
+            if state == IN_FLIGHT:
+                in_flight.setdefault(kind, []).append(resource_id)
+
+        return in_flight
+
+    def summary(self):
+        summary = {}
+        for state in self.states.values():
+            summary[state] = summary.get(state, 0) + 1
+
+        return summary
+
+    def close(self):
+        self.file.close()
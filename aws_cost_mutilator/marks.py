@@ -0,0 +1,246 @@
+import random
+from dataclasses import replace
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, UTC
+from threading import Lock
+from time import sleep
+from .progress import progress_bar, report, ContextThreadPoolExecutor
+from .s3 import get_bucket_region
+from .tags import get_resource_id, RESOURCE_TYPE_FILTERS
+from .trace import traced
+
+# Tag marking a resource for deletion, its value is when it was marked
+MARK_TAG_KEY = "acm:marked-for-deletion"
+
+# TagResources accepts at most 20 ARNs per request
+TAG_RESOURCES_BATCH_SIZE = 20
+
+# Resources a batch failed to tag are retried with exponential backoff, unless the
+# request was invalid
+MARK_MAX_ATTEMPTS = 5
+MARK_BASE_DELAY = 1
+PERMANENT_ERROR_CODES = {"InvalidParameterException"}
+
+
+def format_mark_time(time):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_mark_time(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=UTC)
+
+
+def get_finding_arns(finding, account_id):
+    # ARNs of the resources a finding would delete, the tagging API only takes ARNs
+    region = finding.region
+    if finding.check in ("lbs", "tgs", "clb"):
+        return [finding.resource_id]
+    if finding.check == "ebs":
+        return [f"arn:aws:ec2:{region}:{account_id}:volume/{finding.resource_id}"]
+    if finding.check == "ebssnap":
+        return [f"arn:aws:ec2:{region}:{account_id}:snapshot/{finding.resource_id}"]
+    if finding.check == "orphansnap":
+        return [
+            f"arn:aws:ec2:{region}:{account_id}:snapshot/{snapshot_id}"
+            for snapshot_id in finding.details["snapshots"]
+        ]
+    if finding.check == "s3":
+        return [f"arn:aws:s3:::{finding.resource_id}"]
+
+    raise ValueError(f"{finding.check} findings cannot be marked")
+
+
+def get_bucket_regions(session, findings):
+    # Bucket ARNs have no region, but buckets are tagged and found by the tagging API
+    # of the region they are in. Buckets whose region cannot be told are left out.
+    s3 = session.client("s3")
+    bucket_regions = {}
+    for finding in findings:
+        if finding.check == "s3":
+            try:
+                bucket_regions[finding.resource_id] = get_bucket_region(
+                    s3, finding.resource_id
+                )
+            except ClientError as e:
+                report(f"cannot get the region of bucket {finding.resource_id}: {e}")
+
+    return bucket_regions
+
+
+def get_arn_region(arn, default_region, bucket_regions=None):
+    if ":s3:::" in arn:
+        return (bucket_regions or {}).get(get_resource_id(arn))
+    return arn.split(":")[3] or default_region
+
+
+def get_finding_regions(findings, default_region, bucket_regions):
+    # regions whose marks tell which of the findings are due
+    regions = {
+        finding.region or default_region
+        for finding in findings
+        if finding.check != "s3"
+    }
+    return sorted(regions | set(bucket_regions.values()))
+
+
+def tag_batch(client, arns, tags):
+    # The API reports failures per resource instead of failing the call, only the
+    # resources that failed for a reason other than an invalid request are retried
+    failed = {}
+    pending = list(arns)
+    for attempt in range(MARK_MAX_ATTEMPTS):
+        if attempt > 0:
+            sleep(random.uniform(0, MARK_BASE_DELAY * 2**attempt))
+
+        try:
+            response = client.tag_resources(ResourceARNList=pending, Tags=tags)
+            failures = response.get("FailedResourcesMap", {})
+        except ClientError as e:
+            failures = {
+                arn: {
+                    "ErrorCode": e.response["Error"].get("Code"),
+                    "ErrorMessage": str(e),
+                }
+                for arn in pending
+            }
+
+        for arn in pending:
+            if arn in failures:
+                failed[arn] = failures[arn].get("ErrorMessage")
+            else:
+                failed.pop(arn, None)
+
+        pending = [
+            arn
+            for arn, failure in failures.items()
+            if failure.get("ErrorCode") not in PERMANENT_ERROR_CODES
+        ]
+        if not pending:
+            break
+
+    return [arn for arn in arns if arn not in failed], failed
+
+
+def tag_batches(client, arns, tags, max_workers=8):
+    batches = [
+        arns[offset : offset + TAG_RESOURCES_BATCH_SIZE]
+        for offset in range(0, len(arns), TAG_RESOURCES_BATCH_SIZE)
+    ]
+    result = {"tagged": [], "failed": {}}
+    lock = Lock()
+    pbar = progress_bar(total=len(arns))
+
+    def tag_batch_task(batch):
+        tagged, failed = tag_batch(client, batch, tags)
+        with lock:
+            result["tagged"].extend(tagged)
+            result["failed"].update(failed)
+        pbar.update(len(batch))
+
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(tag_batch_task, batch) for batch in batches]:
+            future.result()
+
+    pbar.close()
+
+    return result
+
+
+def get_marked_resources(session, regions=None):
+    # Marked resources of the regions from one GetResources crawl per region, keyed
+    # by the id the scanners use for them, with the time they were marked
+    marked = {}
+    for region in regions or [session.region_name]:
+        client = session.client("resourcegroupstaggingapi", region_name=region)
+        paginator = client.get_paginator("get_resources")
+        pages = paginator.paginate(
+            TagFilters=[{"Key": MARK_TAG_KEY}],
+            ResourceTypeFilters=RESOURCE_TYPE_FILTERS,
+            ResourcesPerPage=100,
+        )
+        for page in pages:
+            for mapping in page["ResourceTagMappingList"]:
+                tags = {tag["Key"]: tag["Value"] for tag in mapping["Tags"]}
+                try:
+                    marked_at = parse_mark_time(tags[MARK_TAG_KEY])
+                except ValueError:
+                    # a mark edited by hand is ignored rather than guessed at
+                    continue
+                marked[get_resource_id(mapping["ResourceARN"])] = marked_at
+
+    return marked
+
+
+@traced("delete")
+def mark_findings(
+    session, findings, marked, dry_run=False, max_workers=8, bucket_regions=None
+):
+    # Tags the resources of the findings with the time they were marked. Resources
+    # that are already marked keep their mark, so their grace period is not
+    # restarted.
+    account_id = session.client("sts").get_caller_identity()["Account"]
+    tags = {MARK_TAG_KEY: format_mark_time(datetime.now(UTC))}
+    if bucket_regions is None:
+        bucket_regions = get_bucket_regions(session, findings)
+
+    result = {"tagged": [], "failed": {}}
+    regions = {}
+    for finding in findings:
+        for arn in get_finding_arns(finding, account_id):
+            if get_resource_id(arn) in marked:
+                continue
+
+            region = get_arn_region(arn, session.region_name, bucket_regions)
+            if region is None:
+                result["failed"][arn] = "the region of the bucket is unknown"
+                continue
+
+            regions.setdefault(region, []).append(arn)
+    config = Config(max_pool_connections=max_workers)
+    for region, arns in regions.items():
+        report(f"marking {len(arns)} resources in {region} (dry run: {dry_run})...")
+        if dry_run:
+            result["tagged"].extend(arns)
+            continue
+
+        client = session.client(
+            "resourcegroupstaggingapi", region_name=region, config=config
+        )
+        region_result = tag_batches(client, arns, tags, max_workers)
+        result["tagged"].extend(region_result["tagged"])
+        result["failed"].update(region_result["failed"])
+
+    return result
+
+
+def is_due(marked, resource_id, cutoff):
+    return resource_id in marked and marked[resource_id] <= cutoff
+
+
+def get_due_findings(findings, marked, older_than, account_id):
+    # Findings whose resources were all marked at least older_than days ago. Groups
+    # of snapshots of a deleted volume keep only their due snapshots.
+    cutoff = datetime.now(UTC) - timedelta(days=older_than)
+
+    due = []
+    for finding in findings:
+        if finding.check == "orphansnap":
+            snapshot_ids = [
+                snapshot_id
+                for snapshot_id in finding.details["snapshots"]
+                if is_due(marked, snapshot_id, cutoff)
+            ]
+            if snapshot_ids:
+                due.append(
+                    replace(
+                        finding, details={**finding.details, "snapshots": snapshot_ids}
+                    )
+                )
+        elif all(
+            is_due(marked, get_resource_id(arn), cutoff)
+            for arn in get_finding_arns(finding, account_id)
+        ):
+            due.append(finding)
+
+    return due
@@ -0,0 +1,140 @@
+import copy
+import json
+from collections import OrderedDict
+from threading import Lock
+from botocore.awsrequest import AWSResponse
+
+# Responses kept per run, least recently used ones are dropped first
+MAX_ENTRIES = 512
+
+# Operations that only read, every other operation may change what they return
+READ_PREFIXES = ("Describe", "List", "Get", "Head")
+
+# Parameters naming the resources a call reads or changes, e.g. LoadBalancerArns,
+# VolumeId, Bucket or the Values of a volume-id filter
+RESOURCE_PARAM_SUFFIXES = (
+    "Arn",
+    "Arns",
+    "ARN",
+    "ARNList",
+    "Id",
+    "Ids",
+    "Name",
+    "Names",
+    "Bucket",
+    "Values",
+)
+
+
+def get_resource_ids(params):
+    resource_ids = set()
+    for key, value in params.items():
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            if isinstance(item, dict):
+                resource_ids |= get_resource_ids(item)
+            elif isinstance(item, str) and key.endswith(RESOURCE_PARAM_SUFFIXES):
+                resource_ids.add(item)
+
+    return resource_ids
+
+
+def is_read(model):
+    return model.name.startswith(READ_PREFIXES) and not model.has_streaming_output
+
+
+class ResponseMemo:
+    # Serves repeated read calls of a run from memory instead of calling AWS again.
+    # A call that changes resources drops the responses of the same service that
+    # name them or that name nothing, i.e. listings, and marks the resources dirty.
+    # Reads of dirty resources are never served or kept, so waiters polling them
+    # always see AWS.
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.dirty = set()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def attach(self, session):
+        # Registered before a cassette player so served calls do not use up its
+        # responses. botocore still fires after-call for them, so the metrics,
+        # trace and cassette recorder hooks skip calls marked acm_memo_hit and the
+        # metrics count them as cache hits.
+        session.events.register("provide-client-params", self.provide_params)
+        session.events.register("before-call", self.before_call)
+        session.events.register("after-call", self.after_call)
+
+    def provide_params(self, params, context, **kwargs):
+        context["acm_memo_params"] = params
+
+    def get_key(self, model, context):
+        return json.dumps(
+            [
+                model.service_model.service_name,
+                context.get("client_region"),
+                model.name,
+                context.get("acm_memo_params", {}),
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+    def invalidate(self, service_name, resource_ids):
+        with self.lock:
+            self.generation += 1
+            self.dirty |= resource_ids
+            for key, entry in list(self.entries.items()):
+                if entry["service"] == service_name and (
+                    not entry["resource_ids"] or entry["resource_ids"] & resource_ids
+                ):
+                    del self.entries[key]
+
+    def before_call(self, model, context, **kwargs):
+        resource_ids = get_resource_ids(context.get("acm_memo_params", {}))
+        if not is_read(model):
+            self.invalidate(model.service_model.service_name, resource_ids)
+            return None
+
+        key = self.get_key(model, context)
+        with self.lock:
+            if resource_ids & self.dirty:
+                return None
+
+            context["acm_memo_key"] = key
+            context["acm_memo_generation"] = self.generation
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            parsed = self.entries[key]["parsed"]
+
+        context["acm_memo_hit"] = True
+        # callers may modify responses, e.g. the load balancer scan does
+        return AWSResponse(None, 200, {}, None), copy.deepcopy(parsed)
+
+    def after_call(self, model, context, http_response, parsed, **kwargs):
+        if context.get("acm_memo_hit") or "acm_memo_key" not in context:
+            return
+        if http_response.status_code != 200:
+            return
+
+        parsed = copy.deepcopy(parsed)
+        with self.lock:
+            # a response read while resources changed may already be stale
+            if context["acm_memo_generation"] != self.generation:
+                return
+
+            self.entries[context["acm_memo_key"]] = {
+                "service": model.service_model.service_name,
+                "resource_ids": get_resource_ids(context.get("acm_memo_params", {})),
+                "parsed": parsed,
+            }
+            self.entries.move_to_end(context["acm_memo_key"])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
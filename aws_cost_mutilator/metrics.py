@@ -0,0 +1,235 @@
+import os
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from urllib.request import Request, urlopen
+
+# Histogram buckets in seconds, API calls are fast while scanners can take an hour
+API_CALL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SCAN_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+THROTTLE_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+    "PriorRequestNotComplete",
+}
+
+# List keys of describe/list responses counted as scanned resources
+RESOURCE_KEYS = (
+    "LoadBalancers",
+    "TargetGroups",
+    "TargetHealthDescriptions",
+    "Volumes",
+    "Snapshots",
+    "Buckets",
+    "Contents",
+    "Versions",
+    "Roles",
+    "ResourceTagMappingList",
+)
+
+HELP = {
+    "acm_scanner_duration_seconds": "Time spent in each scanner",
+    "acm_api_call_duration_seconds": "Latency of AWS API calls, including retries",
+    "acm_api_throttles": "AWS API calls that were throttled",
+    "acm_api_cache_hits": "AWS API calls served from the memo of the run",
+    "acm_resources_scanned": "Resources returned by describe and list calls",
+    "acm_resources_flagged": "Resources flagged by the last check",
+    "acm_potential_savings_dollars": "Monthly savings of deleting the flagged resources",
+    "acm_realized_savings_dollars": "Monthly savings of the resources deleted",
+}
+
+# The registry of the current run, scanners are only timed while one is set
+registry = None
+
+
+class Registry:
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.metrics = {}
+        self.lock = Lock()
+
+    def get(self, name, metric_type, labels):
+        key = tuple(sorted({**self.labels, **labels}.items()))
+        if name not in self.metrics:
+            self.metrics[name] = (metric_type, {})
+        return self.metrics[name][1], key
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            samples, key = self.get(name, "counter", labels)
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            samples, key = self.get(name, "gauge", labels)
+            samples[key] = value
+
+    def observe(self, name, value, buckets, **labels):
+        with self.lock:
+            samples, key = self.get(name, "histogram", labels)
+            if key not in samples:
+                samples[key] = {"buckets": [0] * len(buckets), "sum": 0, "count": 0}
+            histogram = samples[key]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+            histogram["bounds"] = buckets
+
+    def render(self, openmetrics=True):
+        # OpenMetrics text, or the Prometheus 0.0.4 text format that push gateways
+        # accept, which names counters with their _total suffix in TYPE lines
+        lines = []
+        with self.lock:
+            for name, (metric_type, samples) in sorted(self.metrics.items()):
+                family = (
+                    name if openmetrics or metric_type != "counter" else f"{name}_total"
+                )
+                lines.append(f"# TYPE {family} {metric_type}")
+                if name in HELP:
+                    lines.append(f"# HELP {family} {HELP[name]}")
+                for key, value in sorted(samples.items()):
+                    if metric_type == "counter":
+                        lines.append(f"{name}_total{format_labels(key)} {value}")
+                    elif metric_type == "gauge":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                    else:
+                        # bucket counts are cumulative, observe counts every bound
+                        # the value falls under
+                        bounds = [str(bound) for bound in value["bounds"]] + ["+Inf"]
+                        counts = value["buckets"] + [value["count"]]
+                        for bound, count in zip(bounds, counts):
+                            bucket_key = key + (("le", bound),)
+                            lines.append(
+                                f"{name}_bucket{format_labels(bucket_key)} {count}"
+                            )
+                        labels = format_labels(key)
+                        lines.append(f"{name}_sum{labels} {value['sum']}")
+                        lines.append(f"{name}_count{labels} {value['count']}")
+
+        if openmetrics:
+            lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # written to a temporary file first so node-exporter never reads a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def push(self, url):
+        request = Request(
+            url,
+            data=self.render(openmetrics=False).encode(),
+            method="PUT",
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+        )
+        with urlopen(request, timeout=10) as response:
+            return response.status
+
+
+def format_labels(key):
+    if not key:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in key) + "}"
+
+
+def set_registry(metrics):
+    global registry
+    registry = metrics
+
+
+def timed(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if registry is None:
+            return function(*args, **kwargs)
+
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            registry.observe(
+                "acm_scanner_duration_seconds",
+                perf_counter() - start,
+                SCAN_BUCKETS,
+                scanner=function.__name__,
+            )
+
+    return wrapper
+
+
+def instrument_session(session, metrics):
+    # botocore passes every handler a per-call context dict, so the start time of a
+    # call is kept there between before-call and after-call
+
+    def before_call(context, **kwargs):
+        context["acm_metrics_start"] = perf_counter()
+
+    def after_call(model, context, parsed, **kwargs):
+        labels = {
+            "service": model.service_model.service_name,
+            "operation": model.name,
+        }
+        # calls served from memory never reached AWS, and their resources were
+        # already counted when they did
+        if context.get("acm_memo_hit"):
+            metrics.inc("acm_api_cache_hits", **labels)
+            return
+
+        if "acm_metrics_start" in context:
+            metrics.observe(
+                "acm_api_call_duration_seconds",
+                perf_counter() - context["acm_metrics_start"],
+                API_CALL_BUCKETS,
+                **labels,
+            )
+        for key in RESOURCE_KEYS:
+            if isinstance(parsed.get(key), list):
+                metrics.inc(
+                    "acm_resources_scanned", len(parsed[key]), resource_type=key
+                )
+
+    def needs_retry(response, operation, **kwargs):
+        if response is None:
+            return None
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLE_ERROR_CODES:
+            metrics.inc(
+                "acm_api_throttles",
+                service=operation.service_model.service_name,
+                operation=operation.name,
+            )
+        return None
+
+    session.events.register("before-call", before_call)
+    session.events.register("after-call", after_call)
+    session.events.register("needs-retry", needs_retry)
+
+
+def record_findings(check, flagged, monthly_savings):
+    if registry is None:
+        return
+
+    registry.set("acm_resources_flagged", flagged, check=check)
+    registry.set("acm_potential_savings_dollars", monthly_savings, check=check)
+
+
+def record_savings(check, monthly_savings):
+    if registry is None:
+        return
+
+    registry.set("acm_realized_savings_dollars", monthly_savings, check=check)
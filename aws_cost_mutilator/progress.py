@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Optional
+from tqdm import tqdm
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    # A message, or how many of the items of a progress bar are done
+    message: Optional[str] = None
+    completed: int = 0
+    total: Optional[int] = None
+
+
+class ConsoleReporter:
+    # What the CLI shows: printed messages and tqdm bars
+
+    def message(self, text):
+        print(text)
+
+    def bar(self, iterable=None, total=None, **kwargs):
+        return tqdm(iterable, total=total, **kwargs)
+
+
+class CallbackBar:
+    # The tqdm methods the scanners use, reported as events. Bars are updated from
+    # worker threads, so they only need to be created in the calling one.
+
+    def __init__(self, callback, iterable=None, total=None, disable=False, **kwargs):
+        self.callback = callback
+        self.iterable = iterable
+        self.total = total
+        if total is None and hasattr(iterable, "__len__"):
+            self.total = len(iterable)
+        self.disable = disable
+        self.completed = 0
+        self.lock = Lock()
+
+    def __iter__(self):
+        for item in self.iterable:
+            yield item
+            self.update()
+
+    def update(self, n=1):
+        with self.lock:
+            self.completed += n
+            completed = self.completed
+        if not self.disable:
+            self.callback(ProgressEvent(completed=completed, total=self.total))
+
+    def write(self, text):
+        self.callback(ProgressEvent(message=text))
+
+    def close(self):
+        pass
+
+
+class CallbackReporter:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def message(self, text):
+        self.callback(ProgressEvent(message=text))
+
+    def bar(self, iterable=None, total=None, **kwargs):
+        return CallbackBar(self.callback, iterable, total, **kwargs)
+
+
+class SilentReporter:
+    def message(self, text):
+        pass
+
+    def bar(self, iterable=None, total=None, **kwargs):
+        return CallbackBar(lambda event: None, iterable, total, **kwargs)
+
+
+# Context variables are per thread, so API calls made from different threads each
+# report to their own callback. Worker threads are not given the context of the
+# thread that starts them, pools that report run their tasks in a copy of it.
+reporter = ContextVar("reporter", default=ConsoleReporter())
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # Runs every task in a copy of the context it was submitted from, map submits
+    # its tasks too
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(copy_context().run, fn, *args, **kwargs)
+
+
+def get_reporter():
+    return reporter.get()
+
+
+def report(text):
+    reporter.get().message(text)
+
+
+def progress_bar(iterable=None, total=None, **kwargs):
+    return reporter.get().bar(iterable, total=total, **kwargs)
+
+
+@contextmanager
+def reporting(callback: Optional[Callable[[ProgressEvent], None]]):
+    # Reports to the callback instead of the console, or nowhere without one
+    token = reporter.set(
+        CallbackReporter(callback) if callback is not None else SilentReporter()
+    )
+    try:
+        yield
+    finally:
+        reporter.reset(token)
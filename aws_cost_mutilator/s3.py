@@ -1,50 +1,357 @@
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_COMPLETED, wait
 from datetime import datetime, timedelta, UTC
-from tqdm import tqdm
+from threading import BoundedSemaphore, Lock
+from .progress import progress_bar, report, ContextThreadPoolExecutor
+from .cloudwatch import get_bucket_object_counts, get_bucket_storage_metrics
+from .metrics import timed
+from .trace import traced
 
+# DeleteObjects accepts at most 1,000 keys per request
+MAX_DELETE_KEYS = 1000
 
-def get_buckets(session, days):
+
+# Monthly cost per GB of each storage class (us-east-1), anything not listed here is
+# priced as STANDARD
+STORAGE_CLASS_PRICES = {
+    "STANDARD": 0.023,
+    "INTELLIGENT_TIERING": 0.023,
+    "STANDARD_IA": 0.0125,
+    "ONEZONE_IA": 0.01,
+    "GLACIER_IR": 0.004,
+    "GLACIER": 0.0036,
+    "DEEP_ARCHIVE": 0.00099,
+}
+
+
+@traced("scan")
+@timed
+def get_buckets(session, days, stats=None, tag_filter=None):
+    # Buckets are told empty or old from the first page of their listing, only old
+    # looking buckets with more pages are listed in full. stats, when given to cost
+    # the buckets found, is filled with the stats of every empty and old bucket,
+    # buckets it already holds stats for (e.g. from an inventory) are not listed.
     cutoff_time = datetime.now(UTC) - timedelta(days=days)
 
-    s3 = session.client("s3")
+    s3 = session.client("s3", config=Config(max_pool_connections=32))
 
     s3_buckets = {"old": [], "empty": []}
 
     response = s3.list_buckets()
-    buckets = response["Buckets"]
+    buckets = [
+        bucket
+        for bucket in response["Buckets"]
+        if tag_filter is None or is_bucket_allowed(s3, bucket["Name"], tag_filter)
+    ]
 
-    pbar = tqdm(buckets)
+    pbar = progress_bar(buckets)
     for bucket in pbar:
         bucket_name = bucket["Name"]
 
-        response = s3.list_objects_v2(Bucket=bucket_name)
-        if "Contents" not in response:
+        if stats is not None and bucket_name in stats:
+            bucket_stats = stats[bucket_name]
+        else:
+            bucket_stats = get_first_page_stats(s3, bucket_name, cutoff_time)
+            if bucket_stats is None:
+                continue
+            # an old looking first page of a larger bucket is confirmed, and the
+            # bucket costed, from a full listing
+            if bucket_stats.pop("truncated"):
+                bucket_stats = get_bucket_stats(s3, bucket_name)
+            if stats is not None:
+                stats[bucket_name] = bucket_stats
+
+        if bucket_stats["count"] == 0:
             s3_buckets["empty"].append(bucket_name)
             continue
 
-        newest_object = response["Contents"][0]
-        newest_object_time = newest_object["LastModified"]
-
-        if newest_object_time < cutoff_time:
+        if bucket_stats["last_modified"] < cutoff_time:
             s3_buckets["old"].append(bucket_name)
 
     return s3_buckets
 
 
+def is_bucket_allowed(s3, bucket_name, tag_filter):
+    # buckets are tagged in their home region, buckets whose region cannot be told
+    # are left alone
+    try:
+        region = get_bucket_region(s3, bucket_name)
+    except ClientError as e:
+        report(f"skipping bucket {bucket_name}, its region is unknown: {e}")
+        return False
+
+    return tag_filter(bucket_name, region)
+
+
+def get_first_page_stats(s3, bucket_name, cutoff_time):
+    # Stats of the first page of the bucket's listing, or None if it holds an object
+    # newer than the cutoff time, which is all most buckets need
+    page = s3.list_objects_v2(Bucket=bucket_name)
+    stats = {"size": {}, "count": 0, "last_modified": None}
+    for obj in page.get("Contents", []):
+        if obj["LastModified"] >= cutoff_time:
+            return None
+
+        storage_class = obj.get("StorageClass", "STANDARD")
+        stats["size"][storage_class] = stats["size"].get(storage_class, 0) + obj["Size"]
+        stats["count"] += 1
+        if (
+            stats["last_modified"] is None
+            or obj["LastModified"] > stats["last_modified"]
+        ):
+            stats["last_modified"] = obj["LastModified"]
+
+    return {**stats, "truncated": page.get("IsTruncated", False)}
+
+
+def walk_bucket(
+    s3, bucket_name, handle_page, operation="list_objects_v2", max_workers=16, depth=2
+):
+    # Discovers the prefix structure of the bucket with "/" delimited listings down to
+    # the given depth and lists every prefix found on a worker pool, below that depth
+    # prefixes are listed without a delimiter. handle_page is called from the workers
+    # with each page listed.
+    paginator = s3.get_paginator(operation)
+
+    def walk(prefix, level):
+        kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+        if level < depth:
+            kwargs["Delimiter"] = "/"
+
+        prefixes = []
+        for page in paginator.paginate(**kwargs):
+            prefixes.extend(
+                common_prefix["Prefix"]
+                for common_prefix in page.get("CommonPrefixes", [])
+            )
+            handle_page(page)
+
+        return [(prefix, level + 1) for prefix in prefixes]
+
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(walk, "", 0)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for prefix, level in future.result():
+                    pending.add(executor.submit(walk, prefix, level))
+
+
+def merge_bucket_stats(stats, other):
+    for storage_class, size in other["size"].items():
+        stats["size"][storage_class] = stats["size"].get(storage_class, 0) + size
+    stats["count"] += other["count"]
+    if other["last_modified"] is not None and (
+        stats["last_modified"] is None
+        or other["last_modified"] > stats["last_modified"]
+    ):
+        stats["last_modified"] = other["last_modified"]
+
+    return stats
+
+
+@traced("scan", resource="bucket_name")
+def get_bucket_stats(s3, bucket_name, max_workers=16):
+    # Aggregates the size per storage class, object count and newest LastModified of
+    # a bucket from a parallel listing, keys are never kept in memory
+    stats = {"size": {}, "count": 0, "last_modified": None}
+    lock = Lock()
+
+    def handle_page(page):
+        page_stats = {"size": {}, "count": 0, "last_modified": None}
+        for obj in page.get("Contents", []):
+            storage_class = obj.get("StorageClass", "STANDARD")
+            page_stats["size"][storage_class] = (
+                page_stats["size"].get(storage_class, 0) + obj["Size"]
+            )
+            page_stats["count"] += 1
+            if (
+                page_stats["last_modified"] is None
+                or obj["LastModified"] > page_stats["last_modified"]
+            ):
+                page_stats["last_modified"] = obj["LastModified"]
+
+        with lock:
+            merge_bucket_stats(stats, page_stats)
+
+    walk_bucket(s3, bucket_name, handle_page, max_workers=max_workers)
+
+    return stats
+
+
+def get_bucket_stats_cost(stats):
+    return sum(
+        (size / 1024**3)
+        * STORAGE_CLASS_PRICES.get(storage_class, STORAGE_CLASS_PRICES["STANDARD"])
+        for storage_class, size in stats["size"].items()
+    )
+
+
+@traced("pricing", resource="bucket_name")
 def get_bucket_cost(session, bucket_name):
-    s3 = session.client("s3")
+    s3 = session.client("s3", config=Config(max_pool_connections=32))
+
+    return get_bucket_stats_cost(get_bucket_stats(s3, bucket_name))
+
+
+def get_bucket_region(s3, bucket_name):
+    location = s3.get_bucket_location(Bucket=bucket_name)["LocationConstraint"]
+    # buckets in us-east-1 have no location constraint
+    return location or "us-east-1"
+
+
+def get_bucket_fingerprints(session):
+    # CloudWatch object count and size of every bucket, cheap enough to tell which
+    # buckets need to be listed again. Objects overwritten in place keep both, so a
+    # bucket is only treated as unchanged until its metrics change.
+    s3 = session.client("s3", config=Config(max_pool_connections=32))
+    bucket_regions = {
+        bucket["Name"]: get_bucket_region(s3, bucket["Name"])
+        for bucket in s3.list_buckets()["Buckets"]
+    }
+    return get_bucket_storage_metrics(session, bucket_regions)
+
+
+@traced("delete", resource="bucket_name")
+def expire_bucket(s3, bucket_name):
+    s3.put_bucket_lifecycle_configuration(
+        Bucket=bucket_name,
+        LifecycleConfiguration={
+            "Rules": [
+                {
+                    "ID": "acm-expire-all",
+                    "Filter": {"Prefix": ""},
+                    "Status": "Enabled",
+                    "Expiration": {"Days": 1},
+                    "NoncurrentVersionExpiration": {"NoncurrentDays": 1},
+                    "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+                },
+                {
+                    "ID": "acm-expire-delete-markers",
+                    "Filter": {"Prefix": ""},
+                    "Status": "Enabled",
+                    "Expiration": {"ExpiredObjectDeleteMarker": True},
+                },
+            ]
+        },
+    )
+
+
+@traced("delete", resource="bucket_name")
+def empty_bucket(s3, bucket_name, dry_run=False, max_workers=16):
+    # Lists object versions and delete markers with walk_bucket while deleting them
+    # in batches of MAX_DELETE_KEYS, the number of batches waiting to be deleted is
+    # bounded so memory stays flat on very large buckets
+    counts = {"deleted": 0, "failed": 0}
+    lock = Lock()
+    pending = BoundedSemaphore(max_workers * 2)
+
+    def delete_batch(batch):
+        try:
+            if not dry_run:
+                response = s3.delete_objects(
+                    Bucket=bucket_name, Delete={"Objects": batch, "Quiet": True}
+                )
+                failed = len(response.get("Errors", []))
+            else:
+                failed = 0
 
-    size = 0
-    paginator = s3.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket_name):
-        if "Contents" not in page:
-            # bucket is empty
+            with lock:
+                counts["deleted"] += len(batch) - failed
+                counts["failed"] += failed
+        finally:
+            pending.release()
+
+    def handle_page(page):
+        versions = page.get("Versions", []) + page.get("DeleteMarkers", [])
+        for offset in range(0, len(versions), MAX_DELETE_KEYS):
+            batch = [
+                {"Key": version["Key"], "VersionId": version["VersionId"]}
+                for version in versions[offset : offset + MAX_DELETE_KEYS]
+            ]
+            pending.acquire()
+            futures.append(deleter.submit(delete_batch, batch))
+
+    futures = []
+    with ContextThreadPoolExecutor(max_workers=max_workers) as deleter:
+        walk_bucket(
+            s3,
+            bucket_name,
+            handle_page,
+            "list_object_versions",
+            max_workers=max_workers,
+        )
+
+        for future in futures:
+            future.result()
+
+    return counts
+
+
+@traced("delete")
+def delete_buckets(
+    session, bucket_names, dry_run=False, lifecycle_threshold=None, max_workers=16
+):
+    s3 = session.client("s3", config=Config(max_pool_connections=max_workers * 2 + 1))
+
+    bucket_regions = {
+        bucket_name: get_bucket_region(s3, bucket_name) for bucket_name in bucket_names
+    }
+
+    object_counts = {}
+    if lifecycle_threshold is not None:
+        object_counts = get_bucket_object_counts(session, bucket_regions)
+
+    # expiring buckets are left to their lifecycle rule, they are deleted by a
+    # later run once empty
+    summary = {
+        "deleted_buckets": [],
+        "expiring_buckets": [],
+        "failed_buckets": [],
+        "errors": {},
+    }
+
+    pbar = progress_bar(bucket_names)
+    for bucket_name in pbar:
+        if (
+            lifecycle_threshold is not None
+            and object_counts[bucket_name] > lifecycle_threshold
+        ):
+            # letting a lifecycle rule expire the objects avoids listing the bucket
+            if not dry_run:
+                try:
+                    expire_bucket(s3, bucket_name)
+                except Exception as e:
+                    pbar.write(
+                        f"Failed to set lifecycle rule on bucket {bucket_name} with error {e}"
+                    )
+                    summary["failed_buckets"].append(bucket_name)
+                    summary["errors"][bucket_name] = str(e)
+                    continue
+            pbar.write(
+                f"set expiring lifecycle rule on bucket {bucket_name} with {object_counts[bucket_name]} objects (dry run: {dry_run})"
+            )
+            summary["expiring_buckets"].append(bucket_name)
             continue
 
-        for obj in page["Contents"]:
-            size += obj["Size"]
+        try:
+            counts = empty_bucket(s3, bucket_name, dry_run, max_workers)
+            pbar.write(
+                f"deleted {counts['deleted']} objects from bucket {bucket_name} (dry run: {dry_run})"
+            )
+            if counts["failed"]:
+                raise RuntimeError(f"{counts['failed']} objects could not be deleted")
+
+            if not dry_run:
+                s3.delete_bucket(Bucket=bucket_name)
+        except Exception as e:
+            pbar.write(f"Failed to delete bucket {bucket_name} with error {e}")
+            summary["failed_buckets"].append(bucket_name)
+            summary["errors"][bucket_name] = str(e)
+            continue
 
-    # Calculate the cost based on the size of the data
-    # (Assumes the standard S3 pricing model with a cost of $0.023 per GB per month)
-    cost = (size / 1024**3) * 0.023
+        pbar.write(f"deleted bucket {bucket_name} (dry run: {dry_run})")
+        summary["deleted_buckets"].append(bucket_name)
 
-    return cost
+    return summary
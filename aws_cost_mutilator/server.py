@@ -0,0 +1,276 @@
+import json
+from concurrent.futures import Future
+from datetime import datetime, UTC
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from time import monotonic
+from urllib.parse import parse_qs, urlparse
+from .ec2 import (
+    get_lb_hourly_costs,
+    scan_for_lbs_no_targets,
+    scan_for_tgs_no_targets_or_lb,
+    scan_for_unused_ebs_volumes,
+    get_old_snapshots,
+    estimate_snapshots_cost,
+    get_orphaned_snapshots,
+)
+from .elb import scan_for_clbs_no_instances
+from .graph import build_resource_graph
+from .s3 import get_buckets, get_bucket_stats_cost
+from .iam import get_unused_iam_roles
+from .tags import TagIndex, compile_tag_filter
+from .session import WarmSession
+
+# Seconds a scan result is served from memory, per check
+DEFAULT_TTLS = {
+    "lbs": 300,
+    "tgs": 300,
+    "ebs": 300,
+    "ebssnap": 900,
+    "orphansnap": 900,
+    "s3": 3600,
+    "roles": 3600,
+    "clb": 300,
+}
+
+# Pricing changes rarely, it is fetched once a day
+PRICING_TTL = 86400
+
+
+class ScanCache:
+    # Scan results kept for a TTL, concurrent requests for the same scan wait on the
+    # single scan in flight instead of starting their own
+
+    def __init__(self):
+        self.results = {}
+        self.in_flight = {}
+        self.lock = Lock()
+
+    def get(self, key, ttl, scan, refresh=False):
+        with self.lock:
+            if not refresh and key in self.results:
+                scanned_at, expires, result = self.results[key]
+                if monotonic() < expires:
+                    return scanned_at, result, True
+
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+
+        if not owner:
+            scanned_at, result = future.result()
+            return scanned_at, result, True
+
+        try:
+            result = scan()
+            scanned_at = datetime.now(UTC).isoformat()
+            with self.lock:
+                self.results[key] = (scanned_at, monotonic() + ttl, result)
+            future.set_result((scanned_at, result))
+            return scanned_at, result, False
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+
+def get_params(query, types):
+    params = {}
+    for name, param_type in types.items():
+        if name in query:
+            params[name] = param_type(query[name][-1])
+
+    return params
+
+
+class ScanServer:
+    # Scans run on clients of the session given, so the hooks registered on it, e.g.
+    # metrics or a cassette, see every scan. Regions are checked against the regions
+    # of EC2 before anything is created for them.
+
+    def __init__(self, session, ttls=None, include_tags=(), exclude_tags=()):
+        self.session = WarmSession(session)
+        self.regions = set(session.get_available_regions("ec2"))
+        self.sessions = {}
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.cache = ScanCache()
+        self.lock = Lock()
+        self.include_tags = include_tags
+        self.exclude_tags = exclude_tags
+
+        self.checks = {
+            "lbs": (self.check_lbs, {"idle_days": int}),
+            "tgs": (self.check_tgs, {}),
+            "ebs": (self.check_ebs, {"idle_days": int}),
+            "ebssnap": (self.check_ebs_snapshots, {"older_than": int}),
+            "orphansnap": (self.check_orphaned_snapshots, {}),
+            "s3": (self.check_s3, {"days": int}),
+            "roles": (self.check_roles, {"days": int}),
+            "clb": (self.check_clbs, {}),
+        }
+
+    def get_session(self, region):
+        region = region or self.session.region_name
+        if region not in self.regions:
+            raise ValueError(f"Unknown region: {region}")
+
+        with self.lock:
+            if region not in self.sessions:
+                self.sessions[region] = self.session.in_region(region)
+            return self.sessions[region], region
+
+    def get_tag_filter(self, region):
+        # tags are crawled again by every scan, so they are as fresh as its results
+        if not self.include_tags and not self.exclude_tags:
+            return None
+
+        return compile_tag_filter(
+            TagIndex(self.session),
+            self.include_tags,
+            self.exclude_tags,
+            default_region=region,
+        )
+
+    def get_hourly_costs(self, session):
+        return self.cache.get(
+            ("pricing",), PRICING_TTL, lambda: get_lb_hourly_costs(session)
+        )[1]
+
+    def check_lbs(self, session, region, idle_days=None):
+        return scan_for_lbs_no_targets(
+            session,
+            region,
+            idle_days=idle_days,
+            tag_filter=self.get_tag_filter(region),
+            hourly_costs=self.get_hourly_costs(session),
+        )
+
+    def check_tgs(self, session, region):
+        return scan_for_tgs_no_targets_or_lb(session, self.get_tag_filter(region))
+
+    def check_ebs(self, session, region, idle_days=None):
+        return scan_for_unused_ebs_volumes(
+            session, idle_days, self.get_tag_filter(region)
+        )
+
+    def check_ebs_snapshots(self, session, region, older_than=365):
+        graph = build_resource_graph(session, ["snapshots"])
+        old_snapshots = get_old_snapshots(
+            session, older_than, self.get_tag_filter(region), graph
+        )
+        return {
+            "snapshots": old_snapshots,
+            "total_monthly_cost": estimate_snapshots_cost(
+                session, old_snapshots, graph
+            ),
+        }
+
+    def check_orphaned_snapshots(self, session, region):
+        return get_orphaned_snapshots(session, self.get_tag_filter(region))
+
+    def check_s3(self, session, region, days=365):
+        stats = {}
+        buckets = get_buckets(session, days, stats, self.get_tag_filter(region))
+        buckets["total_monthly_cost"] = sum(
+            [
+                get_bucket_stats_cost(stats[bucket_name])
+                for bucket_name in buckets["old"]
+            ]
+        )
+        return buckets
+
+    def check_roles(self, session, region, days=90):
+        return {"roles": get_unused_iam_roles(session, days)}
+
+    def check_clbs(self, session, region):
+        return scan_for_clbs_no_instances(
+            session,
+            [region],
+            hourly_costs=self.get_hourly_costs(session),
+            tag_filter=self.get_tag_filter(region),
+        )
+
+    def run_check(self, name, region=None, refresh=False, **params):
+        check, _ = self.checks[name]
+        session, region = self.get_session(region)
+        key = (name, region, tuple(sorted(params.items())))
+
+        scanned_at, result, cached = self.cache.get(
+            key,
+            self.ttls[name],
+            lambda: check(session, region, **params),
+            refresh,
+        )
+
+        return {
+            "check": name,
+            "region": region,
+            "params": params,
+            "scanned_at": scanned_at,
+            "cached": cached,
+            "result": result,
+        }
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, status, body):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                parts = url.path.strip("/").split("/")
+
+                if parts == ["health"]:
+                    return self.send_json(200, {"status": "ok"})
+
+                if parts == ["checks"]:
+                    return self.send_json(200, {"checks": list(server.checks)})
+
+                if len(parts) != 2 or parts[0] != "checks":
+                    return self.send_json(404, {"error": f"Not found: {url.path}"})
+
+                name = parts[1]
+                if name not in server.checks:
+                    return self.send_json(404, {"error": f"Unknown check: {name}"})
+
+                try:
+                    params = get_params(query, server.checks[name][1])
+                    region, _ = server.get_session(query.get("region", [None])[-1])
+                except ValueError as e:
+                    return self.send_json(400, {"error": str(e)})
+
+                try:
+                    body = server.run_check(
+                        name,
+                        region=region,
+                        refresh=query.get("refresh", ["false"])[-1] == "true",
+                        **params,
+                    )
+                except Exception as e:
+                    return self.send_json(500, {"error": str(e)})
+
+                self.send_json(200, body)
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=8080):
+        httpd = ThreadingHTTPServer((host, port), self.handler())
+        print(f"Serving acm checks on http://{host}:{port}/checks")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
@@ -0,0 +1,44 @@
+from threading import Lock
+
+
+class WarmSession:
+    # Wraps a boto3 Session so clients are created once and shared by every scan,
+    # boto3 clients are thread safe once created. Clients are created in region_name
+    # unless another region is asked for.
+
+    def __init__(self, session, region_name=None):
+        self.session = session
+        self.region_name = region_name or session.region_name
+        self.clients = {}
+        self.lock = Lock()
+
+    def in_region(self, region_name):
+        # the same session and clients, with region_name as the default region
+        regional = WarmSession(self.session, region_name)
+        regional.clients = self.clients
+        regional.lock = self.lock
+        return regional
+
+    def client(self, service_name, region_name=None, config=None, **kwargs):
+        region_name = region_name or self.region_name
+        key = (
+            service_name,
+            region_name,
+            tuple(sorted(config._user_provided_options.items())) if config else None,
+            tuple(sorted(kwargs.items())),
+        )
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.session.client(
+                    service_name, region_name=region_name, config=config, **kwargs
+                )
+            return self.clients[key]
+
+    def resource(self, service_name, region_name=None, **kwargs):
+        with self.lock:
+            return self.session.resource(
+                service_name, region_name=region_name or self.region_name, **kwargs
+            )
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
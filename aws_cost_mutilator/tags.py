@@ -0,0 +1,128 @@
+from botocore.exceptions import ClientError
+from threading import Lock
+from .progress import progress_bar, report
+from .metrics import timed
+
+# Resource types the scanners report on
+RESOURCE_TYPE_FILTERS = [
+    "elasticloadbalancing:loadbalancer",
+    "elasticloadbalancing:targetgroup",
+    "ec2:volume",
+    "ec2:snapshot",
+    "s3",
+]
+
+
+def get_resource_id(arn):
+    # EC2 resources are looked up by id and buckets by name rather than by ARN
+    if ":s3:::" in arn:
+        return arn.split(":::", 1)[1]
+    if ":ec2:" in arn:
+        return arn.rsplit("/", 1)[-1]
+    return arn
+
+
+@timed
+def get_tag_index(
+    session, region_name=None, resource_type_filters=RESOURCE_TYPE_FILTERS
+):
+    # Tags of every tagged resource in the region from one paginated GetResources
+    # crawl, keyed by ARN and by the id the scanners use for the resource
+    client = session.client("resourcegroupstaggingapi", region_name=region_name)
+    paginator = client.get_paginator("get_resources")
+
+    index = {}
+    pages = paginator.paginate(
+        ResourceTypeFilters=resource_type_filters, ResourcesPerPage=100
+    )
+    for page in progress_bar(pages, unit="page"):
+        for mapping in page["ResourceTagMappingList"]:
+            tags = {tag["Key"]: tag["Value"] for tag in mapping["Tags"]}
+            index[mapping["ResourceARN"]] = tags
+            index[get_resource_id(mapping["ResourceARN"])] = tags
+
+    return index
+
+
+class TagIndex:
+    # Tag indexes of the regions resources are looked up in, each region is crawled
+    # the first time one of its resources is. Regions that cannot be crawled have
+    # None rather than an empty index, so their resources are not taken as untagged.
+
+    def __init__(self, session, resource_type_filters=RESOURCE_TYPE_FILTERS):
+        self.session = session
+        self.resource_type_filters = resource_type_filters
+        self.regions = {}
+        self.lock = Lock()
+
+    def get(self, region):
+        with self.lock:
+            if region not in self.regions:
+                report(f"getting resource tags in {region}...")
+                try:
+                    self.regions[region] = get_tag_index(
+                        self.session, region, self.resource_type_filters
+                    )
+                except ClientError as e:
+                    report(f"cannot get resource tags in {region}: {e}")
+                    self.regions[region] = None
+
+            return self.regions[region]
+
+
+def parse_tag_expressions(expressions):
+    # "key=value" matches that tag, "key" matches the key with any value
+    pairs = set()
+    keys = set()
+    for expression in expressions:
+        key, separator, value = expression.partition("=")
+        if separator:
+            pairs.add((key, value))
+        else:
+            keys.add(key)
+
+    return pairs, keys
+
+
+def compile_tag_matcher(expressions):
+    pairs, keys = parse_tag_expressions(expressions)
+
+    def matches(tags):
+        return any(key in keys or (key, value) in pairs for key, value in tags.items())
+
+    return matches
+
+
+def compile_tag_filter(index, include=(), exclude=(), default_region=None):
+    # Returns a function telling whether a resource of a region, the default region
+    # unless given, may be reported: it must not match any exclude expression and, if
+    # include expressions are given, match one of them. index maps regions to their
+    # tag index. Resources of regions without one are never reported, as their tags
+    # are unknown.
+    include_matches = compile_tag_matcher(include)
+    exclude_matches = compile_tag_matcher(exclude)
+
+    def allowed(resource_id, region=None):
+        region = region or default_region
+        region_index = index.get(region)
+        if region_index is None:
+            report(f"skipping {resource_id}, its tags in {region} are unknown")
+            return False
+
+        tags = region_index.get(resource_id, {})
+        if exclude and exclude_matches(tags):
+            return False
+        if include and not include_matches(tags):
+            return False
+        return True
+
+    return allowed
+
+
+def build_tag_filter(session, include=(), exclude=()):
+    if not include and not exclude:
+        return None
+
+    return compile_tag_filter(
+        TagIndex(session), include, exclude, default_region=session.region_name
+    )
@@ -3,10 +3,69 @@ from .ec2 import (
     scan_for_tgs_no_targets_or_lb,
     scan_for_lbs_no_targets,
     delete_ebs_volumes,
+    get_orphaned_snapshots,
+    resolve_in_flight_deletions,
 )
-from .s3 import get_buckets, get_bucket_cost
+from .s3 import (
+    get_buckets,
+    get_bucket_cost,
+    get_bucket_stats,
+    empty_bucket,
+    delete_buckets,
+)
+from .cloudwatch import get_metric_sums, get_idle_ebs_volumes
+from .inventory import get_inventory_stats
+from .journal import Journal
+from .server import ScanCache, ScanServer
+from .cur import get_cur_costs, get_monthly_cur_costs
+from .tags import compile_tag_filter
+from .metrics import Registry, instrument_session, set_registry
+from .trace import Tracer, set_tracer, trace_session
+from .cassette import Recorder, Player
+from .memo import ResponseMemo
+from .progress import report
+from .marks import (
+    tag_batches,
+    get_due_findings,
+    get_bucket_regions,
+    get_finding_regions,
+    MARK_TAG_KEY,
+)
+from .graph import build_resource_graph, ResourceGraph, SNAPSHOT
+from .api import Scanner, Cleaner, Finding
+from .delta import (
+    diff_findings,
+    load_index,
+    save_index,
+    get_unchanged_results,
+    record_inspections,
+)
+from .ebs import (
+    count_unique_blocks,
+    get_snapshot_chains,
+    get_snapshots_unique_bytes,
+    BLOCK_SIZE,
+)
+from .elb import scan_for_clbs_no_instances, delete_clb, delete_clbs, get_clb_arn
+from .cloudtrail import get_principals_last_used, get_new_log_files, load_state
+from .iam import get_unused_iam_roles
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+from datetime import datetime, timedelta, UTC
 import boto3
-from moto import mock_elbv2, mock_ec2, mock_s3
+import pytest
+import gzip
+import json
+from moto import (
+    mock_elbv2,
+    mock_ec2,
+    mock_s3,
+    mock_cloudwatch,
+    mock_elb,
+    mock_sts,
+    mock_iam,
+    mock_ebs,
+)
 
 
 # Create a mock Elastic Load Balancing client
@@ -371,7 +430,9 @@ def test_delete_ebs_volumes():
     volume = ec2.create_volume(AvailabilityZone="us-east-1a", Size=10)
 
     # delete the volume and confirm it is deleted
-    assert delete_ebs_volumes([volume.id], session) is None
+    summary = delete_ebs_volumes([volume.id], session)
+    assert summary["deleted_volumes"] == [volume.id]
+    assert summary["failed_volumes"] == []
     assert list(ec2.volumes.all()) == []
 
 
@@ -393,9 +454,11 @@ def test_get_old_buckets():
     # Add a new object to the test bucket
     s3.put_object(Bucket="test-bucket", Key="test.txt", Body=b"test")
 
-    # Check that the function does not consider the bucket to be old
-    buckets = get_buckets(session, 365)
+    # Check that the function does not consider the bucket to be old, nor costs it
+    stats = {}
+    buckets = get_buckets(session, 365, stats)
     assert "test-bucket" not in buckets["old"]
+    assert stats == {}
 
 
 @mock_s3
@@ -419,3 +482,1083 @@ def test_get_bucket_cost():
     # Check that the cost of the bucket is calculated correctly
     cost = get_bucket_cost(session, "test-bucket")
     assert cost > 0
+
+
+@mock_ec2
+def test_get_orphaned_snapshots():
+    session = boto3.Session(region_name="us-east-1")
+    client = session.client("ec2")
+
+    kept_volume_id = client.create_volume(AvailabilityZone="us-east-1a", Size=1)[
+        "VolumeId"
+    ]
+    deleted_volume_id = client.create_volume(AvailabilityZone="us-east-1a", Size=2)[
+        "VolumeId"
+    ]
+    client.create_snapshot(VolumeId=kept_volume_id)
+    orphan_ids = [
+        client.create_snapshot(VolumeId=deleted_volume_id)["SnapshotId"]
+        for _ in range(2)
+    ]
+    client.delete_volume(VolumeId=deleted_volume_id)
+
+    orphaned_snapshots = get_orphaned_snapshots(session)
+
+    assert kept_volume_id not in orphaned_snapshots
+    assert sorted(orphaned_snapshots[deleted_volume_id]["snapshots"]) == sorted(
+        orphan_ids
+    )
+    assert orphaned_snapshots[deleted_volume_id]["total_size"] == 4
+    assert orphaned_snapshots[deleted_volume_id]["monthly_cost"] == 4 * 0.05
+
+    # copies of snapshots share a placeholder volume id, each is its own group
+    graph = ResourceGraph(session.region_name, ["volumes", "snapshots"])
+    for snapshot_id in ["snap-copy-1", "snap-copy-2"]:
+        graph.add_node(
+            SNAPSHOT,
+            snapshot_id,
+            {"SnapshotId": snapshot_id, "VolumeId": "vol-ffffffff", "VolumeSize": 1},
+        )
+    orphaned_snapshots = get_orphaned_snapshots(session, graph=graph)
+    assert orphaned_snapshots["snap-copy-1"]["snapshots"] == ["snap-copy-1"]
+    assert orphaned_snapshots["snap-copy-2"]["snapshots"] == ["snap-copy-2"]
+
+    # without the volumes crawl every snapshot would look orphaned
+    with pytest.raises(ValueError):
+        get_orphaned_snapshots(
+            session, graph=ResourceGraph(session.region_name, ["snapshots"])
+        )
+
+
+@mock_cloudwatch
+def test_get_idle_ebs_volumes():
+    session = boto3.Session(region_name="us-east-1")
+    cloudwatch = session.client("cloudwatch")
+
+    cloudwatch.put_metric_data(
+        Namespace="AWS/EBS",
+        MetricData=[
+            {
+                "MetricName": "VolumeWriteOps",
+                "Dimensions": [{"Name": "VolumeId", "Value": "vol-busy"}],
+                "Timestamp": datetime.now(UTC) - timedelta(hours=1),
+                "Value": 42,
+            }
+        ],
+    )
+
+    # attached volumes publish zeros when idle, a volume without a datapoint for
+    # every day of the window, e.g. a new one, is not idle
+    for volume_id, days in [("vol-idle", 7), ("vol-new", 2)]:
+        cloudwatch.put_metric_data(
+            Namespace="AWS/EBS",
+            MetricData=[
+                {
+                    "MetricName": metric_name,
+                    "Dimensions": [{"Name": "VolumeId", "Value": volume_id}],
+                    "Timestamp": datetime.now(UTC) - timedelta(days=day, hours=1),
+                    "Value": 0,
+                }
+                for metric_name in ["VolumeReadOps", "VolumeWriteOps"]
+                for day in range(days)
+            ],
+        )
+
+    idle_volumes = get_idle_ebs_volumes(session, ["vol-busy", "vol-idle", "vol-new"], 7)
+
+    assert idle_volumes == ["vol-idle"]
+
+
+@mock_cloudwatch
+def test_get_metric_sums_batches_queries():
+    session = boto3.Session(region_name="us-east-1")
+    metrics = [
+        (f"vol-{index}", "AWS/EBS", "VolumeReadOps", {"VolumeId": f"vol-{index}"})
+        for index in range(501)
+    ]
+
+    sums = get_metric_sums(session, metrics, 30)
+
+    assert len(sums) == 501
+    assert all(value == 0 for value in sums.values())
+
+
+@mock_s3
+def test_empty_bucket():
+    session = boto3.Session(region_name="us-east-1")
+    s3 = session.client("s3")
+
+    s3.create_bucket(Bucket="test-bucket")
+    s3.put_bucket_versioning(
+        Bucket="test-bucket", VersioningConfiguration={"Status": "Enabled"}
+    )
+    for index in range(1100):
+        s3.put_object(Bucket="test-bucket", Key=f"{index % 3}/{index}.txt", Body=b"")
+    s3.put_object(Bucket="test-bucket", Key="root.txt", Body=b"")
+    s3.delete_object(Bucket="test-bucket", Key="root.txt")
+
+    # 1101 versions and one delete marker, listed across four shards
+    counts = empty_bucket(s3, "test-bucket", dry_run=True, max_workers=2)
+    assert counts == {"deleted": 1102, "failed": 0}
+    assert "Versions" in s3.list_object_versions(Bucket="test-bucket")
+
+    # moto is not thread safe, so only delete from a single shard concurrently
+    s3.create_bucket(Bucket="flat-bucket")
+    s3.put_bucket_versioning(
+        Bucket="flat-bucket", VersioningConfiguration={"Status": "Enabled"}
+    )
+    for index in range(10):
+        s3.put_object(Bucket="flat-bucket", Key=f"{index}.txt", Body=b"")
+    s3.delete_object(Bucket="flat-bucket", Key="0.txt")
+
+    counts = empty_bucket(s3, "flat-bucket", max_workers=2)
+    assert counts == {"deleted": 11, "failed": 0}
+    response = s3.list_object_versions(Bucket="flat-bucket")
+    assert "Versions" not in response
+    assert "DeleteMarkers" not in response
+
+
+@mock_s3
+@mock_cloudwatch
+def test_delete_buckets():
+    session = boto3.Session(region_name="us-east-1")
+    s3 = session.client("s3")
+    cloudwatch = session.client("cloudwatch")
+
+    for bucket_name in ["small-bucket", "large-bucket"]:
+        s3.create_bucket(Bucket=bucket_name)
+        s3.put_object(Bucket=bucket_name, Key="test.txt", Body=b"test")
+
+    cloudwatch.put_metric_data(
+        Namespace="AWS/S3",
+        MetricData=[
+            {
+                "MetricName": "NumberOfObjects",
+                "Dimensions": [
+                    {"Name": "BucketName", "Value": "large-bucket"},
+                    {"Name": "StorageType", "Value": "AllStorageTypes"},
+                ],
+                "Timestamp": datetime.now(UTC) - timedelta(hours=1),
+                "Value": 1000000,
+            }
+        ],
+    )
+
+    summary = delete_buckets(
+        session, ["small-bucket", "large-bucket"], lifecycle_threshold=1000
+    )
+
+    assert summary["deleted_buckets"] == ["small-bucket"]
+    assert summary["expiring_buckets"] == ["large-bucket"]
+    bucket_names = [bucket["Name"] for bucket in s3.list_buckets()["Buckets"]]
+    assert bucket_names == ["large-bucket"]
+    rules = s3.get_bucket_lifecycle_configuration(Bucket="large-bucket")["Rules"]
+    assert rules[0]["Expiration"] == {"Days": 1}
+
+
+@mock_s3
+def test_get_bucket_stats():
+    session = boto3.Session(region_name="us-east-1")
+    s3 = session.client("s3")
+
+    s3.create_bucket(Bucket="test-bucket")
+    for index in range(30):
+        s3.put_object(
+            Bucket="test-bucket",
+            Key=f"{index % 3}/{index % 2}/{index}/{index}.txt",
+            Body=b"test",
+            StorageClass="STANDARD_IA" if index % 5 == 0 else "STANDARD",
+        )
+    newest_time = s3.head_object(Bucket="test-bucket", Key="2/1/29/29.txt")[
+        "LastModified"
+    ]
+
+    stats = get_bucket_stats(s3, "test-bucket", max_workers=4)
+
+    assert stats["count"] == 30
+    assert stats["size"] == {"STANDARD": 96, "STANDARD_IA": 24}
+    assert stats["last_modified"] == newest_time
+    assert get_bucket_cost(session, "test-bucket") > 0
+
+
+def test_get_inventory_stats(tmp_path):
+    session = boto3.Session(region_name="us-east-1")
+
+    data_dir = tmp_path / "source-bucket" / "config" / "data"
+    data_dir.mkdir(parents=True)
+    with gzip.open(data_dir / "inventory.csv.gz", "wt") as f:
+        f.write(
+            '"source-bucket","a.txt","","true","false","10","2023-01-01T00:00:00.000Z","STANDARD"\n'
+        )
+        f.write(
+            '"source-bucket","b.txt","","true","false","20","2023-06-01T00:00:00.000Z","GLACIER"\n'
+        )
+        f.write(
+            '"source-bucket","c.txt","","true","true","","2024-01-01T00:00:00.000Z",""\n'
+        )
+
+    for day, timestamp in [("2024-01-01T00-00Z", 1), ("2024-01-02T00-00Z", 2)]:
+        manifest_dir = tmp_path / "source-bucket" / "config" / day
+        manifest_dir.mkdir()
+        (manifest_dir / "manifest.json").write_text(
+            json.dumps(
+                {
+                    "sourceBucket": "source-bucket",
+                    "destinationBucket": "arn:aws:s3:::destination-bucket",
+                    "creationTimestamp": str(timestamp),
+                    "fileFormat": "CSV",
+                    "fileSchema": "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, StorageClass",
+                    "files": [{"key": "source-bucket/config/data/inventory.csv.gz"}],
+                }
+            )
+        )
+
+    stats = get_inventory_stats(session, [str(tmp_path)], max_workers=2)
+
+    assert stats["source-bucket"]["count"] == 2
+    assert stats["source-bucket"]["size"] == {"STANDARD": 10, "GLACIER": 20}
+    assert stats["source-bucket"]["last_modified"] == datetime(2023, 6, 1, tzinfo=UTC)
+
+
+@mock_s3
+def test_get_buckets_with_stats():
+    session = boto3.Session(region_name="us-east-1")
+    s3 = session.client("s3")
+    s3.create_bucket(Bucket="test-bucket")
+
+    stats = {
+        "test-bucket": {
+            "size": {"STANDARD": 10},
+            "count": 1,
+            "last_modified": datetime(2020, 1, 1, tzinfo=UTC),
+        }
+    }
+    buckets = get_buckets(session, 365, stats)
+
+    assert buckets == {"old": ["test-bucket"], "empty": []}
+
+
+@mock_ec2
+def test_resume_delete_ebs_volumes(tmp_path, monkeypatch):
+    session = boto3.Session(region_name="us-east-1")
+    ec2 = session.client("ec2")
+    volume_ids = [
+        ec2.create_volume(AvailabilityZone="us-east-1a", Size=1)["VolumeId"]
+        for _ in range(3)
+    ]
+
+    # interrupted after deleting the first volume and while deleting the second
+    journal = Journal(tmp_path / "journal.jsonl")
+    fsyncs = []
+    monkeypatch.setattr("os.fsync", fsyncs.append)
+    # the plan is synced once, not once per volume
+    journal.intend("volume", volume_ids)
+    assert len(fsyncs) == 1
+    for volume_id, state in zip(volume_ids[:2], ["done", "in_flight"]):
+        ec2.delete_volume(VolumeId=volume_id)
+        journal.record("volume", volume_id, state)
+    journal.close()
+
+    journal = Journal(tmp_path / "journal.jsonl", resume=True)
+    assert resolve_in_flight_deletions(session, journal) == 1
+    assert list(journal.plan("volume")) == volume_ids
+
+    delete_ebs_volumes(list(journal.plan("volume")), session, journal=journal)
+
+    assert ec2.describe_volumes()["Volumes"] == []
+    assert journal.summary() == {"done": 3}
+
+
+def test_scan_cache_coalesces_concurrent_scans():
+    cache = ScanCache()
+    scans = []
+
+    def scan():
+        scans.append(1)
+        sleep(0.2)
+        return {"total_monthly_cost": 0}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: cache.get(("ebs",), 60, scan), range(4)))
+
+    assert len(scans) == 1
+    assert sorted(cached for _, _, cached in results) == [False, True, True, True]
+
+    # expired results are scanned again
+    cache.get(("s3",), 0, scan)
+    cache.get(("s3",), 0, scan)
+    assert len(scans) == 3
+
+
+@mock_ec2
+@mock_elbv2
+def test_scan_server_run_check():
+    session = boto3.Session(region_name="us-east-1")
+    server = ScanServer(session)
+
+    response = server.run_check("orphansnap")
+    assert response["cached"] is False
+    assert response["region"] == "us-east-1"
+
+    response = server.run_check("orphansnap")
+    assert response["cached"] is True
+    assert server.run_check("orphansnap", refresh=True)["cached"] is False
+
+    # regions are checked before a session is created for them
+    with pytest.raises(ValueError):
+        server.run_check("orphansnap", region="no-such-region")
+    assert list(server.sessions) == ["us-east-1"]
+    assert server.run_check("tgs", region="eu-west-1")["region"] == "eu-west-1"
+    assert server.sessions["eu-west-1"].client("ec2").meta.region_name == "eu-west-1"
+
+
+def test_get_cur_costs(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    pyarrow.parquet.write_table(
+        pa.table(
+            {
+                "line_item_resource_id": ["vol-1", "vol-1", "vol-2", "vol-1"],
+                "line_item_usage_start_date": pa.array(
+                    [
+                        datetime(2024, 1, 1),
+                        datetime(2024, 1, 2),
+                        datetime(2024, 1, 2),
+                        datetime(2023, 1, 1),
+                    ],
+                    type=pa.timestamp("ms"),
+                ),
+                "line_item_unblended_cost": [1.0, 2.0, 4.0, 8.0],
+            }
+        ),
+        tmp_path / "report.parquet",
+    )
+    with gzip.open(tmp_path / "report.csv.gz", "wt") as f:
+        f.write(
+            "identity/LineItemId,lineItem/UsageStartDate,lineItem/ResourceId,lineItem/UnblendedCost\n"
+        )
+        f.write("a,2024-01-03T00:00:00Z,vol-1,16\n")
+        f.write("b,2024-01-03T00:00:00Z,vol-3,32\n")
+
+    costs = get_cur_costs(
+        [str(tmp_path)],
+        ["vol-1", "vol-2"],
+        datetime(2024, 1, 1, tzinfo=UTC),
+        datetime(2024, 2, 1, tzinfo=UTC),
+    )
+
+    assert costs == {"vol-1": 19.0, "vol-2": 4.0}
+
+    # the window ends with the newest day of the reports, not today
+    costs = get_monthly_cur_costs([str(tmp_path)], ["vol-1", "vol-2"], days=2)
+    assert costs == {"vol-1": 18 * 15, "vol-2": 4 * 15}
+
+
+def test_compile_tag_filter():
+    index = {
+        "vol-keep": {"acm:keep": "true"},
+        "vol-prod": {"env": "prod", "team": "a"},
+        "vol-dev": {"env": "dev", "team": "a"},
+    }
+
+    allowed = compile_tag_filter(
+        {"us-east-1": index, "eu-west-1": None},
+        exclude=["acm:keep=true", "env=prod"],
+        default_region="us-east-1",
+    )
+    assert [allowed(id) for id in ["vol-keep", "vol-prod", "vol-dev", "vol-x"]] == [
+        False,
+        False,
+        True,
+        True,
+    ]
+    # resources of regions whose tags are unknown are never allowed
+    assert not allowed("vol-x", "eu-west-1")
+    assert not allowed("vol-x", "ap-south-1")
+
+    allowed = compile_tag_filter(
+        {"us-east-1": index},
+        include=["team"],
+        exclude=["env=prod"],
+        default_region="us-east-1",
+    )
+    assert [allowed(id) for id in ["vol-keep", "vol-prod", "vol-dev", "vol-x"]] == [
+        False,
+        False,
+        True,
+        False,
+    ]
+
+
+@mock_ec2
+@mock_elbv2
+def test_scan_for_tgs_no_targets_or_lb_tag_filter():
+    session = boto3.Session(region_name="us-east-1")
+    ec2_client = session.client("ec2")
+    vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+
+    elb_client = session.client("elbv2")
+    tg_arns = [
+        elb_client.create_target_group(
+            Name=name, Protocol="HTTP", Port=80, VpcId=vpc_id
+        )["TargetGroups"][0]["TargetGroupArn"]
+        for name in ["prod-tg", "dev-tg"]
+    ]
+    index = {tg_arns[0]: {"env": "prod"}, tg_arns[1]: {"env": "dev"}}
+
+    tag_filter = compile_tag_filter(
+        {"us-east-1": index}, exclude=["env=prod"], default_region="us-east-1"
+    )
+    target_groups = scan_for_tgs_no_targets_or_lb(session, tag_filter)
+
+    assert tg_arns[0] not in target_groups
+    assert tg_arns[1] in target_groups
+
+
+@mock_ec2
+@mock_elbv2
+def test_delete_lbs_dry_run_keeps_target_groups():
+    session = boto3.Session(region_name="us-east-1")
+    ec2_client = session.client("ec2")
+    vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    subnet_id = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock="10.0.0.0/24")[
+        "Subnet"
+    ]["SubnetId"]
+
+    elb_client = session.client("elbv2")
+    elb_arn = elb_client.create_load_balancer(Name="mock-elb", Subnets=[subnet_id])[
+        "LoadBalancers"
+    ][0]["LoadBalancerArn"]
+    # an orphaned target group listed under the load balancer twice is only
+    # deleted once
+    tg_arn = elb_client.create_target_group(
+        Name="mock-tg", Protocol="HTTP", Port=80, VpcId=vpc_id
+    )["TargetGroups"][0]["TargetGroupArn"]
+    lbs = {elb_arn: {"empty_target_groups": [tg_arn], "idle_target_groups": [tg_arn]}}
+
+    summary = delete_lbs(session, lbs, dry_run=True)
+
+    assert summary["deleted_load_balancers"] == [elb_arn]
+    assert summary["deleted_target_groups"] == [tg_arn]
+    assert len(elb_client.describe_target_groups()["TargetGroups"]) == 1
+    assert len(elb_client.describe_load_balancers()["LoadBalancers"]) == 1
+
+
+@mock_ec2
+def test_metrics_registry_instruments_session():
+    registry = Registry({"profile": "default"})
+    session = boto3.Session(region_name="us-east-1")
+    instrument_session(session, registry)
+    set_registry(registry)
+
+    ec2 = session.client("ec2")
+    ec2.create_volume(AvailabilityZone="us-east-1a", Size=10)
+    try:
+        get_orphaned_snapshots(session)
+    finally:
+        set_registry(None)
+
+    text = registry.render()
+    assert text.endswith("# EOF\n")
+    assert "# TYPE acm_resources_scanned counter" in text
+    assert (
+        'acm_resources_scanned_total{profile="default",resource_type="Volumes"} 1'
+        in text
+    )
+    assert (
+        'acm_api_call_duration_seconds_count{operation="DescribeVolumes",profile="default",service="ec2"} 1'
+        in text
+    )
+    assert (
+        'acm_scanner_duration_seconds_bucket{profile="default",scanner="get_orphaned_snapshots",le="+Inf"} 1'
+        in text
+    )
+    assert "# TYPE acm_resources_scanned_total counter" in registry.render(
+        openmetrics=False
+    )
+
+
+@mock_ec2
+def test_trace_spans_scanners_and_aws_calls(tmp_path):
+    tracer = Tracer({"account": "123456789012"})
+    session = boto3.Session(region_name="us-east-1")
+    trace_session(session, tracer)
+    set_tracer(tracer)
+
+    volume_id = session.client("ec2").create_volume(
+        AvailabilityZone="us-east-1a", Size=10
+    )["VolumeId"]
+    try:
+        delete_ebs_volumes([volume_id], session)
+    finally:
+        set_tracer(None)
+
+    path = tmp_path / "trace.json"
+    tracer.write(path)
+    events = json.loads(path.read_text())["traceEvents"]
+    spans = {event["name"]: event for event in events if event["ph"] == "X"}
+
+    assert spans["delete_ebs_volumes"]["cat"] == "delete"
+    assert spans["ec2.DeleteVolume"]["args"] == {
+        "account": "123456789012",
+        "region": "us-east-1",
+        "resource": volume_id,
+        "status": 200,
+    }
+    # the call is nested in the deleter's span on the same thread
+    call, deleter = spans["ec2.DeleteVolume"], spans["delete_ebs_volumes"]
+    assert call["tid"] == deleter["tid"]
+    assert deleter["ts"] <= call["ts"]
+    assert call["ts"] + call["dur"] <= deleter["ts"] + deleter["dur"]
+
+
+def test_record_and_replay_cassette(tmp_path):
+    path = tmp_path / "cassette.jsonl.gz"
+
+    with mock_ec2(), mock_elbv2():
+        session = boto3.Session(region_name="us-east-1")
+        recorder = Recorder(path)
+        recorder.attach(session)
+
+        vpc_id = session.client("ec2").describe_vpcs()["Vpcs"][0]["VpcId"]
+        session.client("elbv2").create_target_group(
+            Name="empty-tg", Protocol="HTTP", Port=80, VpcId=vpc_id
+        )
+        recorded = scan_for_tgs_no_targets_or_lb(session)
+        recorder.write()
+
+    # replayed without moto, any call missing from the cassette would fail
+    session = boto3.Session(region_name="us-east-1")
+    Player(path).attach(session)
+    replayed = scan_for_tgs_no_targets_or_lb(session)
+
+    # account ids are sanitized in the cassette
+    assert recorded
+    assert replayed == [arn.replace("123456789012", "000000000000") for arn in recorded]
+    assert "123456789012" not in gzip.open(path, "rt").read()
+
+    with pytest.raises(RuntimeError, match="No recorded response"):
+        session.client("ec2").describe_volumes()
+
+
+@mock_ec2
+@mock_elbv2
+def test_build_resource_graph_referrers():
+    session = boto3.Session(region_name="us-east-1")
+    ec2_client = session.client("ec2")
+    elb_client = session.client("elbv2")
+
+    vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    subnet_id = ec2_client.create_subnet(VpcId=vpc_id, CidrBlock="10.0.0.0/24")[
+        "Subnet"
+    ]["SubnetId"]
+    lb_arn = elb_client.create_load_balancer(Name="lb", Subnets=[subnet_id])[
+        "LoadBalancers"
+    ][0]["LoadBalancerArn"]
+    used_tg_arn, unused_tg_arn = [
+        elb_client.create_target_group(
+            Name=name, Protocol="HTTP", Port=80, VpcId=vpc_id
+        )["TargetGroups"][0]["TargetGroupArn"]
+        for name in ["used-tg", "unused-tg"]
+    ]
+    listener_arn = elb_client.create_listener(
+        LoadBalancerArn=lb_arn,
+        Protocol="HTTP",
+        Port=80,
+        DefaultActions=[{"Type": "forward", "TargetGroupArn": used_tg_arn}],
+    )["Listeners"][0]["ListenerArn"]
+
+    graph = build_resource_graph(session)
+
+    assert graph.neighbors(lb_arn, "listener") == [listener_arn]
+    assert listener_arn in graph.get_referrers(used_tg_arn)
+    assert graph.is_referenced(used_tg_arn)
+    assert not graph.is_referenced(unused_tg_arn)
+
+    # both target groups have no targets, only the unused one can be deleted
+    target_groups = scan_for_tgs_no_targets_or_lb(session, graph=graph)
+    assert used_tg_arn in target_groups and unused_tg_arn in target_groups
+    delete_tgs(session, [used_tg_arn, unused_tg_arn], graph=graph)
+    remaining = [
+        tg["TargetGroupArn"]
+        for tg in elb_client.describe_target_groups()["TargetGroups"]
+    ]
+    assert remaining == [used_tg_arn]
+
+
+@mock_ec2
+@mock_elb
+@mock_sts
+def test_scan_and_delete_clbs_across_regions():
+    session = boto3.Session(region_name="us-east-1")
+    listeners = [{"Protocol": "HTTP", "LoadBalancerPort": 80, "InstancePort": 80}]
+
+    for region in ["us-east-1", "us-west-2"]:
+        session.client("elb", region_name=region).create_load_balancer(
+            LoadBalancerName="idle-clb",
+            Listeners=listeners,
+            AvailabilityZones=[f"{region}a"],
+        )
+
+    # a load balancer with a healthy instance is kept
+    ec2_client = session.client("ec2")
+    ami_id = ec2_client.describe_images()["Images"][0]["ImageId"]
+    instance_id = ec2_client.run_instances(ImageId=ami_id, MinCount=1, MaxCount=1)[
+        "Instances"
+    ][0]["InstanceId"]
+    elb_client = session.client("elb")
+    elb_client.create_load_balancer(
+        LoadBalancerName="used-clb",
+        Listeners=listeners,
+        AvailabilityZones=["us-east-1a"],
+    )
+    elb_client.register_instances_with_load_balancer(
+        LoadBalancerName="used-clb", Instances=[{"InstanceId": instance_id}]
+    )
+
+    lbs = scan_for_clbs_no_instances(
+        session, ["us-east-1", "us-west-2"], omit_pricing=True
+    )
+    del lbs["total_monthly_cost"]
+
+    assert sorted((lb["region"], lb["name"]) for lb in lbs.values()) == [
+        ("us-east-1", "idle-clb"),
+        ("us-west-2", "idle-clb"),
+    ]
+
+    # each load balancer is looked up in the tag index of its own region
+    west_arn = get_clb_arn("us-west-2", "123456789012", "idle-clb")
+    tag_filter = compile_tag_filter(
+        {"us-east-1": {}, "us-west-2": {west_arn: {"keep": "true"}}},
+        exclude=["keep"],
+    )
+    filtered = scan_for_clbs_no_instances(
+        session, ["us-east-1", "us-west-2"], omit_pricing=True, tag_filter=tag_filter
+    )
+    del filtered["total_monthly_cost"]
+    assert [(lb["region"], lb["name"]) for lb in filtered.values()] == [
+        ("us-east-1", "idle-clb")
+    ]
+
+    summary = delete_clbs(session, lbs)
+    assert sorted(summary["deleted_load_balancers"]) == sorted(lbs)
+    for region, names in [("us-east-1", ["used-clb"]), ("us-west-2", [])]:
+        remaining = session.client("elb", region_name=region).describe_load_balancers()
+        assert [
+            lb["LoadBalancerName"] for lb in remaining["LoadBalancerDescriptions"]
+        ] == names
+
+
+@mock_iam
+def test_get_principals_last_used_incrementally(tmp_path):
+    folder = tmp_path / "AWSLogs" / "o-1" / "111111111111" / "CloudTrail" / "us-east-1"
+    role_arn = "arn:aws:iam::111111111111:role/used-role"
+    user_arn = "arn:aws:iam::111111111111:user/deploy"
+
+    def write_log(day, name, records):
+        path = folder / "2024" / "01" / day / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, "wt") as f:
+            json.dump({"Records": records}, f)
+
+    write_log(
+        "01",
+        "111111111111_CloudTrail_us-east-1_20240101T0000Z_a.json.gz",
+        [
+            {
+                "eventTime": "2024-01-01T00:00:00Z",
+                "eventName": "AssumeRole",
+                "userIdentity": {"type": "IAMUser", "arn": user_arn},
+                "requestParameters": {"roleArn": role_arn},
+            }
+        ],
+    )
+
+    session = boto3.Session(region_name="us-east-1")
+    state_path = tmp_path / "state.json"
+    last_used = get_principals_last_used(session, [str(tmp_path)], state_path)
+    assert last_used == {
+        role_arn: "2024-01-01T00:00:00Z",
+        user_arn: "2024-01-01T00:00:00Z",
+    }
+
+    write_log(
+        "02",
+        "111111111111_CloudTrail_us-east-1_20240102T0000Z_b.json.gz",
+        [
+            {
+                "eventTime": "2024-01-02T00:00:00Z",
+                "eventName": "DescribeVolumes",
+                "userIdentity": {
+                    "type": "AssumedRole",
+                    "sessionContext": {"sessionIssuer": {"arn": role_arn}},
+                },
+            }
+        ],
+    )
+
+    # only the new file is read, the earlier usage comes from the state file
+    assert len(get_new_log_files(session, [str(tmp_path)], load_state(state_path))) == 1
+    last_used = get_principals_last_used(session, [str(tmp_path)], state_path)
+    assert last_used[role_arn] == "2024-01-02T00:00:00Z"
+    assert last_used[user_arn] == "2024-01-01T00:00:00Z"
+    assert get_new_log_files(session, [str(tmp_path)], load_state(state_path)) == []
+
+    # a file delivered late within the lag window of the cursor is still read
+    write_log(
+        "01",
+        "111111111111_CloudTrail_us-east-1_20240101T2330Z_c.json.gz",
+        [
+            {
+                "eventTime": "2024-01-01T23:30:00Z",
+                "eventName": "ListUsers",
+                "userIdentity": {"type": "IAMUser", "arn": user_arn},
+            }
+        ],
+    )
+    last_used = get_principals_last_used(session, [str(tmp_path)], state_path)
+    assert last_used[user_arn] == "2024-01-01T23:30:00Z"
+    assert get_new_log_files(session, [str(tmp_path)], load_state(state_path)) == []
+
+    iam = session.client("iam")
+    for name in ["used-role", "unused-role"]:
+        iam.create_role(RoleName=name, AssumeRolePolicyDocument="{}")
+    recent = {
+        arn.replace("111111111111", "123456789012"): datetime.now(UTC).isoformat()
+        for arn in last_used
+    }
+    assert get_unused_iam_roles(session, 30, recent) == ["unused-role"]
+
+
+@mock_ebs
+def test_snapshots_unique_bytes(tmp_path):
+    # blocks written by each snapshot of a volume, oldest first: 1 and 2 of the
+    # first are overwritten by the second, 2 of the second by the third
+    assert count_unique_blocks([iter([0, 1, 2, 5]), iter([1, 2, 3]), iter([2])]) == [
+        2,
+        1,
+        1,
+    ]
+
+    session = boto3.Session(region_name="us-east-1")
+    graph = ResourceGraph(session.region_name, ["snapshots"])
+    for snapshot_id, day in [("snap-c", 3), ("snap-a", 1), ("snap-b", 2)]:
+        graph.add_node(
+            SNAPSHOT,
+            snapshot_id,
+            {
+                "SnapshotId": snapshot_id,
+                "VolumeId": "vol-1",
+                "State": "completed",
+                "StartTime": datetime(2024, 1, day),
+                "VolumeSize": 8,
+            },
+        )
+
+    # snapshots never change, so a cached chain is not walked again
+    cache_path = tmp_path / "snapshot-blocks.json"
+    cache_path.write_text(
+        json.dumps(
+            {"|snap-a|snap-b": 2, "snap-a|snap-b|snap-c": 1, "snap-b|snap-c|": 1}
+        )
+    )
+    unique_bytes = get_snapshots_unique_bytes(
+        session, ["snap-a", "snap-b"], graph, cache_path=str(cache_path)
+    )
+    assert unique_bytes == {"snap-a": 2 * BLOCK_SIZE, "snap-b": BLOCK_SIZE}
+
+    # copies share a placeholder volume id but not their blocks
+    for snapshot_id, day in [("snap-copy-1", 1), ("snap-copy-2", 2)]:
+        graph.add_node(
+            SNAPSHOT,
+            snapshot_id,
+            {
+                "SnapshotId": snapshot_id,
+                "VolumeId": "vol-ffffffff",
+                "State": "completed",
+                "StartTime": datetime(2024, 1, day),
+                "VolumeSize": 8,
+            },
+        )
+    assert get_snapshot_chains(graph, ["snap-a", "snap-copy-2"]) == [
+        ["snap-a", "snap-b", "snap-c"],
+        ["snap-copy-2"],
+    ]
+
+
+@mock_elb
+def test_concurrent_cleanup_reports_to_the_callback(capsys, monkeypatch):
+    session = boto3.Session(region_name="us-east-1")
+    elb_client = session.client("elb")
+    findings = []
+    for name in ["idle-1", "idle-2", "idle-3"]:
+        elb_client.create_load_balancer(
+            LoadBalancerName=name,
+            Listeners=[
+                {"Protocol": "HTTP", "LoadBalancerPort": 80, "InstancePort": 80}
+            ],
+            AvailabilityZones=["us-east-1a"],
+        )
+        arn = get_clb_arn("us-east-1", "123456789012", name)
+        findings.append(
+            Finding("clb", arn, "us-east-1", 0, {"name": name, "region": "us-east-1"})
+        )
+
+    # the deletes run on worker threads, which report like the calling thread
+    def reporting_delete_clb(elb_client, lb_arn, lb, *args):
+        report(f"deleting {lb['name']}")
+        delete_clb(elb_client, lb_arn, lb, *args)
+
+    monkeypatch.setattr("aws_cost_mutilator.elb.delete_clb", reporting_delete_clb)
+
+    events = []
+    results = Cleaner(session, on_progress=events.append).clean(findings)
+    assert sorted(results[0].deleted) == sorted(
+        finding.resource_id for finding in findings
+    )
+    assert sorted(
+        event.message
+        for event in events
+        if event.message and event.message.startswith("deleting ")
+    ) == [
+        "deleting idle-1",
+        "deleting idle-2",
+        "deleting idle-3",
+    ]
+    assert capsys.readouterr().out == ""
+
+
+@mock_ec2
+@mock_elbv2
+def test_api_scans_and_cleans_without_printing(capsys):
+    session = boto3.Session(region_name="us-east-1")
+    ec2_client = session.client("ec2")
+    elb_client = session.client("elbv2")
+    vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    tg_arn = elb_client.create_target_group(
+        Name="unused-tg", Protocol="HTTP", Port=80, VpcId=vpc_id
+    )["TargetGroups"][0]["TargetGroupArn"]
+
+    events = []
+    findings = list(Scanner(session, on_progress=events.append).scan("tgs"))
+    assert findings == [Finding("tgs", tg_arn, "us-east-1")]
+
+    results = Cleaner(session, on_progress=events.append).clean(findings)
+    assert [(result.check, result.deleted) for result in results] == [("tgs", [tg_arn])]
+    assert elb_client.describe_target_groups()["TargetGroups"] == []
+
+    # resources the deleters fail on are reported as failed, not deleted
+    results = Cleaner(session).clean([Finding("ebs", "vol-12345678", "us-east-1")])
+    assert (results[0].deleted, results[0].failed) == ([], ["vol-12345678"])
+
+    # orphaned snapshots are cleaned up by the volume of the finding
+    volume_id = ec2_client.create_volume(AvailabilityZone="us-east-1a", Size=1)[
+        "VolumeId"
+    ]
+    snapshot_id = ec2_client.create_snapshot(VolumeId=volume_id)["SnapshotId"]
+    ec2_client.delete_volume(VolumeId=volume_id)
+    results = Cleaner(session).clean(
+        [
+            Finding(
+                "orphansnap", volume_id, "us-east-1", 0, {"snapshots": [snapshot_id]}
+            ),
+            Finding(
+                "orphansnap",
+                "vol-gone",
+                "us-east-1",
+                0,
+                {"snapshots": ["snap-12345678"]},
+            ),
+        ]
+    )
+    assert (results[0].deleted, results[0].failed) == ([volume_id], ["vol-gone"])
+
+    # progress went to the callback, nothing was printed
+    assert any(event.message for event in events)
+    assert capsys.readouterr().out == ""
+
+
+def test_diff_findings_since_last_scan(tmp_path):
+    created = datetime(2024, 1, 1, tzinfo=UTC)
+    path = str(tmp_path / "ebs.json")
+    index = load_index(path)
+    _, index["findings"] = diff_findings(
+        index["findings"],
+        [
+            Finding(
+                "ebs", "vol-1", "us-east-1", 8, {"Size": 100, "CreateTime": created}
+            ),
+            Finding(
+                "ebs", "vol-2", "us-east-1", 1, {"Size": 10, "CreateTime": created}
+            ),
+        ],
+    )
+    fingerprints = {"bucket-1": [3, 100], "bucket-2": None}
+    record_inspections(
+        index, fingerprints, {"bucket-1": {"count": 3}, "bucket-2": {"count": 0}}
+    )
+    save_index(path, index)
+
+    # findings are compared after a round trip through the index
+    index = load_index(path)
+    delta, _ = diff_findings(
+        index["findings"],
+        [
+            Finding(
+                "ebs", "vol-1", "us-east-1", 8, {"Size": 100, "CreateTime": created}
+            ),
+            Finding(
+                "ebs", "vol-2", "us-east-1", 2, {"Size": 20, "CreateTime": created}
+            ),
+            Finding(
+                "ebs", "vol-3", "us-east-1", 1, {"Size": 10, "CreateTime": created}
+            ),
+        ],
+    )
+    assert [finding["resource_id"] for finding in delta["new"]] == ["vol-3"]
+    assert delta["changed"] == [
+        {"resource_id": "vol-2", "changes": {"monthly_cost": [1, 2], "Size": [10, 20]}}
+    ]
+    assert delta["resolved"] == []
+
+    delta, _ = diff_findings(index["findings"], [])
+    assert [finding["resource_id"] for finding in delta["resolved"]] == [
+        "vol-1",
+        "vol-2",
+    ]
+
+    # buckets without a fingerprint are always listed again
+    assert get_unchanged_results(index, {"bucket-1": [3, 100], "bucket-2": None}) == {
+        "bucket-1": {"count": 3}
+    }
+    assert get_unchanged_results(index, {"bucket-1": [4, 120]}) == {}
+
+
+@mock_ec2
+@mock_elbv2
+def test_response_memo_serves_reads_until_resources_change():
+    session = boto3.Session(region_name="us-east-1")
+    memo = ResponseMemo()
+    memo.attach(session)
+    ec2_client = session.client("ec2")
+    elb_client = session.client("elbv2")
+
+    vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    tg_arns = [
+        elb_client.create_target_group(
+            Name=name, Protocol="HTTP", Port=80, VpcId=vpc_id
+        )["TargetGroups"][0]["TargetGroupArn"]
+        for name in ["tg-1", "tg-2"]
+    ]
+
+    # the second listing is served from memory, changes to it do not leak
+    elb_client.describe_target_groups()["TargetGroups"].clear()
+    assert len(elb_client.describe_target_groups()["TargetGroups"]) == 2
+    assert (memo.hits, memo.misses) == (1, 1)
+
+    # deleting a target group drops the listing and marks the target group dirty,
+    # so polling it always calls AWS
+    elb_client.delete_target_group(TargetGroupArn=tg_arns[0])
+    assert [
+        tg["TargetGroupArn"]
+        for tg in elb_client.describe_target_groups()["TargetGroups"]
+    ] == tg_arns[1:]
+    for _ in range(2):
+        with pytest.raises(elb_client.exceptions.TargetGroupNotFoundException):
+            elb_client.describe_target_groups(TargetGroupArns=tg_arns[:1])
+    assert (memo.hits, memo.misses) == (1, 2)
+
+
+@mock_ec2
+def test_memo_hits_are_not_recorded_as_calls(tmp_path):
+    session = boto3.Session(region_name="us-east-1")
+    registry = Registry()
+    instrument_session(session, registry)
+    recorder = Recorder(tmp_path / "run.jsonl.gz")
+    recorder.attach(session)
+    ResponseMemo().attach(session)
+    ec2_client = session.client("ec2")
+
+    for _ in range(3):
+        ec2_client.describe_volumes()
+
+    # only the call that reached AWS is recorded and timed, the others are hits
+    assert [json.loads(call["key"])[1] for call in recorder.calls] == [
+        "DescribeVolumes"
+    ]
+    text = registry.render()
+    assert (
+        'acm_api_call_duration_seconds_count{operation="DescribeVolumes",service="ec2"} 1'
+        in text
+    )
+    assert (
+        'acm_api_cache_hits_total{operation="DescribeVolumes",service="ec2"} 2' in text
+    )
+
+
+def test_mark_tags_in_batches_and_sweeps_due_findings(monkeypatch):
+    monkeypatch.setattr("aws_cost_mutilator.marks.MARK_BASE_DELAY", 0)
+
+    class TaggingClient:
+        # fails the first request for one ARN and every request for an invalid one
+        def __init__(self):
+            self.requests = []
+
+        def tag_resources(self, ResourceARNList, Tags):
+            self.requests.append(ResourceARNList)
+            failures = {}
+            if arns[3] in ResourceARNList and len(self.requests) == 1:
+                failures[arns[3]] = {"ErrorCode": "InternalServiceException"}
+            if arns[5] in ResourceARNList:
+                failures[arns[5]] = {"ErrorCode": "InvalidParameterException"}
+            return {"FailedResourcesMap": failures}
+
+    arns = [f"arn:aws:ec2:us-east-1:123456789012:volume/vol-{i}" for i in range(45)]
+    client = TaggingClient()
+    result = tag_batches(client, arns, {MARK_TAG_KEY: "2026-01-01T00:00:00Z"}, 1)
+
+    assert all(len(request) <= 20 for request in client.requests)
+    assert sorted(result["tagged"]) == sorted(arns[:5] + arns[6:])
+    assert list(result["failed"]) == [arns[5]]
+    # only the transiently failed ARN was retried
+    assert client.requests[1] == [arns[3]]
+
+    now = datetime.now(UTC)
+    findings = [
+        Finding("ebs", "vol-1", "us-east-1"),
+        Finding("ebs", "vol-2", "us-east-1"),
+        Finding("ebs", "vol-3", "us-east-1"),
+        Finding("orphansnap", "vol-4", "us-east-1", 0, {"snapshots": ["s-1", "s-2"]}),
+    ]
+    marked = {
+        "vol-1": now - timedelta(days=20),
+        "vol-2": now - timedelta(days=3),
+        "s-1": now - timedelta(days=20),
+        "s-2": now - timedelta(days=3),
+    }
+    due = get_due_findings(findings, marked, 14, "123456789012")
+    assert [finding.resource_id for finding in due] == ["vol-1", "vol-4"]
+    assert due[1].details["snapshots"] == ["s-1"]
+
+
+@mock_s3
+def test_marks_of_buckets_are_in_their_region():
+    session = boto3.Session(region_name="us-east-1")
+    session.client("s3").create_bucket(
+        Bucket="eu-bucket",
+        CreateBucketConfiguration={"LocationConstraint": "eu-west-1"},
+    )
+    findings = [
+        Finding("ebs", "vol-1", "us-east-1"),
+        Finding("s3", "eu-bucket"),
+        Finding("s3", "missing-bucket"),
+    ]
+
+    # a bucket whose region cannot be told is left out rather than guessed at
+    bucket_regions = get_bucket_regions(session, findings)
+    assert bucket_regions == {"eu-bucket": "eu-west-1"}
+    assert get_finding_regions(findings, "us-east-1", bucket_regions) == [
+        "eu-west-1",
+        "us-east-1",
+    ]
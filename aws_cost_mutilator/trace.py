@@ -0,0 +1,153 @@
+import inspect
+import json
+import os
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from threading import Lock, current_thread, get_ident
+from time import perf_counter
+
+# Request parameters naming the resource an AWS call acts on, in order of preference
+RESOURCE_PARAMS = (
+    "LoadBalancerArn",
+    "TargetGroupArn",
+    "LoadBalancerArns",
+    "VolumeId",
+    "VolumeIds",
+    "SnapshotId",
+    "SnapshotIds",
+    "Bucket",
+    "RoleName",
+    "ResourceARNList",
+)
+
+# The tracer of the current run, spans are only recorded while one is set
+tracer = None
+
+
+class Tracer:
+    # Collects complete ("X") events of the Chrome trace-event format, which
+    # chrome://tracing and ui.perfetto.dev show as one timeline row per thread
+
+    def __init__(self, args=None):
+        self.args = args or {}
+        self.events = []
+        self.threads = set()
+        self.start = perf_counter()
+        self.pid = os.getpid()
+        self.lock = Lock()
+
+    def add(self, name, category, start, end, args):
+        tid = get_ident()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": tid,
+            "args": {**self.args, **args},
+        }
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": {"name": current_thread().name},
+                    }
+                )
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category, **args):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, perf_counter(), args)
+
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+def set_tracer(new_tracer):
+    global tracer
+    tracer = new_tracer
+
+
+def span(name, category, **args):
+    if tracer is None:
+        return nullcontext()
+
+    return tracer.span(name, category, **args)
+
+
+def traced(category, resource=None):
+    # Records a span for every call of the decorated function, resource names the
+    # argument identifying the resource it acts on
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+
+            span_args = {}
+            if resource:
+                bound = signature.bind_partial(*args, **kwargs)
+                span_args["resource"] = bound.arguments.get(resource)
+            with tracer.span(function.__name__, category, **span_args):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_call_resource(params):
+    for name in RESOURCE_PARAMS:
+        if name in params:
+            return params[name]
+
+    return None
+
+
+def trace_session(session, tracer):
+    # AWS calls are timed with botocore's before-call and after-call events, the
+    # start time is kept in the per-call context dict botocore passes to both
+
+    def before_call(context, **kwargs):
+        context["acm_trace_start"] = perf_counter()
+
+    def after_call(model, context, http_response, **kwargs):
+        # calls served from memory are not AWS calls
+        if "acm_trace_start" not in context or context.get("acm_memo_hit"):
+            return
+
+        params = context.get("acm_trace_params", {})
+        tracer.add(
+            f"{model.service_model.service_name}.{model.name}",
+            "aws",
+            context["acm_trace_start"],
+            perf_counter(),
+            {
+                "region": context.get("client_region"),
+                "resource": get_call_resource(params),
+                "status": http_response.status_code,
+            },
+        )
+
+    def provide_params(params, context, **kwargs):
+        context["acm_trace_params"] = params
+
+    session.events.register("provide-client-params", provide_params)
+    session.events.register("before-call", before_call)
+    session.events.register("after-call", after_call)